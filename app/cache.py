@@ -0,0 +1,66 @@
+# cache.py
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# Punctuation and emoji, except a decimal point inside a number
+_PUNCT_RE = re.compile(r"[^\w\s.]|_|(?<!\d)\.|\.(?!\d)")
+
+def normalize_message(message: str) -> str:
+    """Normalize a user message into a cache key.
+    Case, whitespace, punctuation and emoji are ignored, so 'Hi there!' and 'hi, there 👋'
+    share an entry; digits are kept so '10 coffee' and '100 coffee' never do."""
+    return _WHITESPACE_RE.sub(" ", _PUNCT_RE.sub(" ", message.lower())).strip()
+
+# Filler words that never change what kind of message it is
+_FILLER_WORDS = frozenset(("a", "an", "the", "please", "pls", "kindly", "just", "me", "my", "i", "you", "can", "could", "would"))
+
+def bag_of_words_key(message: str) -> str:
+    """Order-insensitive key for caches whose answer is a label, not text: 'show me my
+    spending breakdown' and 'spending breakdown please' share an entry. Never use it
+    where the answer depends on word order or the exact wording."""
+    return " ".join(sorted(set(normalize_message(message).split()) - _FILLER_WORDS))
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire after a time-to-live"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -1,16 +1,36 @@
 # crud.py
 
+from sqlalchemy import func, insert, lambda_stmt, select
 from sqlalchemy.orm import Session
 from . import models, schemas
+from .cache import TTLCache
 
+# phone number -> users.id; only the scalar id is kept so no ORM object outlives its session
+USER_ID_CACHE = TTLCache(maxsize=10_000, ttl=300)
+
+# Phone lookups run on every message; as lambda statements they skip rebuilding the
+# statement and its cache key, and phone_number goes in as a bound parameter
 def get_user_by_phone_number(db: Session, phone_number: str):
-    return db.query(models.User).filter(models.User.phone_number == phone_number).first()
+    return db.scalars(
+        lambda_stmt(lambda: select(models.User).where(models.User.phone_number == phone_number).limit(1))
+    ).first()
+
+def get_user_id_by_phone_number(db: Session, phone_number: str):
+    user_id = USER_ID_CACHE.get(phone_number)
+    if user_id is None:
+        user_id = db.scalar(
+            lambda_stmt(lambda: select(models.User.id).where(models.User.phone_number == phone_number))
+        )
+        if user_id is not None:
+            USER_ID_CACHE.set(phone_number, user_id)
+    return user_id
 
 def create_user(db: Session, user: schemas.UserCreate):
     db_user = models.User(phone_number=user.phone_number)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    USER_ID_CACHE.set(db_user.phone_number, db_user.id)
     return db_user
 
 def get_or_create_category(db: Session, user_id: int, category_name: str):
@@ -25,9 +45,53 @@ def get_or_create_category(db: Session, user_id: int, category_name: str):
         db.refresh(category)
     return category
 
+def get_or_create_categories(db: Session, user_id: int, category_names):
+    # Returns {lowercased name: Category}; new categories are flushed, not committed
+    wanted = {name.lower(): name for name in category_names}
+    if not wanted:
+        return {}
+    categories = {
+        category.name.lower(): category
+        for category in db.query(models.Category).filter(
+            models.Category.user_id == user_id,
+            func.lower(models.Category.name).in_(list(wanted))
+        )
+    }
+    missing = [
+        models.Category(name=name, user_id=user_id, is_custom=True)
+        for key, name in wanted.items() if key not in categories
+    ]
+    if missing:
+        db.add_all(missing)
+        db.flush()
+        categories.update((category.name.lower(), category) for category in missing)
+    return categories
+
 def create_expense(db: Session, user_id: int, category_id: int, amount: float, note: str = ""):
     expense = models.Expense(user_id=user_id, category_id=category_id, amount=amount, note=note)
     db.add(expense)
     db.commit()
     db.refresh(expense)
     return expense
+
+def create_expenses(db: Session, user_id: int, expenses):
+    # One multi-row INSERT ... RETURNING; the returned rows (id, amount, note, category_id)
+    # stay readable after the commit, unlike expired ORM instances that would each refresh
+    rows = [
+        {
+            "user_id": user_id,
+            "category_id": expense["category_id"],
+            "amount": expense["amount"],
+            "note": expense.get("note") or ""
+        }
+        for expense in expenses
+    ]
+    if not rows:
+        return []
+    stmt = insert(models.Expense).returning(
+        models.Expense.id, models.Expense.amount, models.Expense.note, models.Expense.category_id,
+        sort_by_parameter_order=True
+    )
+    created = db.execute(stmt, rows).all()
+    db.commit()
+    return created
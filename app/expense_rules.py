@@ -0,0 +1,64 @@
+# expense_rules.py
+
+import re
+
+# Rule-based reading of chat messages, shared by the LLM-backed parsers so that cheap,
+# unambiguous cases skip the model. Anything the rules can't pin down returns None.
+
+# Questions and filters ("how much...", "expenses over 500") are never expense logs
+QUESTION_RE = re.compile(
+    r"^\s*(how|what|which|when|where|why|show|list|top|most|cheapest|compare|total|did|do|can)\b|\?",
+    re.IGNORECASE,
+)
+FILTER_RE = re.compile(
+    r"\b(expenses|spending|over|above|below|under|more than|less than|between|since|last \d+)\b",
+    re.IGNORECASE,
+)
+
+# Single "amount + item" logs ("500 groceries", "paid 2000 for lunch", "fuel 1.5k") are
+# extracted locally when the item maps to a known category; anything else goes to the LLM.
+_AMOUNT_PART = r"(?P<amount>\d[\d,]*(?:\.\d+)?)\s*(?P<k>k)?\s*(?:pkr|rs\.?)?"
+_ITEM_PART = r"(?P<item>[a-z]+(?: [a-z]+){0,2})"
+_FAST_LOG_RES = (
+    re.compile(rf"^\s*(?:paid |spent )?{_AMOUNT_PART}\s+(?:for |on )?{_ITEM_PART}\s*$", re.IGNORECASE),
+    re.compile(rf"^\s*{_ITEM_PART}\s*:?\s+{_AMOUNT_PART}\s*$", re.IGNORECASE),
+)
+# A date or time word ("yesterday", "last friday", "12/5") means the expense is not
+# today's; the fast path can't date it, so the LLM takes those
+_DATE_WORD_RE = re.compile(
+    r"\b(today|tonight|yesterday|tomorrow|ago|last|morning|afternoon|evening|night|day|days|week|weekend|"
+    r"month|year|monday|tuesday|wednesday|thursday|friday|saturday|sunday|"
+    r"jan|january|feb|february|mar|march|apr|april|may|jun|june|jul|july|aug|august|"
+    r"sep|sept|september|oct|october|nov|november|dec|december)\b|\d{1,2}[/-]\d{1,2}",
+    re.IGNORECASE,
+)
+CATEGORY_KEYWORDS = {
+    **dict.fromkeys(("food", "lunch", "dinner", "breakfast", "coffee", "tea", "snacks", "pizza", "burger"), "food"),
+    **dict.fromkeys(("groceries", "grocery"), "groceries"),
+    **dict.fromkeys(("fuel", "petrol", "uber", "careem", "taxi", "bus", "rickshaw", "transport"), "transportation"),
+    **dict.fromkeys(("movie", "movies", "cinema", "netflix", "games"), "entertainment"),
+    **dict.fromkeys(("clothes", "shoes", "shirt", "shopping"), "shopping"),
+    **dict.fromkeys(("medicine", "medicines", "doctor", "pharmacy", "gym"), "health"),
+    **dict.fromkeys(("phone", "laptop", "charger", "headphones"), "electronics"),
+    **dict.fromkeys(("ball", "bat", "racket", "football", "cricket"), "sports"),
+    "rent": "rent",
+}
+
+
+def extract_simple_expense(message: str):
+    """Return [expense] for a single unambiguous "amount + item" log, else None"""
+    if QUESTION_RE.search(message) or FILTER_RE.search(message) or _DATE_WORD_RE.search(message):
+        return None
+    for pattern in _FAST_LOG_RES:
+        match = pattern.match(message)
+        if match:
+            break
+    else:
+        return None
+    item = match["item"].lower()
+    # Only the head noun decides: "coffee machine" or "phone bill" is not coffee or a phone
+    category = CATEGORY_KEYWORDS.get(item.split()[-1])
+    if category is None:
+        return None
+    amount = float(match["amount"].replace(",", "")) * (1000 if match["k"] else 1)
+    return [{"amount": int(amount) if amount.is_integer() else amount, "category": category, "note": item}]
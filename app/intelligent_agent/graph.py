@@ -3,7 +3,8 @@ Intelligent ExpenseBot Agent - Proper Tool-Based Implementation
 """
 
 import logging
-from typing import Dict, List, Optional, Any, TypedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any
 from app.intelligent_agent.config import config
 from app.intelligent_agent.memory import memory
 from app.intelligent_agent.tools import ExpenseTools
@@ -12,37 +13,119 @@ from langchain_groq import ChatGroq
 from pydantic import SecretStr
 import os
 import json
+import re
+import threading
+from types import MappingProxyType
+from sqlalchemy import text
 from app import crud
+from app.models import User
 
 logger = logging.getLogger("expensebot.intelligent_agent.graph")
 
+# Fixed query statements, built once at import instead of per call
+_CATEGORY_SPENDING_SQL = text("""
+    SELECT COALESCE(SUM(e.amount), 0) as total, COUNT(*) as count
+    FROM expenses e
+    JOIN categories c ON e.category_id = c.id
+    WHERE e.user_id = :user_id AND LOWER(c.name) = LOWER(:category)
+""")
+
+_PERIOD_TOTAL_SQL = {
+    period: text(f"""
+        SELECT COALESCE(SUM(e.amount), 0) as total
+        FROM expenses e
+        WHERE e.user_id = :user_id {time_filter}
+    """)
+    for period, time_filter in (
+        ("yesterday", "AND DATE(timestamp) = CURRENT_DATE - INTERVAL '1 day'"),
+        ("this week", "AND timestamp >= NOW() - INTERVAL '7 days'"),
+        ("this month", "AND timestamp >= NOW() - INTERVAL '1 month'"),
+        ("today", "AND DATE(timestamp) = CURRENT_DATE"),
+    )
+}
+
+# Keyword sets for the rule-based tools, matched against whole words
+_WORD_RE = re.compile(r"[a-z']+")
+_ACK_WORDS = frozenset(("thanks", "thank", "okay", "ok", "good", "great", "also", "no", "not"))
+_UNCLEAR_MESSAGES = frozenset(("i", "a", "e", "o", "u", "spent", "bought", "paid"))
+
+# --- Lazily built singletons ---
+# Read without locking on the hot path; the lock is only taken by the first initializers.
+_COMPILED_GRAPH = None
+_ROUTER_LLM = None
+_FINAL_LLM = None
+_INIT_LOCK = threading.Lock()
+
+def _get_graph():
+    graph = _COMPILED_GRAPH
+    return graph if graph is not None else _init_graph()
+
+def _init_graph():
+    global _COMPILED_GRAPH
+    with _INIT_LOCK:
+        if _COMPILED_GRAPH is None:
+            _COMPILED_GRAPH = create_agent_graph()
+        return _COMPILED_GRAPH
+
+def _get_router_llm():
+    llm = _ROUTER_LLM
+    return llm if llm is not None else _init_router_llm()
+
+def _init_router_llm():
+    global _ROUTER_LLM
+    with _INIT_LOCK:
+        if _ROUTER_LLM is None:
+            _ROUTER_LLM = ChatGroq(
+                api_key=SecretStr(os.environ.get("GROQ_API_KEY") or ""),
+                model=config.llm_model,
+                temperature=0,
+            )
+        return _ROUTER_LLM
+
+def _get_final_llm():
+    llm = _FINAL_LLM
+    return llm if llm is not None else _init_final_llm()
+
+def _init_final_llm():
+    global _FINAL_LLM
+    with _INIT_LOCK:
+        if _FINAL_LLM is None:
+            _FINAL_LLM = ChatGroq(
+                api_key=SecretStr(os.environ.get("GROQ_API_KEY") or ""),
+                model=config.llm_model,
+                temperature=0.7,  # Slightly higher for more natural responses
+            )
+        return _FINAL_LLM
+
 # --- State ---
-class AgentState(TypedDict):
+@dataclass(slots=True)
+class AgentState:
     phone_number: str
     user_message: str
-    conversation_history: List[Dict[str, Any]]
-    user_id: Optional[int]
-    response: Optional[str]
-    pending_expense: Optional[Dict[str, Any]]
-    intent: Optional[str]
-    amount: Optional[float]
-    category: Optional[str]
-    item: Optional[str]
-    clarification: Optional[str]
-    db: Any
-    tool_result: Optional[Dict[str, Any]]
-    tool_name: Optional[str]
-    final_response: Optional[str]
-    multiple_expenses: Optional[List[Dict[str, Any]]]
+    conversation_history: List[Dict[str, Any]] = field(default_factory=list)
+    user_id: Optional[int] = None
+    response: Optional[str] = None
+    pending_expense: Optional[Dict[str, Any]] = None
+    intent: Optional[str] = None
+    amount: Optional[float] = None
+    category: Optional[str] = None
+    item: Optional[str] = None
+    clarification: Optional[str] = None
+    db: Any = None
+    tool_result: Optional[Dict[str, Any]] = None
+    tool_name: Optional[str] = None
+    final_response: Optional[str] = None
+    multiple_expenses: Optional[List[Dict[str, Any]]] = None
+    extracted_data: Dict[str, Any] = field(default_factory=dict)
 
 # --- LLM Router Node (First LLM Call) ---
 def llm_router_node(state: AgentState) -> AgentState:
     """First LLM call: Analyze intent and decide which tool to use"""
-    phone_number = state["phone_number"]
-    user_message = state["user_message"]
-    user_id = state["user_id"]
-    pending_expense = state.get("pending_expense")
-    conversation_history = state.get("conversation_history", [])
+    phone_number = state.phone_number
+    user_message = state.user_message
+    user_id = state.user_id
+    pending_expense = state.pending_expense
+    conversation_history = state.conversation_history
 
     # Build conversation context
     context_lines = []
@@ -284,20 +367,16 @@ User: "how much have I spent on electronics?"
 Output ONLY the JSON object.
 """
 
-    llm = ChatGroq(
-        api_key=SecretStr(os.environ.get("GROQ_API_KEY") or ""),
-        model=config.llm_model,
-        temperature=0,
-    )
+    llm = _get_router_llm()
     
-    logger.info(f"🤖 Router LLM: Analyzing message: {user_message}")
+    logger.info("🤖 Router LLM: Analyzing message: %s", user_message)
     response = llm.invoke(prompt)
     llm_response = response.content if hasattr(response, "content") else str(response)
     
     if isinstance(llm_response, list):
         llm_response = " ".join(str(x) for x in llm_response)
     
-    logger.info(f"🤖 Router LLM Response: {llm_response}")
+    logger.info("🤖 Router LLM Response: %s", llm_response)
 
     # Parse JSON response
     try:
@@ -308,7 +387,7 @@ Output ONLY the JSON object.
         if first != -1 and last != -1 and last > first:
             json_str = llm_response[first:last+1]
             action_data = json.loads(json_str)
-            logger.info(f"🤖 Router parsed data: {action_data}")
+            logger.info("🤖 Router parsed data: %s", action_data)
         else:
             # Fallback
             action_data = {
@@ -318,7 +397,7 @@ Output ONLY the JSON object.
                 "extracted_data": {}
             }
     except Exception as e:
-        logger.error(f"🤖 Router JSON parse error: {e}")
+        logger.error("🤖 Router JSON parse error: %s", e)
         action_data = {
             "reasoning": "JSON parse error fallback",
             "tool_name": "clarification_tool",
@@ -327,43 +406,44 @@ Output ONLY the JSON object.
         }
 
     # Update state with router decision
-    state["tool_name"] = action_data.get("tool_name", "clarification_tool")
-    state["intent"] = action_data.get("intent", "clarification")
+    state.tool_name = action_data.get("tool_name", "clarification_tool")
+    state.intent = action_data.get("intent", "clarification")
     
     # Extract data for tools
-    extracted_data = action_data.get("extracted_data", {})
-    state["amount"] = extracted_data.get("amount")
-    state["item"] = extracted_data.get("item")
-    state["category"] = extracted_data.get("category")
+    extracted_data = action_data.get("extracted_data") or {}
+    state.extracted_data = extracted_data
+    state.amount = extracted_data.get("amount")
+    state.item = extracted_data.get("item")
+    state.category = extracted_data.get("category")
     
     # Extract multiple expenses if present
     multiple_expenses = action_data.get("multiple_expenses", [])
-    state["multiple_expenses"] = multiple_expenses
+    state.multiple_expenses = multiple_expenses
     
-    logger.info(f"🤖 Router decided: {state['tool_name']} for intent: {state['intent']}")
+    logger.info("🤖 Router decided: %s for intent: %s", state.tool_name, state.intent)
     if multiple_expenses:
-        logger.info(f"🤖 Router extracted {len(multiple_expenses)} expenses: {multiple_expenses}")
+        logger.info("🤖 Router extracted %s expenses: %s", len(multiple_expenses), multiple_expenses)
     return state
 
 # --- Tool Nodes ---
 def log_expense_tool(state: AgentState) -> AgentState:
     """Tool: Handle expense logging with proper context awareness"""
-    db = state.get("db")
-    user_id = state.get("user_id")
-    amount = state.get("amount")
-    item = state.get("item")
-    category = state.get("category")
-    phone_number = state.get("phone_number")
-    pending_expense = state.get("pending_expense")
-    user_message = state.get("user_message")
+    db = state.db
+    user_id = state.user_id
+    amount = state.amount
+    item = state.item
+    category = state.category
+    phone_number = state.phone_number
+    pending_expense = state.pending_expense
+    user_message = state.user_message
     
-    logger.info(f"🔧 Log Expense Tool: amount={amount}, item={item}, category={category}")
-    logger.info(f"🔧 Pending expense: {pending_expense}")
-    logger.info(f"🔧 User message: {user_message}")
+    logger.info("🔧 Log Expense Tool: amount=%s, item=%s, category=%s", amount, item, category)
+    logger.info("🔧 Pending expense: %s", pending_expense)
+    logger.info("🔧 User message: %s", user_message)
     
     # Check if user_id is valid
     if user_id is None:
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "error",
             "error": "User account not found",
             "response": "User account not found. Please try again."
@@ -373,18 +453,18 @@ def log_expense_tool(state: AgentState) -> AgentState:
     # Handle context from pending expense
     if pending_expense and not amount:
         amount = pending_expense.get("amount")
-        state["amount"] = amount
-        logger.info(f"🔧 Using pending amount: {amount}")
+        state.amount = amount
+        logger.info("🔧 Using pending amount: %s", amount)
     
     if pending_expense and not item:
         item = pending_expense.get("item")
-        state["item"] = item
-        logger.info(f"🔧 Using pending item: {item}")
+        state.item = item
+        logger.info("🔧 Using pending item: %s", item)
     
     # Parse amount if string
     if amount and isinstance(amount, str):
         amount = parse_amount(amount)
-        state["amount"] = amount
+        state.amount = amount
     
     # Determine what's missing
     missing_info = []
@@ -394,7 +474,8 @@ def log_expense_tool(state: AgentState) -> AgentState:
         missing_info.append("item")
     
     # Check if this is a very short or unclear message that shouldn't use pending context
-    if len(user_message.strip()) <= 3 or user_message.strip().lower() in ["i", "a", "e", "o", "u", "spent", "bought", "paid"]:
+    stripped = user_message.strip()
+    if len(stripped) <= 3 or stripped.lower() in _UNCLEAR_MESSAGES:
         # Clear pending context for unclear messages
         memory.set_pending_expense(phone_number, None)
         missing_info = ["amount", "item"]  # Force asking for both
@@ -420,19 +501,20 @@ def log_expense_tool(state: AgentState) -> AgentState:
             # Clear pending context if no valid data
             memory.set_pending_expense(phone_number, None)
         
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "incomplete",
             "missing": missing_info,
             "response": response,
             "pending_expense": pending_data if (amount or item) else None
         }
+        state.final_response = response
     else:
         # Complete expense - log it
         try:
             # Auto-map category if not provided
             if not category and item:
                 category = map_category(item)
-                state["category"] = category
+                state.category = category
             
             # Ensure amount is a valid number
             if amount is None:
@@ -457,7 +539,7 @@ def log_expense_tool(state: AgentState) -> AgentState:
             else:
                 response = f"Great! I've logged {amount:,.0f} PKR for {item} under {category}. Your expense has been saved successfully!"
             
-            state["tool_result"] = {
+            state.tool_result = {
                 "status": "success",
                 "expense_id": getattr(db_expense, "id"),
                 "amount": amount,
@@ -465,12 +547,13 @@ def log_expense_tool(state: AgentState) -> AgentState:
                 "item": item,
                 "response": response
             }
+            state.final_response = response
             
-            logger.info(f"✅ Logged expense: {amount} PKR for {category or item}")
+            logger.info("✅ Logged expense: %s PKR for %s", amount, category or item)
             
         except Exception as e:
-            logger.error(f"❌ Expense logging error: {e}")
-            state["tool_result"] = {
+            logger.error("❌ Expense logging error: %s", e)
+            state.tool_result = {
                 "status": "error",
                 "error": str(e),
                 "response": "Failed to log expense. Please try again."
@@ -480,17 +563,17 @@ def log_expense_tool(state: AgentState) -> AgentState:
 
 def query_expenses_tool(state: AgentState) -> AgentState:
     """Tool: Handle expense queries"""
-    db = state.get("db")
-    user_id = state.get("user_id")
-    user_message = state.get("user_message")
-    intent = state.get("intent")
-    extracted_data = state.get("extracted_data", {})
+    db = state.db
+    user_id = state.user_id
+    user_message = state.user_message
+    intent = state.intent
+    extracted_data = state.extracted_data
     
-    logger.info(f"🔧 Query Expenses Tool: {user_message}")
+    logger.info("🔧 Query Expenses Tool: %s", user_message)
     
     # Check if user_id is valid
     if user_id is None:
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "error",
             "error": "User account not found",
             "response": "User account not found. Please try again."
@@ -503,7 +586,7 @@ def query_expenses_tool(state: AgentState) -> AgentState:
         # Handle context provision (like "yeah i bought a car")
         if intent == "provide_context":
             response = "Ah, that makes perfect sense! A car purchase would definitely be your biggest expense. Thanks for the context - that helps me understand your spending patterns better. Is there anything else you'd like to know about your expenses?"
-            state["tool_result"] = {
+            state.tool_result = {
                 "status": "success",
                 "response": response,
                 "query_type": "context_acknowledgment"
@@ -515,15 +598,7 @@ def query_expenses_tool(state: AgentState) -> AgentState:
             category = extracted_data.get("category")
             if category:
                 # Get expenses for specific category
-                from sqlalchemy import text
-                sql = text(f"""
-                    SELECT COALESCE(SUM(e.amount), 0) as total, COUNT(*) as count
-                    FROM expenses e
-                    JOIN categories c ON e.category_id = c.id
-                    WHERE e.user_id = :user_id AND LOWER(c.name) = LOWER(:category)
-                """)
-                
-                result = db.execute(sql, {"user_id": user_id, "category": category}).fetchone()
+                result = db.execute(_CATEGORY_SPENDING_SQL, {"user_id": user_id, "category": category}).fetchone()
                 total = result[0] if result else 0
                 count = result[1] if result else 0
                 
@@ -532,7 +607,7 @@ def query_expenses_tool(state: AgentState) -> AgentState:
                 else:
                     response = f"You haven't logged any expenses for {category} yet."
                 
-                state["tool_result"] = {
+                state.tool_result = {
                     "status": "success",
                     "response": response,
                     "query_type": "category_spending",
@@ -581,15 +656,15 @@ def query_expenses_tool(state: AgentState) -> AgentState:
             else:
                 response = "I couldn't find any expenses in your records."
         
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "success",
             "response": response,
             "query_type": "expense_analysis"
         }
         
     except Exception as e:
-        logger.error(f"❌ Query error: {e}")
-        state["tool_result"] = {
+        logger.error("❌ Query error: %s", e)
+        state.tool_result = {
             "status": "error",
             "error": str(e),
             "response": "Sorry, I couldn't retrieve your expense data right now."
@@ -599,15 +674,15 @@ def query_expenses_tool(state: AgentState) -> AgentState:
 
 def get_total_expenses_tool(state: AgentState) -> AgentState:
     """Tool: Get total expenses for a time period"""
-    db = state.get("db")
-    user_id = state.get("user_id")
-    user_message = state.get("user_message")
+    db = state.db
+    user_id = state.user_id
+    user_message = state.user_message
     
-    logger.info(f"🔧 Get Total Expenses Tool: {user_message}")
+    logger.info("🔧 Get Total Expenses Tool: %s", user_message)
     
     # Check if user_id is valid
     if user_id is None:
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "error",
             "error": "User account not found",
             "response": "User account not found. Please try again."
@@ -615,35 +690,19 @@ def get_total_expenses_tool(state: AgentState) -> AgentState:
         return state
     
     try:
-        from datetime import datetime
-        from sqlalchemy import text
-        
         # Determine time period
         message_lower = user_message.lower()
         if "yesterday" in message_lower:
-            time_filter = "AND DATE(timestamp) = CURRENT_DATE - INTERVAL '1 day'"
             period = "yesterday"
         elif "week" in message_lower:
-            time_filter = "AND timestamp >= NOW() - INTERVAL '7 days'"
             period = "this week"
         elif "month" in message_lower:
-            time_filter = "AND timestamp >= NOW() - INTERVAL '1 month'"
             period = "this month"
-        elif "today" in message_lower:
-            time_filter = "AND DATE(timestamp) = CURRENT_DATE"
-            period = "today"
         else:
-            # Default to today
-            time_filter = "AND DATE(timestamp) = CURRENT_DATE"
+            # "today", and the default
             period = "today"
         
-        sql = text(f"""
-            SELECT COALESCE(SUM(e.amount), 0) as total
-            FROM expenses e
-            WHERE e.user_id = :user_id {time_filter}
-        """)
-        
-        result = db.execute(sql, {"user_id": user_id}).fetchone()
+        result = db.execute(_PERIOD_TOTAL_SQL[period], {"user_id": user_id}).fetchone()
         total = result[0] if result else 0
         
         if total > 0:
@@ -651,7 +710,7 @@ def get_total_expenses_tool(state: AgentState) -> AgentState:
         else:
             response = f"You haven't logged any expenses {period}."
         
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "success",
             "total": total,
             "period": period,
@@ -659,8 +718,8 @@ def get_total_expenses_tool(state: AgentState) -> AgentState:
         }
         
     except Exception as e:
-        logger.error(f"❌ Total expenses error: {e}")
-        state["tool_result"] = {
+        logger.error("❌ Total expenses error: %s", e)
+        state.tool_result = {
             "status": "error",
             "error": str(e),
             "response": "Sorry, I couldn't retrieve your expenses right now."
@@ -670,55 +729,56 @@ def get_total_expenses_tool(state: AgentState) -> AgentState:
 
 def greeting_tool(state: AgentState) -> AgentState:
     """Tool: Handle greetings and acknowledgments"""
-    user_message = state.get("user_message", "").lower()
-    intent = state.get("intent")
+    # One lowercase + tokenize pass, then set membership instead of a substring scan per word
+    words = frozenset(_WORD_RE.findall(state.user_message.lower()))
+    intent = state.intent
     
     # Handle acknowledgments and short responses
-    if intent == "acknowledgment" or any(word in user_message for word in ["thanks", "thank you", "okay", "ok", "good", "great", "also", "no", "not"]):
+    if intent == "acknowledgment" or not _ACK_WORDS.isdisjoint(words):
         response = "You're welcome! Is there anything else I can help you with?"
-    # Handle greetings
-    elif any(word in user_message for word in ["hi", "hello", "good morning", "good afternoon", "good evening"]):
-        response = "Hello! How can I help with your expenses today?"
+    # Greetings and anything else
     else:
         response = "Hello! How can I help with your expenses today?"
     
-    state["tool_result"] = {
+    state.tool_result = {
         "status": "success",
         "response": response,
         "greeting": True
     }
+    state.final_response = response
     return state
 
 def clarification_tool(state: AgentState) -> AgentState:
     """Tool: Ask for clarification"""
-    user_message = state.get("user_message", "").lower()
+    user_message = state.user_message.lower().strip()
     
     # Handle very short responses and single letters
-    if len(user_message.strip()) <= 2:
+    if len(user_message) <= 2:
         response = "I didn't quite catch that. Could you please be more specific? For example:\n• '500 for groceries' to log an expense\n• 'How much did I spend this week?' to check expenses\n• 'Show me my spending breakdown' for analysis"
-    elif user_message.strip() in ["i", "a", "e", "o", "u", "spent", "bought", "paid"]:
+    elif user_message in _UNCLEAR_MESSAGES:
         response = "I need more information to help you. Could you please provide:\n• The amount you spent\n• What you bought\n\nFor example: '500 for groceries' or 'groceries 500'"
     else:
         response = "I'm not sure what you meant. You can:\n• Log expenses: '500 for groceries'\n• Ask queries: 'How much did I spend this week?'\n• Get breakdowns: 'Show me my spending breakdown'"
     
-    state["tool_result"] = {
+    state.tool_result = {
         "status": "clarification_needed",
         "response": response
     }
+    state.final_response = response
     return state
 
 def log_multiple_expenses_tool(state: AgentState) -> AgentState:
     """Tool: Handle multiple expenses in a single message"""
-    db = state.get("db")
-    user_id = state.get("user_id")
-    multiple_expenses = state.get("multiple_expenses", [])
-    phone_number = state.get("phone_number")
+    db = state.db
+    user_id = state.user_id
+    multiple_expenses = state.multiple_expenses
+    phone_number = state.phone_number
     
-    logger.info(f"🔧 Log Multiple Expenses Tool: {len(multiple_expenses) if multiple_expenses else 0} expenses")
+    logger.info("🔧 Log Multiple Expenses Tool: %s expenses", len(multiple_expenses) if multiple_expenses else 0)
     
     # Check if user_id is valid
     if user_id is None:
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "error",
             "error": "User account not found",
             "response": "User account not found. Please try again."
@@ -726,7 +786,7 @@ def log_multiple_expenses_tool(state: AgentState) -> AgentState:
         return state
     
     if not multiple_expenses:
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "error",
             "error": "No expenses to log",
             "response": "I couldn't find any expenses to log. Please try again."
@@ -755,25 +815,30 @@ def log_multiple_expenses_tool(state: AgentState) -> AgentState:
                 failed_expenses.append(expense)
                 continue
             
+            logged_expenses.append({
+                "amount": amount,
+                "item": item,
+                "category": category or "misc"
+            })
+        
+        if logged_expenses:
+            # One category lookup and one commit for the whole message
             try:
-                # Create category and expense
-                db_category = crud.get_or_create_category(db, user_id, category or "misc")
-                db_expense = crud.create_expense(
-                    db,
-                    user_id=user_id,
-                    category_id=getattr(db_category, "id"),
-                    amount=float(amount),
-                    note=item or ""
-                )
-                logged_expenses.append({
-                    "amount": amount,
-                    "item": item,
-                    "category": category or "misc"
-                })
-                logger.info(f"✅ Logged expense: {amount} PKR for {category or item}")
+                categories = crud.get_or_create_categories(db, user_id, {exp["category"] for exp in logged_expenses})
+                crud.create_expenses(db, user_id, [
+                    {
+                        "category_id": categories[exp["category"].lower()].id,
+                        "amount": float(exp["amount"]),
+                        "note": exp["item"]
+                    }
+                    for exp in logged_expenses
+                ])
+                logger.info("✅ Logged %d expenses", len(logged_expenses))
             except Exception as e:
-                logger.error(f"❌ Failed to log expense {item}: {e}")
-                failed_expenses.append(expense)
+                db.rollback()
+                logger.error("❌ Failed to log expenses: %s", e)
+                failed_expenses.extend(logged_expenses)
+                logged_expenses = []
         
         # Generate response
         if logged_expenses and not failed_expenses:
@@ -788,7 +853,7 @@ def log_multiple_expenses_tool(state: AgentState) -> AgentState:
             # No expenses logged
             response = "I couldn't log any expenses. Please make sure to provide both amount and item for each expense."
         
-        state["tool_result"] = {
+        state.tool_result = {
             "status": "success",
             "logged_expenses": logged_expenses,
             "failed_expenses": failed_expenses,
@@ -796,8 +861,8 @@ def log_multiple_expenses_tool(state: AgentState) -> AgentState:
         }
         
     except Exception as e:
-        logger.error(f"❌ Multiple expenses logging error: {e}")
-        state["tool_result"] = {
+        logger.error("❌ Multiple expenses logging error: %s", e)
+        state.tool_result = {
             "status": "error",
             "error": str(e),
             "response": "Failed to log expenses. Please try again."
@@ -808,29 +873,29 @@ def log_multiple_expenses_tool(state: AgentState) -> AgentState:
 # --- Final LLM Node (Second LLM Call) ---
 def final_response_node(state: AgentState) -> AgentState:
     """Second LLM call: Generate final natural language response based on tool result"""
-    tool_result = state.get("tool_result", {})
-    user_message = state["user_message"]
-    intent = state.get("intent")
-    phone_number = state.get("phone_number")
+    tool_result = state.tool_result
+    user_message = state.user_message
+    intent = state.intent
+    phone_number = state.phone_number
     
-    logger.info(f"🤖 Final Response LLM: Processing tool result: {tool_result}")
+    logger.info("🤖 Final Response LLM: Processing tool result: %s", tool_result)
     
     # For successful expense logging, use the tool result and clear context
     if intent == "log_expense" and tool_result and tool_result.get("status") == "success":
         response = tool_result.get("response", "Expense logged successfully!")
         # Clear any pending expense context after successful logging
         memory.set_pending_expense(phone_number, None)
-        state["final_response"] = response
+        state.final_response = response
         return state
     
     # For incomplete expenses, use the tool result directly
     if intent == "log_expense" and tool_result and tool_result.get("status") == "incomplete":
-        state["final_response"] = tool_result.get("response", "I need more information to log your expense.")
+        state.final_response = tool_result.get("response", "I need more information to log your expense.")
         return state
     
     # For acknowledgments (thanks, okay, etc.), give a simple acknowledgment
     if intent == "acknowledgment":
-        state["final_response"] = "You're welcome! Is there anything else I can help you with?"
+        state.final_response = "You're welcome! Is there anything else I can help you with?"
         return state
     
     # For other cases, use LLM to generate natural response
@@ -839,7 +904,7 @@ You are an intelligent expense tracking assistant. Generate a natural, helpful r
 
 User Message: "{user_message}"
 Intent: {intent}
-Tool Result: {json.dumps(tool_result, indent=2)}
+Tool Result: {_format_tool_result(tool_result)}
 
 Your task is to:
 1. Take the tool result and convert it into a natural, conversational response
@@ -859,15 +924,11 @@ RULES:
 Generate ONLY the final response text, nothing else.
 """
 
-    llm = ChatGroq(
-        api_key=SecretStr(os.environ.get("GROQ_API_KEY") or ""),
-        model=config.llm_model,
-        temperature=0.7,  # Slightly higher for more natural responses
-    )
+    llm = _get_final_llm()
     
+    # One request: the reply goes out as a single message, so streaming would only add overhead
     response = llm.invoke(prompt)
     final_response = response.content if hasattr(response, "content") else str(response)
-    
     if isinstance(final_response, list):
         final_response = " ".join(str(x) for x in final_response)
     
@@ -876,12 +937,16 @@ Generate ONLY the final response text, nothing else.
     if final_response.startswith('"') and final_response.endswith('"'):
         final_response = final_response[1:-1]
     
-    state["final_response"] = final_response
-    logger.info(f"🤖 Final Response: {final_response}")
+    state.final_response = final_response
+    logger.info("🤖 Final Response: %s", final_response)
     
     return state
 
 # --- Helper Functions ---
+def _format_tool_result(tool_result):
+    """Serialize a tool result compactly for the final prompt (fewer tokens than pretty JSON)"""
+    return json.dumps(tool_result, separators=(",", ":"), default=str)
+
 def parse_amount(amount_str):
     """Parse amount string like '750k' to 750000"""
     if not amount_str:
@@ -912,98 +977,84 @@ def parse_amount(amount_str):
         except ValueError:
             return None
 
+# Canonical category -> items list; the item lookup index below is derived from it once
+_CATEGORY_ITEMS = {
+    "food": [
+        "breakfast", "lunch", "dinner", "pizza", "burger", "sandwich", "coffee", "tea",
+        "groceries", "restaurant", "meal", "foodpanda", "juice", "milkshake", "drinks", "popcorn",
+        "snack", "chips", "candy", "chocolate", "ice cream", "cake", "bread", "milk",
+        "eggs", "meat", "fish", "vegetables", "fruits", "rice", "pasta", "soup",
+        "sweets", "sweet", "chocolate bar",
+        "water bottles", "water bottle", "bottled water",
+        "apple", "apples", "carrot", "carrots", "banana", "bananas", "orange", "oranges",
+        "tomato", "tomatoes", "potato", "potatoes", "onion", "onions", "garlic", "ginger",
+    ],
+    "transportation": [
+        "car", "bus", "taxi", "uber", "fuel", "bus fare", "fare",
+        "train", "train ticket", "metro", "subway", "bike", "motorcycle",
+    ],
+    "electronics": [
+        "phone", "laptop", "computer", "charger", "headphones", "watch",
+        "tablet", "camera", "speaker", "keyboard", "mouse", "gaming mouse",
+        "monitor", "printer", "scanner", "webcam", "microphone", "router",
+    ],
+    "communication": [
+        "phone balance", "balance", "calling", "mobile", "sim", "internet",
+        "data", "sms", "call",
+    ],
+    "stationery": [
+        "notebook", "pen", "pencil", "book", "paper", "folder",
+        "binder", "stapler", "scissors",
+    ],
+    "clothing": [
+        "shirt", "pants", "shoes", "dress", "jacket", "leather jacket",
+        "coat", "sweater", "jeans", "hat", "cap", "scarf", "gloves",
+        "socks", "underwear", "belt",
+    ],
+    "furniture": [
+        "chair", "table", "bed", "sofa", "desk", "lamp",
+        "mirror", "shelf", "cabinet",
+    ],
+    "housing": [
+        "rent", "apartment", "house", "electricity", "water", "gas",
+        "maintenance", "repair",
+    ],
+    "entertainment": [
+        "movie", "cinema", "game", "concert", "ticket", "toy",
+        "toy car", "video game", "music", "theater", "show", "amusement",
+        "board game", "chess", "monopoly", "ludo", "scrabble", "puzzle",
+    ],
+    "health": [
+        "medicine", "doctor", "hospital", "pharmacy", "vitamins", "dental",
+        "eye care", "glasses", "contact lenses",
+    ],
+    "sports": [
+        "baseball", "baseball bat", "football", "basketball", "tennis", "gym",
+        "fitness", "workout", "exercise", "cricket", "cricket kit", "cricket bat",
+        "cricket ball", "cricket equipment", "sports kit", "badminton", "badminton racket",
+        "badminton kit", "swimming", "swimming gear", "yoga", "yoga mat", "weights", "dumbbells",
+    ],
+    "gift": ["gift", "sent to", "transfer"],
+    "misc": ["keychain", "donation"],
+}
+
+def _build_item_index(category_items):
+    """Invert category -> items into item -> category, rejecting items listed twice"""
+    index = {}
+    for category, items in category_items.items():
+        for item in items:
+            if item in index:
+                raise ValueError(f"Item '{item}' is mapped to both '{index[item]}' and '{category}'")
+            index[item] = category
+    return MappingProxyType(index)
+
+_ITEM_TO_CATEGORY = _build_item_index(_CATEGORY_ITEMS)
+
 def map_category(item):
     """Map common items to categories"""
     if not item:
         return "misc"
-    
-    item_lower = str(item).lower()
-    category_map = {
-        # Food
-        "breakfast": "food", "lunch": "food", "dinner": "food", "pizza": "food", 
-        "burger": "food", "sandwich": "food", "coffee": "food", "tea": "food",
-        "groceries": "food", "restaurant": "food", "meal": "food", "foodpanda": "food",
-        "juice": "food", "milkshake": "food", "drinks": "food", "popcorn": "food",
-        "snack": "food", "chips": "food", "candy": "food", "chocolate": "food",
-        "ice cream": "food", "cake": "food", "bread": "food", "milk": "food",
-        "eggs": "food", "meat": "food", "fish": "food", "vegetables": "food",
-        "fruits": "food", "rice": "food", "pasta": "food", "soup": "food",
-        "sweets": "food", "sweet": "food", "candy": "food", "chocolate bar": "food",
-        "water": "food", "water bottles": "food", "water bottle": "food", "bottled water": "food",
-        "apple": "food", "apples": "food", "carrot": "food", "carrots": "food", 
-        "banana": "food", "bananas": "food", "orange": "food", "oranges": "food",
-        "tomato": "food", "tomatoes": "food", "potato": "food", "potatoes": "food",
-        "onion": "food", "onions": "food", "garlic": "food", "ginger": "food",
-        
-        # Transportation
-        "car": "transportation", "bus": "transportation", "taxi": "transportation",
-        "uber": "transportation", "fuel": "transportation", "gas": "transportation",
-        "bus fare": "transportation", "fare": "transportation", "ticket": "transportation",
-        "train": "transportation", "train ticket": "transportation", "metro": "transportation",
-        "subway": "transportation", "bike": "transportation", "motorcycle": "transportation",
-        
-        # Electronics
-        "phone": "electronics", "laptop": "electronics", "computer": "electronics",
-        "charger": "electronics", "headphones": "electronics", "watch": "electronics",
-        "tablet": "electronics", "camera": "electronics", "speaker": "electronics",
-        "keyboard": "electronics", "mouse": "electronics", "gaming mouse": "electronics",
-        "monitor": "electronics", "printer": "electronics", "scanner": "electronics",
-        "webcam": "electronics", "microphone": "electronics", "router": "electronics",
-        
-        # Communication
-        "phone balance": "communication", "balance": "communication", "calling": "communication",
-        "mobile": "communication", "sim": "communication", "internet": "communication",
-        "data": "communication", "sms": "communication", "call": "communication",
-        
-        # Stationery
-        "notebook": "stationery", "pen": "stationery", "pencil": "stationery",
-        "book": "stationery", "paper": "stationery", "folder": "stationery",
-        "binder": "stationery", "stapler": "stationery", "scissors": "stationery",
-        
-        # Clothing
-        "shirt": "clothing", "pants": "clothing", "shoes": "clothing",
-        "dress": "clothing", "jacket": "clothing", "leather jacket": "clothing",
-        "coat": "clothing", "sweater": "clothing", "jeans": "clothing",
-        "hat": "clothing", "cap": "clothing", "scarf": "clothing", "gloves": "clothing",
-        "socks": "clothing", "underwear": "clothing", "belt": "clothing",
-        
-        # Furniture/Home
-        "chair": "furniture", "table": "furniture", "bed": "furniture",
-        "sofa": "furniture", "desk": "furniture", "lamp": "furniture",
-        "mirror": "furniture", "shelf": "furniture", "cabinet": "furniture",
-        
-        # Housing
-        "rent": "housing", "apartment": "housing", "house": "housing",
-        "electricity": "housing", "water": "housing", "gas": "housing",
-        "maintenance": "housing", "repair": "housing",
-        
-        # Entertainment
-        "movie": "entertainment", "cinema": "entertainment", "game": "entertainment",
-        "concert": "entertainment", "ticket": "entertainment", "toy": "entertainment",
-        "toy car": "entertainment", "video game": "entertainment", "music": "entertainment",
-        "theater": "entertainment", "show": "entertainment", "amusement": "entertainment",
-        "board game": "entertainment", "chess": "entertainment", "monopoly": "entertainment",
-        "ludo": "entertainment", "scrabble": "entertainment", "puzzle": "entertainment",
-        
-        # Health
-        "medicine": "health", "doctor": "health", "hospital": "health",
-        "pharmacy": "health", "vitamins": "health", "dental": "health",
-        "eye care": "health", "glasses": "health", "contact lenses": "health",
-        
-        # Sports
-        "baseball": "sports", "baseball bat": "sports", "football": "sports",
-        "basketball": "sports", "tennis": "sports", "gym": "sports",
-        "fitness": "sports", "workout": "sports", "exercise": "sports",
-        "cricket": "sports", "cricket kit": "sports", "cricket bat": "sports",
-        "cricket ball": "sports", "cricket equipment": "sports", "sports kit": "sports",
-        "badminton": "sports", "badminton racket": "sports", "badminton kit": "sports",
-        "swimming": "sports", "swimming gear": "sports", "yoga": "sports",
-        "yoga mat": "sports", "weights": "sports", "dumbbells": "sports",
-        
-        # Miscellaneous
-        "keychain": "misc", "gift": "gift", "donation": "misc", "sent to": "gift", "transfer": "gift"
-    }
-    return category_map.get(item_lower, "misc")
+    return _ITEM_TO_CATEGORY.get(str(item).lower(), "misc")
 
 # --- Graph Construction ---
 def create_agent_graph():
@@ -1021,7 +1072,7 @@ def create_agent_graph():
     
     # Routing from router to tools
     def route_to_tool(state: AgentState) -> str:
-        tool_name = state.get("tool_name")
+        tool_name = state.tool_name
         if tool_name is None:
             return "clarification_tool"
         return tool_name
@@ -1039,9 +1090,12 @@ def create_agent_graph():
         }
     )
     
-    # All tools go to final response
+    # Tools that already produced user-facing text skip the second LLM call
+    def route_after_tool(state: AgentState) -> str:
+        return END if state.final_response else "final_response_node"
+    
     for tool in ["log_expense_tool", "query_expenses_tool", "get_total_expenses_tool", "greeting_tool", "clarification_tool", "log_multiple_expenses_tool"]:
-        workflow.add_edge(tool, "final_response_node")
+        workflow.add_conditional_edges(tool, route_after_tool, {"final_response_node": "final_response_node", END: END})
     
     # Final response ends the graph
     workflow.add_edge("final_response_node", END)
@@ -1054,11 +1108,10 @@ def process_message_with_agent(phone_number: str, message: str, db) -> Optional[
     if not config.enabled:
         return None
     try:
-        logger.info(f"🤖 INTELLIGENT AGENT: Processing message: {message}")
+        logger.info("🤖 INTELLIGENT AGENT: Processing message: %s", message)
         conversation_history = memory.get_conversation_context(phone_number)
         pending_expense = memory.get_pending_expense(phone_number)
         
-        from ..models import User
         user = db.query(User).filter(User.phone_number == phone_number).first()
         if not user:
             return None
@@ -1070,23 +1123,13 @@ def process_message_with_agent(phone_number: str, message: str, db) -> Optional[
             conversation_history=[{
                 "user": turn.user_message,
                 "assistant": turn.bot_response
-            } for turn in conversation_history[-3:]],
+            } for turn in conversation_history],
             user_id=user_id,
-            response=None,
             pending_expense=pending_expense,
-            intent=None,
-            amount=None,
-            category=None,
-            item=None,
-            clarification=None,
-            db=db,
-            tool_result=None,
-            tool_name=None,
-            final_response=None,
-            multiple_expenses=None
+            db=db
         )
         
-        graph = create_agent_graph()
+        graph = _get_graph()
         final_state = graph.invoke(state)
         
         final_response = final_state.get("final_response")
@@ -1098,7 +1141,7 @@ def process_message_with_agent(phone_number: str, message: str, db) -> Optional[
                 intent=final_state.get("intent") or "intelligent_agent",
                 confidence=0.9
             )
-            logger.info(f"🤖 INTELLIGENT AGENT: Success! Returning: {final_response}")
+            logger.info("🤖 INTELLIGENT AGENT: Success! Returning: %s", final_response)
             return {
                 "message": final_response,
                 "intent": final_state.get("intent") or "intelligent_agent",
@@ -1106,11 +1149,11 @@ def process_message_with_agent(phone_number: str, message: str, db) -> Optional[
                 "tools_used": [final_state.get("tool_name")]
             }
         
-        logger.info(f"🤖 INTELLIGENT AGENT: No response generated")
+        logger.info("🤖 INTELLIGENT AGENT: No response generated")
         return None
         
     except Exception as e:
-        logger.error(f"Agent processing error: {e}")
+        logger.error("Agent processing error: %s", e)
         import traceback
         traceback.print_exc()
         return None 
\ No newline at end of file
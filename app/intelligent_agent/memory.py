@@ -2,14 +2,26 @@
 Conversation Memory Management for Intelligent Agent
 """
 
+import re
 import time
+from itertools import islice
 from typing import Dict, List, Optional, Any
 from dataclasses import dataclass, field
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 import logging
 
 logger = logging.getLogger("expensebot.intelligent_agent.memory")
 
+# Common patterns for name introduction, compiled once and tried in priority order, so
+# "this is great, i am Ali" still finds "i am Ali" before "this is great"
+_NAME_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r"i am ([a-zA-Z]+)",
+    r"i'm ([a-zA-Z]+)",
+    r"my name is ([a-zA-Z]+)",
+    r"this is ([a-zA-Z]+)",
+    r"call me ([a-zA-Z]+)",
+))
+
 @dataclass
 class ConversationTurn:
     """Represents a single turn in the conversation"""
@@ -45,7 +57,11 @@ class UserContext:
     
     def get_recent_context(self, turns: int = 3) -> List[ConversationTurn]:
         """Get recent conversation context"""
-        return list(self.conversation_history)[-turns:]
+        history = self.conversation_history
+        if turns <= 0:
+            # Same as the list slice [-turns:]: 0 returns the whole history
+            return list(history)[-turns:]
+        return list(islice(history, max(0, len(history) - turns), None))
     
     def get_user_name(self) -> Optional[str]:
         """Extract or return user name"""
@@ -70,14 +86,17 @@ class ConversationMemory:
     def __init__(self, max_history: int = 10, ttl_seconds: int = 3600):
         self.max_history = max_history
         self.ttl_seconds = ttl_seconds
-        self.user_contexts: Dict[str, UserContext] = {}
+        # Ordered oldest-to-newest by last_interaction, so expiry only looks at the front
+        self.user_contexts: "OrderedDict[str, UserContext]" = OrderedDict()
         self._cleanup_timer = 0
     
     def get_user_context(self, phone_number: str) -> UserContext:
         """Get or create user context"""
-        if phone_number not in self.user_contexts:
-            self.user_contexts[phone_number] = UserContext(phone_number=phone_number)
-        return self.user_contexts[phone_number]
+        context = self.user_contexts.get(phone_number)
+        if context is None:
+            context = UserContext(phone_number=phone_number)
+            self.user_contexts[phone_number] = context
+        return context
     
     def add_conversation_turn(self, phone_number: str, user_message: str, 
                              bot_response: Optional[str] = None, intent: Optional[str] = None,
@@ -85,6 +104,8 @@ class ConversationMemory:
         """Add a conversation turn for a user"""
         context = self.get_user_context(phone_number)
         context.add_turn(user_message, bot_response, intent, confidence)
+        # add_turn refreshed last_interaction, so the context is now the newest
+        self.user_contexts.move_to_end(phone_number)
         
         # Extract user name if this is an introduction
         if intent == "introduction" and not context.name:
@@ -119,19 +140,9 @@ class ConversationMemory:
     
     def _extract_name_from_message(self, message: str) -> Optional[str]:
         """Extract name from introduction messages"""
-        import re
-        # Common patterns for name introduction
-        patterns = [
-            r"i am ([a-zA-Z]+)",
-            r"i'm ([a-zA-Z]+)", 
-            r"my name is ([a-zA-Z]+)",
-            r"this is ([a-zA-Z]+)",
-            r"call me ([a-zA-Z]+)"
-        ]
-        
         message_lower = message.lower()
-        for pattern in patterns:
-            match = re.search(pattern, message_lower)
+        for pattern in _NAME_PATTERNS:
+            match = pattern.search(message_lower)
             if match:
                 return match.group(1).title()
         return None
@@ -139,15 +150,13 @@ class ConversationMemory:
     def cleanup_expired_contexts(self) -> None:
         """Remove expired user contexts"""
         current_time = time.time()
-        expired_users = []
-        
-        for phone_number, context in self.user_contexts.items():
-            if current_time - context.last_interaction > self.ttl_seconds:
-                expired_users.append(phone_number)
-        
-        for phone_number in expired_users:
-            del self.user_contexts[phone_number]
-            logger.info(f"Cleaned up expired context for user {phone_number}")
+        # Oldest interaction first, so stop at the first context that is still live
+        while self.user_contexts:
+            phone_number, context = next(iter(self.user_contexts.items()))
+            if current_time - context.last_interaction <= self.ttl_seconds:
+                break
+            self.user_contexts.popitem(last=False)
+            logger.info("Cleaned up expired context for user %s", phone_number)
     
     def get_memory_summary(self) -> Dict[str, Any]:
         """Get memory usage summary"""
@@ -9,6 +9,7 @@ from sqlalchemy.orm import Session
 from app.intelligent_agent.config import config
 from app.intelligent_agent.graph import process_message_with_agent
 from app.intelligent_agent.memory import memory
+from app.models import User
 
 logger = logging.getLogger("expensebot.intelligent_agent.processor")
 
@@ -24,32 +25,31 @@ def process_message_safely(phone_number: str, message: str, db) -> Optional[Dict
             return None
         
         # Get user from database
-        from ..models import User
         user = db.query(User).filter(User.phone_number == phone_number).first()
         if not user:
-            logger.warning(f"🤖 User not found for phone number: {phone_number}")
+            logger.warning("🤖 User not found for phone number: %s", phone_number)
             return None
         
         # Get conversation context
         conversation_history = memory.get_conversation_context(phone_number)
         pending_expense = memory.get_pending_expense(phone_number)
         
-        logger.info(f"🤖 Processing message: {message}")
-        logger.info(f"🤖 Conversation history length: {len(conversation_history)}")
-        logger.info(f"🤖 Pending expense: {pending_expense}")
+        logger.info("🤖 Processing message: %s", message)
+        logger.info("🤖 Conversation history length: %s", len(conversation_history))
+        logger.info("🤖 Pending expense: %s", pending_expense)
         
         # Process with agent
         result = process_message_with_agent(phone_number, message, db)
         
         if result:
-            logger.info(f"🤖 Agent result: {result}")
+            logger.info("🤖 Agent result: %s", result)
             return result
         else:
             logger.info("🤖 Agent returned None, falling back to legacy system")
             return None
             
     except Exception as e:
-        logger.error(f"🤖 Error in process_message_safely: {e}")
+        logger.error("🤖 Error in process_message_safely: %s", e)
         import traceback
         traceback.print_exc()
         return None
@@ -60,12 +60,12 @@ def cleanup_memory():
         memory.cleanup_expired_contexts()
         logger.debug("Memory cleanup completed")
     except Exception as e:
-        logger.error(f"Memory cleanup failed: {e}")
+        logger.error("Memory cleanup failed: %s", e)
 
 def get_memory_stats() -> Dict[str, Any]:
     """Get memory usage statistics"""
     try:
         return memory.get_memory_summary()
     except Exception as e:
-        logger.error(f"Failed to get memory stats: {e}")
+        logger.error("Failed to get memory stats: %s", e)
         return {"error": "Failed to get memory statistics"} 
\ No newline at end of file
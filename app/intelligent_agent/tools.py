@@ -8,24 +8,24 @@ from typing import Dict, List, Optional, Any, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy import text, func
 from datetime import datetime, timedelta
+from operator import itemgetter
+from types import MappingProxyType
 
 from app import crud, models
-from app.services import llm_service
 
 logger = logging.getLogger("expensebot.intelligent_agent.tools")
 
-class ExpenseTools:
-    """Enhanced tools for expense processing and analysis"""
-    
-    def __init__(self, db: Session):
-        self.db = db
-    
-    def generate_advanced_sql(self, query_type: str, user_id: int, **kwargs) -> str:
-        """Generate advanced SQL queries for complex analysis"""
-        
-        if query_type == "max_expense":
-            time_filter = self._get_time_filter(kwargs.get("time_period", "all"))
-            return f"""
+# Whitelisted time filter clauses; only these fragments are ever spliced into SQL
+_TIME_FILTERS = MappingProxyType({
+    "today": "AND DATE(timestamp) = CURRENT_DATE",
+    "week": "AND timestamp >= NOW() - INTERVAL '7 days'",
+    "month": "AND timestamp >= NOW() - INTERVAL '1 month'",
+    "year": "AND timestamp >= NOW() - INTERVAL '1 year'",
+})
+
+# SQL templates built once; {time_filter} is filled from _TIME_FILTERS, values are bound parameters
+_SQL_TEMPLATES = MappingProxyType({
+    "max_expense": """
             SELECT 
                 e.amount,
                 c.name as category,
@@ -33,15 +33,11 @@ class ExpenseTools:
                 e.note
             FROM expenses e
             JOIN categories c ON e.category_id = c.id
-            WHERE e.user_id = {user_id} {time_filter}
+            WHERE e.user_id = :user_id {time_filter}
             ORDER BY e.amount DESC
             LIMIT 1
-            """
-        
-        elif query_type == "top_expenses":
-            limit = kwargs.get("limit", 5)
-            time_filter = self._get_time_filter(kwargs.get("time_period", "all"))
-            return f"""
+            """,
+    "top_expenses": """
             SELECT 
                 e.amount,
                 c.name as category,
@@ -49,14 +45,11 @@ class ExpenseTools:
                 e.note
             FROM expenses e
             JOIN categories c ON e.category_id = c.id
-            WHERE e.user_id = {user_id} {time_filter}
+            WHERE e.user_id = :user_id {time_filter}
             ORDER BY e.amount DESC
-            LIMIT {limit}
-            """
-        
-        elif query_type == "category_breakdown":
-            time_filter = self._get_time_filter(kwargs.get("time_period", "all"))
-            return f"""
+            LIMIT :limit
+            """,
+    "category_breakdown": """
             SELECT 
                 c.name as category,
                 SUM(e.amount) as total_amount,
@@ -64,58 +57,67 @@ class ExpenseTools:
                 AVG(e.amount) as avg_amount
             FROM expenses e
             JOIN categories c ON e.category_id = c.id
-            WHERE e.user_id = {user_id} {time_filter}
+            WHERE e.user_id = :user_id {time_filter}
             GROUP BY c.name
             ORDER BY total_amount DESC
-            """
-        
-        elif query_type == "daily_average":
-            time_filter = self._get_time_filter(kwargs.get("time_period", "all"))
-            return f"""
-            SELECT 
-                DATE(e.timestamp) as date,
-                SUM(e.amount) as daily_total,
-                COUNT(*) as transactions
-            FROM expenses e
-            WHERE e.user_id = {user_id} {time_filter}
-            GROUP BY DATE(e.timestamp)
-            ORDER BY date DESC
-            """
-        
-        elif query_type == "spending_trend":
-            days = kwargs.get("days", 7)
-            return f"""
+            """,
+    "average_daily_total": """
+            SELECT AVG(daily_total) AS daily_average
+            FROM (
+                SELECT DATE(timestamp) AS date, SUM(amount) AS daily_total
+                FROM expenses
+                WHERE user_id = :user_id {time_filter}
+                GROUP BY DATE(timestamp)
+            ) t
+            """,
+    "spending_trend": """
             SELECT 
                 DATE(e.timestamp) as date,
                 SUM(e.amount) as daily_total
             FROM expenses e
-            WHERE e.user_id = {user_id}
-            AND e.timestamp >= NOW() - INTERVAL '{days} days'
+            WHERE e.user_id = :user_id
+            AND e.timestamp >= NOW() - :days * INTERVAL '1 day'
             GROUP BY DATE(e.timestamp)
             ORDER BY date
-            """
-        
-        else:
-            # Fallback to basic query
-            return f"SELECT SUM(amount) FROM expenses WHERE user_id = {user_id}"
+            """,
+})
+
+# Fallback to basic query
+_DEFAULT_SQL = "SELECT SUM(amount) FROM expenses WHERE user_id = :user_id"
+
+_CATEGORY_EMOJIS = MappingProxyType({
+    "transport": "🚗", "electronics": "💻", "lunch": "🍔", 
+    "purchases": "🛒", "groceries": "🛍️", "entertainment": "🎬", 
+    "health": "💊", "food": "🍕", "coffee": "☕", "shopping": "🛍️",
+    "clothing": "👕", "utilities": "⚡", "rent": "🏠"
+})
+
+# Row field extractors for the response formatters
+_TOP_EXPENSE_FIELDS = itemgetter("amount", "category")
+_BREAKDOWN_FIELDS = itemgetter("category", "total_amount", "transaction_count")
+
+class ExpenseTools:
+    """Enhanced tools for expense processing and analysis"""
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def generate_advanced_sql(self, query_type: str, **kwargs) -> str:
+        """Generate advanced SQL queries for complex analysis; run them with execute_sql_query,
+        binding user_id (and the template's other parameters, e.g. limit or days)"""
+        template = _SQL_TEMPLATES.get(query_type)
+        if template is None:
+            return _DEFAULT_SQL
+        return template.format(time_filter=self._get_time_filter(kwargs.get("time_period", "all")))
     
     def _get_time_filter(self, time_period: str) -> str:
         """Generate time filter for SQL queries"""
-        if time_period == "today":
-            return "AND DATE(timestamp) = CURRENT_DATE"
-        elif time_period == "week":
-            return "AND timestamp >= NOW() - INTERVAL '7 days'"
-        elif time_period == "month":
-            return "AND timestamp >= NOW() - INTERVAL '1 month'"
-        elif time_period == "year":
-            return "AND timestamp >= NOW() - INTERVAL '1 year'"
-        else:
-            return ""
+        return _TIME_FILTERS.get(time_period, "")
     
-    def execute_sql_query(self, sql: str) -> List[Dict[str, Any]]:
-        """Execute SQL query and return results"""
+    def execute_sql_query(self, sql: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Execute SQL query with bound parameters and return results"""
         try:
-            result = self.db.execute(text(sql))
+            result = self.db.execute(text(sql), params or {})
             rows = result.fetchall()
             
             # Get column names from result
@@ -131,36 +133,39 @@ class ExpenseTools:
             
             return results
         except Exception as e:
-            logger.error(f"SQL execution error: {e}")
+            logger.error("SQL execution error: %s", e)
             return []
     
     def get_max_expense(self, user_id: int, time_period: str = "all") -> Optional[Dict[str, Any]]:
         """Get the maximum expense for a user"""
-        sql = self.generate_advanced_sql("max_expense", user_id, time_period=time_period)
-        results = self.execute_sql_query(sql)
+        sql = self.generate_advanced_sql("max_expense", time_period=time_period)
+        results = self.execute_sql_query(sql, {"user_id": user_id})
         return results[0] if results else None
     
     def get_top_expenses(self, user_id: int, limit: int = 5, time_period: str = "all") -> List[Dict[str, Any]]:
         """Get top expenses for a user"""
-        sql = self.generate_advanced_sql("top_expenses", user_id, limit=limit, time_period=time_period)
-        return self.execute_sql_query(sql)
+        sql = self.generate_advanced_sql("top_expenses", time_period=time_period)
+        return self.execute_sql_query(sql, {"user_id": user_id, "limit": limit})
     
     def get_category_breakdown(self, user_id: int, time_period: str = "all") -> List[Dict[str, Any]]:
         """Get category breakdown for a user"""
-        sql = self.generate_advanced_sql("category_breakdown", user_id, time_period=time_period)
-        return self.execute_sql_query(sql)
+        sql = self.generate_advanced_sql("category_breakdown", time_period=time_period)
+        return self.execute_sql_query(sql, {"user_id": user_id})
     
     def get_daily_average(self, user_id: int, time_period: str = "all") -> float:
         """Get daily average spending"""
-        sql = self.generate_advanced_sql("daily_average", user_id, time_period=time_period)
-        results = self.execute_sql_query(sql)
+        sql = self.generate_advanced_sql("average_daily_total", time_period=time_period)
+        results = self.execute_sql_query(sql, {"user_id": user_id})
         
-        if not results:
+        if not results or results[0]["daily_average"] is None:
             return 0.0
         
-        total_amount = sum(row["daily_total"] for row in results)
-        days = len(results)
-        return total_amount / days if days > 0 else 0.0
+        return float(results[0]["daily_average"])
+    
+    def get_spending_trend(self, user_id: int, days: int = 7) -> List[Dict[str, Any]]:
+        """Get daily spending totals for the last `days` days, oldest first"""
+        sql = self.generate_advanced_sql("spending_trend")
+        return self.execute_sql_query(sql, {"user_id": user_id, "days": days})
     
     def format_expense_response(self, data: List[Dict[str, Any]], query_type: str) -> str:
         """Format expense data into natural language response"""
@@ -174,18 +179,20 @@ class ExpenseTools:
         
         elif query_type == "top_expenses":
             response = "Here are your top expenses:\n"
-            for i, expense in enumerate(data, 1):
-                response += f"{i}. {expense['amount']:,.0f} PKR - {expense['category']}\n"
+            for i, (amount, category) in enumerate(map(_TOP_EXPENSE_FIELDS, data), 1):
+                response += f"{i}. {amount:,.0f} PKR - {category}\n"
             return response
         
         elif query_type == "category_breakdown":
             response = "📊 Your spending breakdown:\n\n"
-            total = sum(row["total_amount"] for row in data)
+            rows = list(map(_BREAKDOWN_FIELDS, data))
+            total = sum(row[1] for row in rows)
             response += f"Total: {total:,.0f} PKR\n\n"
             
-            for row in data:
-                emoji = self._get_category_emoji(row["category"])
-                response += f"{emoji} {row['category'].title()}: {row['total_amount']:,.0f} PKR ({row['transaction_count']} transactions)\n"
+            get_emoji = _CATEGORY_EMOJIS.get
+            for category, total_amount, transaction_count in rows:
+                emoji = get_emoji(category.lower(), "💰")
+                response += f"{emoji} {category.title()}: {total_amount:,.0f} PKR ({transaction_count} transactions)\n"
             return response
         
         else:
@@ -193,45 +200,43 @@ class ExpenseTools:
     
     def _get_category_emoji(self, category: str) -> str:
         """Get emoji for category"""
-        emoji_map = {
-            "transport": "🚗", "electronics": "💻", "lunch": "🍔", 
-            "purchases": "🛒", "groceries": "🛍️", "entertainment": "🎬", 
-            "health": "💊", "food": "🍕", "coffee": "☕", "shopping": "🛍️",
-            "clothing": "👕", "utilities": "⚡", "rent": "🏠"
-        }
-        return emoji_map.get(category.lower(), "💰")
+        return _CATEGORY_EMOJIS.get(category.lower(), "💰")
     
     def process_expense_logging(self, user_id: int, expenses_data: List[Dict[str, Any]]) -> Tuple[List[str], List[str]]:
-        """Process expense logging with enhanced validation"""
+        """Process expense logging with enhanced validation.
+        All valid expenses are written in one transaction with a single category lookup."""
         confirmations = []
         errors = []
+        valid_expenses = []
         
         for expense in expenses_data:
-            try:
-                amount = expense.get("amount")
-                category = expense.get("category")
-                note = expense.get("note", "")
-                
-                if not amount or not category:
-                    errors.append(f"Missing amount or category for expense")
-                    continue
-                
-                # Create or get category
-                db_category = crud.get_or_create_category(self.db, user_id, category)
-                
-                # Create expense
-                db_expense = crud.create_expense(
-                    self.db,
-                    user_id=user_id,
-                    category_id=getattr(db_category, "id"),
-                    amount=amount,
-                    note=note
-                )
-                
-                confirmations.append(f"{db_expense.amount:,.0f} PKR for {db_category.name}")
-                
-            except Exception as e:
-                logger.error(f"Error processing expense: {e}")
-                errors.append(f"Failed to process expense: {str(e)}")
+            if not expense.get("amount") or not expense.get("category"):
+                errors.append(f"Missing amount or category for expense")
+                continue
+            valid_expenses.append(expense)
+        
+        if not valid_expenses:
+            return confirmations, errors
+        
+        try:
+            categories = crud.get_or_create_categories(
+                self.db, user_id, {expense["category"] for expense in valid_expenses}
+            )
+            rows = []
+            for expense in valid_expenses:
+                db_category = categories[expense["category"].lower()]
+                amount = float(expense["amount"])
+                rows.append({
+                    "category_id": db_category.id,
+                    "amount": amount,
+                    "note": expense.get("note", "")
+                })
+                confirmations.append(f"{amount:,.0f} PKR for {db_category.name}")
+            crud.create_expenses(self.db, user_id, rows)
+        except Exception as e:
+            self.db.rollback()
+            logger.error("Error processing expenses: %s", e)
+            confirmations = []
+            errors.append(f"Failed to process expenses: {str(e)}")
         
-        return confirmations, errors 
\ No newline at end of file
+        return confirmations, errors
\ No newline at end of file
@@ -1,24 +1,74 @@
 # agent_v3.py
 
-from app.intelligent_agent_v3.langgraph_agent import run_expense_agent
+from app.intelligent_agent_v3.langgraph_agent import arun_expense_agent, get_agent, run_expense_agent
+from app.intelligent_agent_v3.state import REPLY_SINK
 from sqlalchemy.orm import Session
+import logging
+
+logger = logging.getLogger("expensebot.intelligent_agent_v3.agent_v3")
 
 def process_message_with_agent_v3(phone_number: str, message: str, db: Session) -> dict:
     """
     Main entry point for FastAPI webhook to use the LangGraph ReAct Agent.
     """
     try:
-        result = run_expense_agent(phone_number, message, db)
+        return _to_reply(run_expense_agent(phone_number, message, db))
+    except Exception as e:
+        logger.exception("Agent V3 error: %s", e)
+        return _ERROR_REPLY.copy()
 
-        final_response = result.get("final_response") or result.get("sql_result") or "Sorry, I couldn't process that."
-        return {
-            "message": final_response,
-            "intent": result.get("intent", "unknown"),
-        }
 
+async def aprocess_message_with_agent_v3(phone_number: str, message: str, db: Session, on_reply_chunk=None) -> dict:
+    """
+    Async entry point; use from async handlers so LLM round trips don't hold a worker thread.
+    With on_reply_chunk, prose replies are streamed to it sentence by sentence; the
+    result's "streamed" flag then says the message has already been delivered.
+    """
+    token = REPLY_SINK.set(on_reply_chunk)
+    try:
+        return _to_reply(await arun_expense_agent(phone_number, message, db))
     except Exception as e:
-        print(f"[Agent V3] Error: {e}")
-        return {
-            "message": "An unexpected error occurred while processing your message.",
-            "intent": "error"
-        }
\ No newline at end of file
+        logger.exception("Agent V3 error: %s", e)
+        return _ERROR_REPLY.copy()
+    finally:
+        REPLY_SINK.reset(token)
+
+
+def process_messages_batch(phone_number: str, messages: list, db: Session) -> list:
+    """
+    Run several messages from one user as consecutive turns on one session.
+    This is only a loop over process_message_with_agent_v3: each turn is its own
+    agent run with its own LLM calls and commits. Turns stay in order, since each
+    one may answer the previous turn's follow-up question; a failing turn gets the
+    error reply and the rest still run.
+    """
+    replies = []
+    for message in messages:
+        replies.append(process_message_with_agent_v3(phone_number, message, db))
+        # Start the next turn from a clean slate, as a fresh per-request session would:
+        # objects the turn loaded are reloaded on next use rather than reused stale
+        db.expire_all()
+    return replies
+
+
+def warmup() -> None:
+    """
+    Compile the agent graph ahead of the first message, so the first real turn
+    doesn't pay for graph construction.
+    """
+    get_agent()
+
+
+_ERROR_REPLY = {
+    "message": "An unexpected error occurred while processing your message.",
+    "intent": "error"
+}
+
+
+def _to_reply(result: dict) -> dict:
+    final_response = result.get("final_response") or result.get("sql_result") or "Sorry, I couldn't process that."
+    return {
+        "message": final_response,
+        "intent": result.get("intent", "unknown"),
+        "streamed": bool(result.get("reply_streamed")),
+    }
@@ -11,6 +11,13 @@ class AgentConfigV2:
     llm_model: str = "llama-3.3-70b-versatile"  # Reverted to previous model
     temperature: float = 0 # Lower temperature for more consistent responses
     max_tokens: int = 1000
+    # Output caps per call type; classification needs a few tokens, generators keep max_tokens
+    max_tokens_intent: int = 32
+    max_tokens_extract: int = 256
+    max_tokens_sql: int = 384
+    # The combined call may return an extraction and a SQL statement in one object
+    max_tokens_combined: int = max_tokens_extract + max_tokens_sql
+    max_tokens_response: int = max_tokens
     groq_api_key: str = os.getenv("GROQ_API_KEY", "")
     
     # Agent Behavior
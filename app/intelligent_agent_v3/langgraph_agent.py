@@ -1,102 +1,160 @@
 # langgraph_agent.py
 
-from typing import TypedDict, Optional, List, Any, Dict
-from langgraph.graph import END, StateGraph
-from .tools import (
-    IntentTool,
-    ExtractExpenseTool,
-    CreateExpenseTool,
-    GenerateSQLTool,
-    ExecuteSQLTool,
-    FormatBreakdownTool,
-    ChitchatTool,
-    RespondTool,
-    FormatQueryResponseTool,
-    get_conversation_context,
-)
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from langgraph.graph import END, START, StateGraph
+from .state import AgentState, DB_SESSION
 
 
-# 1. Define LangGraph Agent State
-class AgentState(TypedDict):
-    phone_number: str
-    message: str
-    intent: Optional[str]
-    db_user: Optional[dict]
-    expenses: Optional[List[dict]]
-    query: Optional[str]
-    sql: Optional[str]
-    sql_result: Optional[str]
-    final_response: Optional[str]
-    db: Optional[Any]
-    pending_context: Optional[Dict[str, Any]]
+# 1. Define Router
+_ROUTE = {
+    "log_expense": "create_expense",
+    "query": "query_sql",
+    "breakdown": "generate_breakdown",
+    "chitchat": "chitchat",
+}
 
 
-# 2. Define Router
 def router(state: AgentState):
-    intent = state.get("intent")
-    if intent == "log_expense":
-        return "extract_expense"
-    elif intent == "query":
-        return "generate_sql"
-    elif intent == "breakdown":
-        return "generate_breakdown"
-    elif intent == "chitchat":
-        return "chitchat"
-    else:
-        return "fallback"
-
-
-# 3. Build LangGraph
-builder = StateGraph(AgentState)
-
-# Add nodes
-builder.add_node("detect_intent", IntentTool())
-builder.add_node("extract_expense", ExtractExpenseTool())
-builder.add_node("create_expense", CreateExpenseTool())
-builder.add_node("generate_sql", GenerateSQLTool())
-builder.add_node("execute_sql", ExecuteSQLTool())
-builder.add_node("generate_breakdown", FormatBreakdownTool())
-builder.add_node("chitchat", ChitchatTool())
-builder.add_node("fallback", RespondTool())
-builder.add_node("respond", RespondTool())
-builder.add_node("format_query_response", FormatQueryResponseTool())
-
-# Set edges
-builder.set_entry_point("detect_intent")
-builder.add_conditional_edges("detect_intent", router)
-builder.add_edge("extract_expense", "create_expense")
-builder.add_edge("create_expense", "respond")
-builder.add_edge("generate_sql", "execute_sql")
-builder.add_edge("execute_sql", "format_query_response")
-builder.add_edge("generate_breakdown", "respond")
-builder.add_edge("chitchat", "respond")
-builder.add_edge("fallback", "respond")
-builder.add_edge("format_query_response", "respond")
-builder.add_edge("respond", END)
-
-# Compile
-expense_agent_graph = builder.compile()
+    return _ROUTE.get(state.intent, "fallback")
+
+
+# 2. Build LangGraph
+# Compiled lazily and exactly once per process, not as an import side effect.
+@lru_cache(maxsize=1)
+def build_agent_graph():
+    # Tools (and their LLM clients) load on first use rather than at import time
+    from .tools import (
+        COMBINED_INTENT_EXTRACT_TOOL,
+        CREATE_EXPENSE_TOOL,
+        QUERY_SQL_TOOL,
+        FORMAT_BREAKDOWN_TOOL,
+        CHITCHAT_TOOL,
+        RESPOND_TOOL,
+        FORMAT_QUERY_TOOL,
+    )
+
+    builder = StateGraph(AgentState)
+
+    # Add nodes
+    builder.add_node("understand_message", COMBINED_INTENT_EXTRACT_TOOL)
+    builder.add_node("create_expense", CREATE_EXPENSE_TOOL)
+    builder.add_node("query_sql", QUERY_SQL_TOOL)
+    builder.add_node("generate_breakdown", FORMAT_BREAKDOWN_TOOL)
+    builder.add_node("chitchat", CHITCHAT_TOOL)
+    builder.add_node("fallback", RESPOND_TOOL)
+    builder.add_node("format_query_response", FORMAT_QUERY_TOOL)
+
+    # Set edges
+    # One LLM call classifies the intent and, for log_expense, extracts the expenses too
+    builder.add_edge(START, "understand_message")
+    builder.add_conditional_edges("understand_message", router)
+    builder.add_edge("query_sql", "format_query_response")
+    # Producers are terminal; process_message_with_agent_v3 already falls back to sql_result
+    for terminal in ("create_expense", "generate_breakdown", "chitchat", "fallback", "format_query_response"):
+        builder.add_edge(terminal, END)
+
+    return builder.compile()
+
+
+def get_agent():
+    return build_agent_graph()
+
+
+# 3. Canned replies for trivial messages, resolved before any LLM call
+_TRIVIAL_REPLIES = (
+    (re.compile(r"^\s*$"), "fallback",
+     "I didn't catch that. Tell me about an expense, e.g. 'lunch 500', or ask for your spending breakdown."),
+    (re.compile(r"^\s*(hi|hello|hey|salam|assalam o alaikum)\W*$", re.IGNORECASE), "chitchat",
+     "Hello! 👋 Tell me what you spent, e.g. 'lunch 500', or ask 'show my spending breakdown'."),
+    (re.compile(r"^\s*(thanks|thank you|thx|ok|okay|cool|great)\W*$", re.IGNORECASE), "chitchat",
+     "You're welcome! Let me know whenever you have an expense to log. 😊"),
+)
+
+
+def match_trivial_message(message: str):
+    """Return (intent, reply) for greetings/acknowledgements that need no LLM, else None"""
+    for pattern, intent, reply in _TRIVIAL_REPLIES:
+        if pattern.match(message):
+            return intent, reply
+    return None
 
 
 # 4. Entry point with corrected config
-def run_expense_agent(phone_number: str, message: str, db):
+def _initial_state(phone_number: str, message: str, db) -> AgentState:
+    from .tools import get_conversation_context
+
     # Load existing conversation context
-    existing_context = get_conversation_context(db, phone_number)
-    
-    state = {
-        "phone_number": phone_number,
-        "message": message,
-        "intent": None,
-        "db_user": None,
-        "expenses": None,
-        "query": None,
-        "sql": None,
-        "sql_result": None,
-        "final_response": None,
-        "db": db,
-        "pending_context": existing_context,  # ✅ Load previous context!
-    }
-    
-    print(f"[DEBUG] Running agent with existing context: {existing_context}")
-    result = expense_agent_graph.invoke(state)
-    return result
+    return AgentState(
+        phone_number=phone_number,
+        message=message,
+        pending_context=get_conversation_context(db, phone_number),  # ✅ Load previous context!
+    )
+
+
+def _trivial_result(phone_number: str, message: str):
+    trivial = match_trivial_message(message or "")
+    if not trivial:
+        return None
+    intent, reply = trivial
+    return {"phone_number": phone_number, "message": message, "intent": intent, "final_response": reply}
+
+
+def run_expense_agent(phone_number: str, message: str, db):
+    trivial = _trivial_result(phone_number, message)
+    if trivial:
+        return trivial
+    token = DB_SESSION.set(db)
+    try:
+        return get_agent().invoke(_initial_state(phone_number, message, db))
+    finally:
+        DB_SESSION.reset(token)
+
+
+async def arun_expense_agent(phone_number: str, message: str, db):
+    """Async variant: LLM-backed nodes await the AsyncGroq client instead of blocking a thread"""
+    trivial = _trivial_result(phone_number, message)
+    if trivial:
+        return trivial
+    token = DB_SESSION.set(db)
+    try:
+        return await get_agent().ainvoke(_initial_state(phone_number, message, db))
+    finally:
+        DB_SESSION.reset(token)
+
+
+async def run_expense_agent_stream(phone_number: str, message: str, db):
+    """Yield {node_name: update} as each node finishes, so the webhook can send a typing
+    indicator or an early reply instead of waiting for the whole graph."""
+    trivial = _trivial_result(phone_number, message)
+    if trivial:
+        yield {"canned_reply": trivial}
+        return
+    token = DB_SESSION.set(db)
+    try:
+        async for update in get_agent().astream(_initial_state(phone_number, message, db), stream_mode="updates"):
+            yield update
+    finally:
+        DB_SESSION.reset(token)
+
+
+def run_expense_agent_batch(items, max_concurrency: int = 16):
+    """Run several (phone_number, message, db) turns concurrently on one compiled graph.
+    Each turn binds its own DB session, so each item needs its own session."""
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        return list(pool.map(lambda item: run_expense_agent(*item), items))
+
+
+async def arun_expense_agent_batch(items):
+    """Async counterpart of run_expense_agent_batch; each turn is its own task, so its
+    DB session binding stays separate while the Groq calls overlap."""
+    return await asyncio.gather(*(arun_expense_agent(*item) for item in items))
+
+
+def __getattr__(name):
+    # Backwards-compatible module attribute, compiled on first access
+    if name == "expense_agent_graph":
+        return get_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
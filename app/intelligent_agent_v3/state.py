@@ -0,0 +1,35 @@
+# state.py
+
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional, List, Any, Awaitable, Callable, Dict
+
+
+# Shared LangGraph state. Nodes read attributes and return partial dicts of the
+# fields they change; LangGraph merges those back into the state.
+@dataclass(slots=True)
+class AgentState:
+    phone_number: str
+    message: str
+    intent: Optional[str] = None
+    expenses: Optional[List[dict]] = None
+    sql: Optional[str] = None
+    sql_result: Optional[Any] = None
+    final_response: Optional[str] = None
+    pending_context: Optional[Dict[str, Any]] = None
+    # True once final_response has already gone out through REPLY_SINK
+    reply_streamed: bool = False
+
+
+# The request's SQLAlchemy session is bound per invocation instead of travelling in
+# the state, so state merges never copy a live session around.
+DB_SESSION: ContextVar[Any] = ContextVar("db_session", default=None)
+
+
+def current_db():
+    return DB_SESSION.get()
+
+
+# Optional async callback for prose replies; when set, the reply nodes stream and
+# hand it sentence-sized chunks as they arrive instead of one final string.
+REPLY_SINK: ContextVar[Optional[Callable[[str], Awaitable[None]]]] = ContextVar("reply_sink", default=None)
@@ -3,224 +3,615 @@
 #from langchain_core.tools import tool
 from langchain_core.runnables import Runnable
 from typing import Dict, Any
-from groq import Groq
-import json, re
+from groq import AsyncGroq, Groq
+import anyio
+import httpx
+import asyncio, json, re, uuid, weakref
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import lru_cache
+import logging
+import sqlglot
+from sqlglot import exp
 from dotenv import load_dotenv
+from sqlalchemy import text as sql_text
 from app import crud, models
+from app.cache import TTLCache, bag_of_words_key, normalize_message
+from app.expense_rules import CATEGORY_KEYWORDS, FILTER_RE as _FILTER_RE, QUESTION_RE as _QUESTION_RE, extract_simple_expense
+from app.llm_json import parse_llm_json
 from app.intelligent_agent_v3.config import config
-from datetime import datetime, timedelta
+from app.intelligent_agent_v3.state import REPLY_SINK, AgentState, current_db
 
 load_dotenv()
 
-# Set up Groq client
-llm_client = Groq(api_key=config.groq_api_key)
-
-
-def clean_json_response(raw_response: str) -> str:
-    """Clean LLM response to extract valid JSON"""
-    if not raw_response:
-        return "{}"
-    
-    # Remove markdown code blocks
-    raw_response = re.sub(r'```(?:json)?\s*', '', raw_response)
-    raw_response = re.sub(r'```\s*', '', raw_response)
-    
-    # Convert single quotes to double quotes
-    raw_response = raw_response.replace("'", '"')
-    
-    # Try to find JSON object
-    json_match = re.search(r'\{.*\}', raw_response, re.DOTALL)
-    if json_match:
-        return json_match.group(0)
-    
-    return raw_response
+logger = logging.getLogger("expensebot.intelligent_agent_v3.tools")
+
+# Pooled HTTP clients for Groq so bursts reuse warm keep-alive connections.
+# HTTP/2 needs the optional h2 package; without it httpx stays on HTTP/1.1.
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+_http_client = httpx.Client(http2=_HTTP2, timeout=10.0, limits=_HTTP_LIMITS)
+try:
+    # aiohttp transport for the async client, available with groq[aiohttp]
+    from groq import DefaultAioHttpClient
+    _async_http_client = DefaultAioHttpClient(timeout=10.0)
+except (ImportError, RuntimeError):  # older groq, or aiohttp not installed
+    _async_http_client = httpx.AsyncClient(http2=_HTTP2, timeout=10.0, limits=_HTTP_LIMITS)
+
+# Set up Groq clients; the async one lets concurrent webhook turns share one event loop
+llm_client = Groq(api_key=config.groq_api_key, http_client=_http_client)
+async_llm_client = AsyncGroq(api_key=config.groq_api_key, http_client=_async_http_client)
+
+
+async def close_llm_clients() -> None:
+    """Close the pooled Groq connections; called on app shutdown"""
+    _http_client.close()
+    await _async_http_client.aclose()
+
+# Response caches for the LLM-backed nodes, keyed by llm_cache_key (INTENT_CACHE by intent_cache_key).
+# TTLs follow how quickly each answer goes stale.
+INTENT_CACHE = TTLCache(maxsize=2048, ttl=24 * 60 * 60)
+CHITCHAT_CACHE = TTLCache(maxsize=1024, ttl=24 * 60 * 60)
+# SQL depends only on the question, schema and model (dates are relative to NOW() and the
+# user is bound as :user_id), so it is shared across users and kept for a day
+SQL_CACHE = TTLCache(maxsize=4096, ttl=24 * 60 * 60)
+BREAKDOWN_CACHE = TTLCache(maxsize=1024, ttl=60)
+# Generated confirmation/clarification wording; only the text is cached, never the DB writes
+REPLY_CACHE = TTLCache(maxsize=2048, ttl=15 * 60)
+
+
+def llm_cache_key(message: str) -> tuple:
+    """Cache key for an LLM answer to message; switching models never serves stale entries"""
+    return (config.llm_model, normalize_message(message))
+
+
+def intent_cache_key(message: str) -> tuple:
+    """INTENT_CACHE key: an intent is a label, so reordered or padded phrasings share it"""
+    return (config.llm_model, bag_of_words_key(message))
 
 
 # Add context management functions
+# Pending (incomplete) expense per phone number, dropped after 5 minutes of silence
+CONTEXT_CACHE = TTLCache(maxsize=10_000, ttl=5 * 60)
+
+
 def get_conversation_context(db, phone_number: str):
     """Retrieve stored conversation context"""
-    try:
-        user = crud.get_user_by_phone_number(db, phone_number)
-        if not user:
-            return {}
-        
-        # For now, let's use a simple approach - store in a new table or 
-        # use a cache. For immediate fix, let's add a context field to User model
-        # But first, let's implement a simpler solution using a global cache
-        
-        # Check if context exists and is recent (within 5 minutes)
-        cache_key = f"context_{phone_number}"
-        if hasattr(get_conversation_context, '_cache'):
-            cached = get_conversation_context._cache.get(cache_key)
-            if cached and cached.get('timestamp'):
-                if datetime.now() - cached['timestamp'] < timedelta(minutes=5):
-                    return cached.get('context', {})
-        
-        return {}
-    except:
-        return {}
+    return CONTEXT_CACHE.get(phone_number) or {}
 
 def store_conversation_context(db, phone_number: str, context: dict):
     """Store conversation context - only keep the most recent incomplete expense"""
+    # If context is empty or None, clear the cache
+    if not context:
+        CONTEXT_CACHE.pop(phone_number)
+        return
+
+    # Only store single context dict, not lists; if a list is passed, take the most recent
+    if isinstance(context, list):
+        context = context[-1]
+    if isinstance(context, dict):
+        CONTEXT_CACHE.set(phone_number, context)
+    else:
+        logger.error("Failed to store context: unexpected type %s", type(context).__name__)
+
+
+def get_or_create_user_id(db, phone_number: str):
+    """Id of the user for phone_number, creating the user if needed; None without a DB session"""
+    if not db:
+        return None
+    user_id = crud.get_user_id_by_phone_number(db, phone_number)
+    if user_id is None:
+        user_id = crud.create_user(db, user=models.User(phone_number=phone_number)).id
+    return user_id
+
+
+# System prompts are kept byte-for-byte static so the provider can reuse the cached
+# prefix across requests; anything per-user goes in the user message instead.
+_INTENT_GUIDELINES = (
+    "Classify the user's intent as one of: "
+    "'log_expense', 'query', 'breakdown', 'chitchat'. "
+    "\n\nGuidelines:"
+    "\n- 'query': Specific questions like 'top 5 expenses', 'most expensive', 'cheapest', 'how much did I spend on X', 'compare months', 'breakdown for past week/month', 'expenses in January', etc."
+    "\n- 'breakdown': General requests like 'spending breakdown', 'category summary', 'overall breakdown' (without time periods)"
+    "\n- 'log_expense': Adding/recording new expenses"
+    "\n- 'chitchat': General conversation, greetings, non-expense related"
+)
+
+_EXTRACTION_RULES = (
+    "IMPORTANT RULES:\n"
+    "1. Extract ALL complete expenses (both amount and item mentioned)\n"
+    "2. Handle multiple expenses in one message: 'soccer ball: 8k, shoes: 11k, socks: 800'\n"
+    "3. Handle various formats: '8000', '8k', '8K', '8,000'\n"
+    "4. Smart categorization: food/groceries, transportation/transport, entertainment, shopping/clothing, health, electronics, sports, rent/housing, other\n"
+    "5. Extract meaningful notes from item descriptions\n"
+    "6. If message has amount AND item, it's COMPLETE - extract it\n"
+    "7. If missing amount OR item, mark as incomplete\n\n"
+)
+
+_EXTRACTION_EXAMPLES = (
+    "Examples:\n"
+    "- 'soccer ball 8k' → complete\n"
+    "- 'I spent 500 PKR' → incomplete (missing item)\n"
+    "- 'bought shoes' → incomplete (missing amount)\n"
+    "- 'phone 25k, lunch 300' → both complete"
+)
+
+INTENT_SYSTEM_PROMPT = (
+    "You are a WhatsApp expense bot. " + _INTENT_GUIDELINES +
+    "\nReturn ONLY a valid JSON object with double quotes. "
+    "Example: {\"intent\": \"query\"}"
+)
+
+EXTRACTION_SYSTEM_PROMPT = (
+    "You are an intelligent expense extraction system. Extract expenses from user messages.\n\n"
+    + _EXTRACTION_RULES +
+    "Return JSON format:\n"
+    "{\n"
+    '  "complete_expenses": [{"amount": 8000, "category": "sports", "note": "soccer ball"}],\n'
+    '  "incomplete_expense": {"type": "missing_amount", "item": "shoes"} OR {"type": "missing_item", "amount": 5000} OR null\n'
+    "}\n\n"
+    + _EXTRACTION_EXAMPLES
+)
+
+_SQL_RULES = (
+    "User data is stored in tables: users(id), categories(id, name, user_id), expenses(id, user_id, category_id, amount, timestamp, note).\n"
+    "Only generate SELECT statements to answer the user's question.\n"
+    "Always filter with e.user_id = :user_id exactly as written; it is a bound parameter, never inline a number.\n"
+    "Every table you use needs its own filter, joined to the rest of the condition with AND: "
+    "expenses e.user_id = :user_id, categories c.user_id = :user_id, users u.id = :user_id. Never use UNION.\n"
+)
+
+SQL_SYSTEM_PROMPT = (
+    "You are a PostgreSQL expert helping generate SQL for an expense tracker.\n"
+    + _SQL_RULES +
+    'Return ONLY a JSON object of the form {"sql": "SELECT ..."}.'
+)
+
+# Intent, extraction and query SQL in one call, so log_expense and query turns
+# each cost a single round trip
+COMBINED_SYSTEM_PROMPT = (
+    "You are a WhatsApp expense bot. " + _INTENT_GUIDELINES +
+    "\n\nWhen the intent is 'log_expense', also extract the expenses.\n"
+    + _EXTRACTION_RULES +
+    "When the intent is 'query', also write a PostgreSQL query that answers it.\n"
+    + _SQL_RULES +
+    "\nReturn ONLY a valid JSON object with double quotes:\n"
+    "{\n"
+    '  "intent": "log_expense",\n'
+    '  "complete_expenses": [{"amount": 8000, "category": "sports", "note": "soccer ball"}],\n'
+    '  "incomplete_expense": {"type": "missing_amount", "item": "shoes"} OR {"type": "missing_item", "amount": 5000} OR null\n'
+    "}\n"
+    'For a query return e.g. {"intent": "query", "sql": "SELECT SUM(e.amount) FROM expenses e WHERE e.user_id = :user_id"}\n'
+    'For any other intent return e.g. {"intent": "chitchat", "complete_expenses": [], "incomplete_expense": null}\n\n'
+    + _EXTRACTION_EXAMPLES
+)
+
+# System messages shared by every call; the bytes stay identical so the provider's
+# prompt-prefix cache can hit. Never mutate these.
+_INTENT_SYS = {"role": "system", "content": INTENT_SYSTEM_PROMPT}
+_EXTRACT_SYS = {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT}
+_COMBINED_SYS = {"role": "system", "content": COMBINED_SYSTEM_PROMPT}
+_SQL_SYS = {"role": "system", "content": SQL_SYSTEM_PROMPT}
+_SUCCESS_SYS = {"role": "system", "content": "You are a helpful financial assistant. Generate brief, natural confirmation messages for logged expenses. Be encouraging and conversational."}
+_CLARIFY_SYS = {"role": "system", "content": "You are a helpful financial assistant. Generate natural, conversational questions to clarify incomplete expense information. Be friendly and specific."}
+_NO_EXPENSE_SYS = {"role": "system", "content": "You are a helpful financial assistant. When users mention expenses but don't provide enough detail, guide them naturally. Be encouraging and give examples."}
+_CHITCHAT_SYS = {"role": "system", "content": (
+    "You are a friendly financial assistant for expense tracking. "
+    "Reply casually but helpfully to any general messages. "
+    "Focus on expense tracking capabilities and be encouraging about financial management."
+)}
+_FORMAT_QUERY_SYS = {"role": "system", "content": "You are a helpful financial assistant that provides clear, friendly, conversational responses. Never use technical terms like 'data', 'query', 'criteria', 'records'. Talk like a friendly helper."}
+
+
+def log_cached_tokens(tool_name: str, response) -> None:
+    """Print how many prompt tokens the provider served from its prefix cache, when reported"""
+    details = getattr(getattr(response, "usage", None), "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None)
+    if cached is not None:
+        logger.debug("%s cached prompt tokens: %s", tool_name, cached)
+
+# Cheap rule-based intent classifier tried before the intent LLM. It only answers when the
+# message is unambiguous; anything else returns None and goes to the LLM as before.
+_BREAKDOWN_RE = re.compile(r"\b(breakdown|summary)\b", re.IGNORECASE)
+_PERIOD_RE = re.compile(
+    r"\b(today|yesterday|days?|weeks?|months?|years?|daily|weekly|monthly|yearly|last\s+\d+|"
+    r"january|february|march|april|may|june|july|august|september|october|november|december)\b",
+    re.IGNORECASE,
+)
+_AMOUNT_RE = re.compile(r"\d[\d,]*(\.\d+)?\s*(k|pkr|rs)?\b", re.IGNORECASE)
+# Whole-message greetings only; "hey what did I spend" must still reach the LLM
+_GREETING_RE = re.compile(
+    r"^\s*(hi|hello|hey|yo|salam|thanks|thank you|thanks a lot|bye)(\s+(there|bot|buddy))?[\s!.,]*$",
+    re.IGNORECASE,
+)
+
+# How often the local classifier answered vs. deferred to the LLM
+LOCAL_INTENT_STATS = Counter()
+
+
+def classify_intent_locally(message: str):
+    intent = _classify_intent_locally(message)
+    LOCAL_INTENT_STATS["hit" if intent else "miss"] += 1
+    return intent
+
+
+def _classify_intent_locally(message: str):
+    if _BREAKDOWN_RE.search(message):
+        # A breakdown scoped to a period is answered by the SQL path
+        return "query" if _PERIOD_RE.search(message) else "breakdown"
+    if _AMOUNT_RE.search(message) and not (_QUESTION_RE.search(message) or _FILTER_RE.search(message)):
+        return "log_expense"
+    if _GREETING_RE.match(message):
+        return "chitchat"
+    if match_query_template(message):
+        return "query"
+    return None
+
+
+# JSON mode: the model can only emit a JSON object, so no fences or prose to strip.
+# Not used with streaming, which Groq does not support in JSON mode.
+_JSON_FORMAT = {"response_format": {"type": "json_object"}}
+
+
+def chat_completion(messages, max_tokens: int = None, json_mode: bool = False):
+    return llm_client.chat.completions.create(
+        model=config.llm_model,
+        temperature=config.temperature,
+        max_tokens=max_tokens or config.max_tokens_response,
+        messages=messages,
+        **(_JSON_FORMAT if json_mode else {}),
+    )
+
+
+# asyncio primitives belong to the loop that first uses them, so anything shared across
+# turns is created lazily per running loop instead of at import
+_LOOP_STATE: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, Any]]" = weakref.WeakKeyDictionary()
+
+
+def _loop_local(name: str, factory):
+    state = _LOOP_STATE.setdefault(asyncio.get_running_loop(), {})
+    if name not in state:
+        state[name] = factory()
+    return state[name]
+
+
+def _async_llm_limit() -> asyncio.Semaphore:
+    """Caps in-flight async Groq requests per loop so bursts stay under the rate limit"""
+    return _loop_local("llm_limit", lambda: asyncio.Semaphore(8))
+
+
+async def achat_completion(messages, max_tokens: int = None, json_mode: bool = False):
+    # Identical requests already in flight, so concurrent duplicates share one Groq call
+    in_flight: Dict[tuple, asyncio.Task] = _loop_local("in_flight", dict)
+    key = (max_tokens, json_mode, tuple((m["role"], m["content"]) for m in messages))
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_achat_completion(messages, max_tokens, json_mode))
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    # shield: one caller giving up must not cancel the request for the others
+    return await asyncio.shield(task)
+
+
+async def _achat_completion(messages, max_tokens: int = None, json_mode: bool = False):
+    async with _async_llm_limit():
+        return await async_llm_client.chat.completions.create(
+            model=config.llm_model,
+            temperature=config.temperature,
+            max_tokens=max_tokens or config.max_tokens_response,
+            messages=messages,
+            **(_JSON_FORMAT if json_mode else {}),
+        )
+
+
+def stream_completion(messages, stop_when=None, max_tokens: int = None) -> str:
+    """Stream a completion and return its text, closing the stream early once
+    stop_when(text_so_far) is true"""
+    stream = llm_client.chat.completions.create(
+        model=config.llm_model,
+        temperature=config.temperature,
+        max_tokens=max_tokens or config.max_tokens_response,
+        messages=messages,
+        stream=True,
+    )
+    parts = []
     try:
-        if not hasattr(store_conversation_context, '_cache'):
-            store_conversation_context._cache = {}
-        
-        cache_key = f"context_{phone_number}"
-        
-        # If context is empty or None, clear the cache
-        if not context:
-            if cache_key in store_conversation_context._cache:
-                del store_conversation_context._cache[cache_key]
-            return
-        
-        # Only store single context dict, not lists
-        if isinstance(context, dict):
-            store_conversation_context._cache[cache_key] = {
-                'context': context,
-                'timestamp': datetime.now()
-            }
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                if stop_when and '"' in delta and stop_when("".join(parts)):
+                    break
+    finally:
+        stream.close()
+    return "".join(parts)
+
+
+async def astream_completion(messages, stop_when=None, max_tokens: int = None) -> str:
+    async with _async_llm_limit():
+        stream = await async_llm_client.chat.completions.create(
+            model=config.llm_model,
+            temperature=config.temperature,
+            max_tokens=max_tokens or config.max_tokens_response,
+            messages=messages,
+            stream=True,
+        )
+        parts = []
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    if stop_when and '"' in delta and stop_when("".join(parts)):
+                        break
+        finally:
+            await stream.close()
+        return "".join(parts)
+
+
+# Several understand_message turns from the same user answered in one call: the combined
+# prompt's prefix, then one result object per tagged message
+COMBINED_BATCH_SYSTEM_PROMPT = (
+    COMBINED_SYSTEM_PROMPT +
+    '\n\nYou may receive several messages, one per line as {"id": ..., "message": ...}. Answer each one '
+    'on its own and return ONLY {"results": [...]}, holding one object of the form above per message, '
+    'each with an extra "id" field copied unchanged from its message.'
+)
+_COMBINED_BATCH_SYS = {"role": "system", "content": COMBINED_BATCH_SYSTEM_PROMPT}
+
+
+class CombinedBatcher:
+    """Coalesces concurrent async understand_message calls from one user into one LLM
+    request; other users' messages never share a prompt. While fewer than busy_at calls
+    are in flight, turns make their own call at once, so light traffic never waits. Under
+    a burst, a user's turns queue for up to max_wait seconds or until max_batch are
+    pending and share one request. Each message is tagged with an opaque id and a result
+    is only handed back when it carries that id; submit returns the turn's result dict,
+    or None when there was no matching result and the caller should make its own call.
+    One instance per event loop, from combined_batcher()."""
+
+    def __init__(self, max_batch: int = 8, max_wait: float = 0.05, busy_at: int = 4):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.busy_at = busy_at
+        self.in_flight = 0
+        # phone number -> [(id, user_content, future)] and its flush timer
+        self._pending: Dict[str, list] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    def busy(self) -> bool:
+        return self.in_flight >= self.busy_at
+
+    async def submit(self, phone_number: str, user_content: str):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(phone_number, [])
+        pending.append((uuid.uuid4().hex[:12], user_content, future))
+        if len(pending) >= self.max_batch:
+            self._flush(phone_number)
+        elif phone_number not in self._timers:
+            self._timers[phone_number] = loop.call_later(self.max_wait, self._flush, phone_number)
+        return await future
+
+    def _flush(self, phone_number: str) -> None:
+        timer = self._timers.pop(phone_number, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(phone_number, [])
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch) -> None:
+        if len(batch) == 1:
+            # Nothing to coalesce: send it with the single-message prompt right away
+            messages = [_COMBINED_SYS, {"role": "user", "content": batch[0][1]}]
         else:
-            # If somehow a list is passed, take the last item
-            if isinstance(context, list) and context:
-                store_conversation_context._cache[cache_key] = {
-                    'context': context[-1],  # Take most recent
-                    'timestamp': datetime.now()
-                }
-        
-        # Also store reference in get_conversation_context
-        get_conversation_context._cache = store_conversation_context._cache
-    except Exception as e:
-        print(f"[ERROR] Failed to store context: {e}")
+            tagged = "\n".join(json.dumps({"id": item_id, "message": content}) for item_id, content, _ in batch)
+            messages = [_COMBINED_BATCH_SYS, {"role": "user", "content": tagged}]
+        by_id = {}
+        self.in_flight += 1
+        try:
+            response = await achat_completion(messages, config.max_tokens_combined * len(batch), json_mode=True)
+            parsed = parse_llm_json(response.choices[0].message.content or "{}")
+            if len(batch) == 1:
+                by_id = {batch[0][0]: parsed}
+            else:
+                by_id = self._match_ids(batch, parsed.get("results"))
+        except Exception as e:
+            logger.exception("CombinedBatcher: batch call failed: %s", e)
+        finally:
+            self.in_flight -= 1
+        for item_id, _, future in batch:
+            if not future.done():
+                result = by_id.get(item_id)
+                future.set_result(result if isinstance(result, dict) else None)
+
+    @staticmethod
+    def _match_ids(batch, results) -> Dict[str, dict]:
+        """Results keyed by the id they carry; ids that are missing, unknown or answered
+        twice are left out, so those turns fall back to their own call"""
+        if not isinstance(results, list):
+            return {}
+        ids = {item_id for item_id, _, _ in batch}
+        by_id, repeated = {}, set()
+        for result in results:
+            item_id = result.pop("id", None) if isinstance(result, dict) else None
+            if item_id not in ids:
+                continue
+            if item_id in by_id:
+                repeated.add(item_id)
+            by_id[item_id] = result
+        for item_id in repeated:
+            del by_id[item_id]
+        return by_id
 
 
-# 1. Intent Detection Tool
-class IntentTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] IntentTool invoked with state:", state)
-        message = state["message"]
-        response = llm_client.chat.completions.create(
+def combined_batcher() -> CombinedBatcher:
+    return _loop_local("combined_batcher", CombinedBatcher)
+
+
+async def run_db_work(func, *args):
+    """Run a node's synchronous SQLAlchemy work on a worker thread, so a turn waiting on
+    the database never blocks the event loop. anyio copies the context, so DB_SESSION
+    stays bound; the session is only ever used by one thread at a time."""
+    return await anyio.to_thread.run_sync(func, *args)
+
+
+# Send streamed prose once the buffer holds a finished sentence of at least this length
+_REPLY_CHUNK_MIN = 80
+_SENTENCE_END_RE = re.compile(r"[.!?\n]\s")
+
+
+async def areply_completion(messages):
+    """Return (text, streamed). With a REPLY_SINK bound, the completion is streamed and
+    every chunk of text is passed to the sink; otherwise it is one plain request."""
+    sink = REPLY_SINK.get()
+    if sink is None:
+        return (await achat_completion(messages)).choices[0].message.content, False
+    parts = []
+    buffer = ""
+    async with _async_llm_limit():
+        stream = await async_llm_client.chat.completions.create(
             model=config.llm_model,
             temperature=config.temperature,
-            max_tokens=config.max_tokens,
-            messages=[
-                {"role": "system", "content": (
-                    "You are a WhatsApp expense bot. Classify the user's intent as one of: "
-                    "'log_expense', 'query', 'breakdown', 'chitchat'. "
-                    "\n\nGuidelines:"
-                    "\n- 'query': Specific questions like 'top 5 expenses', 'most expensive', 'cheapest', 'how much did I spend on X', 'compare months', 'breakdown for past week/month', 'expenses in January', etc."
-                    "\n- 'breakdown': General requests like 'spending breakdown', 'category summary', 'overall breakdown' (without time periods)"
-                    "\n- 'log_expense': Adding/recording new expenses"
-                    "\n- 'chitchat': General conversation, greetings, non-expense related"
-                    "\nReturn ONLY a valid JSON object with double quotes. "
-                    "Example: {\"intent\": \"query\"}"
-                )},
-                {"role": "user", "content": message},
-            ]
+            max_tokens=config.max_tokens_response,
+            messages=messages,
+            stream=True,
         )
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                parts.append(delta)
+                buffer += delta
+                if len(buffer) >= _REPLY_CHUNK_MIN:
+                    ends = list(_SENTENCE_END_RE.finditer(buffer))
+                    if ends:
+                        cut = ends[-1].end()
+                        await sink(buffer[:cut].strip())
+                        buffer = buffer[cut:]
+        finally:
+            await stream.close()
+    if buffer.strip():
+        await sink(buffer.strip())
+    text = "".join(parts)
+    return text, bool(text.strip())
+
+
+# 1. Intent Detection Tool
+# The graph uses CombinedIntentExtractTool; this stays usable on its own.
+class IntentTool(Runnable):
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("IntentTool invoked with state: %s", state)
+        local_intent = classify_intent_locally(state.message)
+        if local_intent:
+            logger.debug("IntentTool local classifier: %s", local_intent)
+            return {"intent": local_intent}
+        cache_key = intent_cache_key(state.message)
+        cached_intent = INTENT_CACHE.get(cache_key)
+        if cached_intent:
+            logger.debug("IntentTool cache hit: %s", cached_intent)
+            return {"intent": cached_intent}
+        return self._parse(cache_key, chat_completion(self._messages(state), config.max_tokens_intent, json_mode=True))
+
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        local_intent = classify_intent_locally(state.message)
+        if local_intent:
+            return {"intent": local_intent}
+        cache_key = intent_cache_key(state.message)
+        cached_intent = INTENT_CACHE.get(cache_key)
+        if cached_intent:
+            return {"intent": cached_intent}
+        return self._parse(cache_key, await achat_completion(self._messages(state), config.max_tokens_intent, json_mode=True))
+
+    def _messages(self, state: AgentState):
+        return [
+            _INTENT_SYS,
+            {"role": "user", "content": state.message},
+        ]
+
+    def _parse(self, cache_key: tuple, response) -> Dict[str, Any]:
+        log_cached_tokens("IntentTool", response)
         raw = response.choices[0].message.content
         if raw is None:
-            print("[WARNING] IntentTool: LLM returned None response.")
-            return {**state, "intent": "chitchat"}
+            logger.warning("IntentTool: LLM returned None response.")
+            return {"intent": "chitchat"}
         
         try:
-            cleaned_json = clean_json_response(raw)
-            result = json.loads(cleaned_json) if cleaned_json else {}
+            result = parse_llm_json(raw)
             intent = result.get("intent", "chitchat")
-            print("[DEBUG] IntentTool output:", result)
-            return {**state, "intent": intent}
+            INTENT_CACHE.set(cache_key, intent)
+            logger.debug("IntentTool output: %s", result)
+            return {"intent": intent}
         except Exception as e:
-            print(f"[ERROR] IntentTool: Failed to parse LLM response: {e}")
-            return {**state, "intent": "chitchat"}
+            logger.exception("IntentTool: Failed to parse LLM response: %s", e)
+            return {"intent": "chitchat"}
 
 
 # 2. Completely Rewritten Expense Extraction Tool
+# Also the extraction half of CombinedIntentExtractTool, so it must not touch the DB session.
 class ExtractExpenseTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] ExtractExpenseTool invoked with state:", state)
-        db: Any = state.get("db")
-        message = state["message"]
-        phone_number = state["phone_number"]
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("ExtractExpenseTool invoked with state: %s", state)
+        # Use LLM to extract expenses intelligently
+        return self._parse(chat_completion(self._messages(state), config.max_tokens_extract, json_mode=True))
+
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        return self._parse(await achat_completion(self._messages(state), config.max_tokens_extract, json_mode=True))
+
+    def _messages(self, state: AgentState):
+        return [
+            _EXTRACT_SYS,
+            {"role": "user", "content": self._user_content(state)},
+        ]
 
-        # Get or create user
-        db_user = crud.get_user_by_phone_number(db, phone_number) if db else None
-        if db and not db_user:
-            db_user = crud.create_user(db, user=models.User(phone_number=phone_number))
+    def _user_content(self, state: AgentState) -> str:
+        message = state.message
 
         # Check for pending context from previous messages
-        pending_context = state.get("pending_context", {})
-        
-        # Fix: Handle case where pending_context is a list
-        if isinstance(pending_context, list):
-            pending_context = pending_context[-1] if pending_context else {}
-            print(f"[DEBUG] Fixed list context to: {pending_context}")
+        pending_context = state.pending_context
         
         # Enhanced context processing
         if pending_context:
             enhanced_message = self._enhance_message_with_context(message, pending_context)
-            print(f"[DEBUG] Enhanced message with context: {enhanced_message}")
-        else:
-            enhanced_message = message
+            logger.debug("Enhanced message with context: %s", enhanced_message)
+            return enhanced_message
+        return message
 
-        # Use LLM to extract expenses intelligently
-        response = llm_client.chat.completions.create(
-            model=config.llm_model,
-            temperature=config.temperature,
-            max_tokens=config.max_tokens,
-            messages=[
-                {"role": "system", "content": (
-                    "You are an intelligent expense extraction system. Extract expenses from user messages.\n\n"
-                    "IMPORTANT RULES:\n"
-                    "1. Extract ALL complete expenses (both amount and item mentioned)\n"
-                    "2. Handle multiple expenses in one message: 'soccer ball: 8k, shoes: 11k, socks: 800'\n"
-                    "3. Handle various formats: '8000', '8k', '8K', '8,000'\n"
-                    "4. Smart categorization: food/groceries, transportation/transport, entertainment, shopping/clothing, health, electronics, sports, rent/housing, other\n"
-                    "5. Extract meaningful notes from item descriptions\n"
-                    "6. If message has amount AND item, it's COMPLETE - extract it\n"
-                    "7. If missing amount OR item, mark as incomplete\n\n"
-                    "Return JSON format:\n"
-                    "{\n"
-                    '  "complete_expenses": [{"amount": 8000, "category": "sports", "note": "soccer ball"}],\n'
-                    '  "incomplete_expense": {"type": "missing_amount", "item": "shoes"} OR {"type": "missing_item", "amount": 5000} OR null\n'
-                    "}\n\n"
-                    "Examples:\n"
-                    "- 'soccer ball 8k' → complete\n"
-                    "- 'I spent 500 PKR' → incomplete (missing item)\n"
-                    "- 'bought shoes' → incomplete (missing amount)\n"
-                    "- 'phone 25k, lunch 300' → both complete"
-                )},
-                {"role": "user", "content": enhanced_message},
-            ]
-        )
-        
+    def _parse(self, response) -> Dict[str, Any]:
         raw = response.choices[0].message.content
-        print(f"[DEBUG] ExtractExpenseTool raw LLM output: {raw}")
+        logger.debug("ExtractExpenseTool raw LLM output: %.200s", raw)
         
         try:
             if raw is None:
                 raw = "{}"
-            cleaned_json = clean_json_response(raw)
-            result = json.loads(cleaned_json) if cleaned_json else {}
-            
-            complete_expenses = result.get("complete_expenses", [])
-            incomplete_expense = result.get("incomplete_expense")
-            
-            print(f"[DEBUG] ExtractExpenseTool extracted: {len(complete_expenses)} complete, incomplete: {incomplete_expense}")
-            
-            # Prepare return state
-            new_state = {**state, "db_user": db_user, "expenses": complete_expenses}
-            
-            # Handle incomplete expense - ensure it's a dict, not a list
-            if incomplete_expense and isinstance(incomplete_expense, dict):
-                new_state["pending_context"] = incomplete_expense
-            else:
-                new_state["pending_context"] = {}
-                
-            return new_state
-            
+            result = parse_llm_json(raw)
+            return self._expense_fields(result)
         except Exception as e:
-            print(f"[ERROR] ExtractExpenseTool: Failed to parse LLM response: {e}")
-            return {**state, "db_user": db_user, "expenses": [], "pending_context": {}}
+            logger.exception("ExtractExpenseTool: Failed to parse LLM response: %s", e)
+            return {"expenses": [], "pending_context": {}}
+
+    def _expense_fields(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        complete_expenses = result.get("complete_expenses") or []
+        incomplete_expense = result.get("incomplete_expense")
+        
+        logger.debug("ExtractExpenseTool extracted: %s complete, incomplete: %s", len(complete_expenses), incomplete_expense)
+        
+        # Prepare return state
+        new_state = {"expenses": complete_expenses}
+        
+        # Handle incomplete expense - ensure it's a dict, not a list
+        if incomplete_expense and isinstance(incomplete_expense, dict):
+            new_state["pending_context"] = incomplete_expense
+        else:
+            new_state["pending_context"] = {}
+            
+        return new_state
 
     def _enhance_message_with_context(self, message: str, pending_context: dict) -> str:
         """Enhance current message with pending context intelligently"""
@@ -235,241 +626,483 @@ class ExtractExpenseTool(Runnable):
         return message
 
 
+# 2b. Intent detection and expense extraction in a single LLM call.
+# Intents that need no extraction are still answered locally or from the intent cache first.
+class CombinedIntentExtractTool(Runnable):
+    # The intent key is asked for first, so non-expense turns can stop reading the stream
+    # as soon as it closes instead of waiting for the empty extraction fields.
+    _INTENT_FIELD_RE = re.compile(r'"intent"\s*:\s*"(\w+)"')
+
+    def __init__(self):
+        self.extract = ExtractExpenseTool()
+
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("CombinedIntentExtractTool invoked with state: %s", state)
+        fast_log = self._fast_log(state)
+        if fast_log:
+            return fast_log
+        quick_intent = self._quick_intent(state)
+        if quick_intent:
+            logger.debug("CombinedIntentExtractTool quick intent: %s", quick_intent)
+            return {"intent": quick_intent}
+        return self._parse(state, stream_completion(self._messages(state), self._intent_settled, config.max_tokens_combined))
+
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        fast_log = self._fast_log(state)
+        if fast_log:
+            return fast_log
+        quick_intent = self._quick_intent(state)
+        if quick_intent:
+            return {"intent": quick_intent}
+        batcher = combined_batcher()
+        if batcher.busy():
+            result = await batcher.submit(state.phone_number, self.extract._user_content(state))
+            if result is not None:
+                return self._parse_result(state, result)
+        batcher.in_flight += 1
+        try:
+            raw = await astream_completion(self._messages(state), self._intent_settled, config.max_tokens_combined)
+        finally:
+            batcher.in_flight -= 1
+        return self._parse(state, raw)
+
+    def _intent_settled(self, text: str) -> bool:
+        match = self._INTENT_FIELD_RE.search(text)
+        # log_expense and query turns still need the rest of the object
+        return bool(match) and match.group(1) not in ("log_expense", "query")
+
+    def _fast_log(self, state: AgentState):
+        # A pending question changes what a bare "500 lunch" means, so leave that to the LLM
+        if state.pending_context:
+            return None
+        expenses = extract_simple_expense(state.message)
+        if expenses:
+            return {"intent": "log_expense", "expenses": expenses, "pending_context": {}}
+        return None
+
+    def _quick_intent(self, state: AgentState):
+        # "lunch" or "500" answering a pending question completes that expense; neither the
+        # local rules nor INTENT_CACHE see the question, so only the LLM may classify it
+        if state.pending_context:
+            return None
+        intent = classify_intent_locally(state.message) or INTENT_CACHE.get(intent_cache_key(state.message))
+        # log_expense still needs the LLM for the extraction itself
+        return intent if intent != "log_expense" else None
+
+    def _messages(self, state: AgentState):
+        return [
+            _COMBINED_SYS,
+            {"role": "user", "content": self.extract._user_content(state)},
+        ]
+
+    def _parse(self, state: AgentState, raw: str) -> Dict[str, Any]:
+        logger.debug("CombinedIntentExtractTool raw LLM output: %.200s", raw)
+        try:
+            result = parse_llm_json(raw or "{}")
+        except Exception as e:
+            logger.exception("CombinedIntentExtractTool: Failed to parse LLM response: %s", e)
+            result = {}
+        if "intent" not in result:
+            # Stream stopped early (or the JSON was malformed); the intent field is enough
+            match = self._INTENT_FIELD_RE.search(raw or "")
+            result = {"intent": match.group(1)} if match else {}
+        return self._parse_result(state, result)
+
+    def _parse_result(self, state: AgentState, result: Dict[str, Any]) -> Dict[str, Any]:
+        intent = result.get("intent", "chitchat")
+        if intent != "log_expense":
+            if not state.pending_context:
+                INTENT_CACHE.set(intent_cache_key(state.message), intent)
+            sql = (result.get("sql") or "").strip() if intent == "query" else ""
+            if sql:
+                # Cached by QuerySQLTool once the statement has passed the guard and run
+                return {"intent": intent, "sql": sql}
+            return {"intent": intent}
+        return {"intent": intent, **self.extract._expense_fields(result)}
+
+
 # 3. Completely Rewritten Expense Creation Tool
 class CreateExpenseTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] CreateExpenseTool invoked with state:", state)
-        db: Any = state.get("db")
-        user = state["db_user"]
-        user_id = user.id if user else None
-        expenses = state.get("expenses", [])
-        pending_context = state.get("pending_context", {})
-        message = state["message"]
-        phone_number = state["phone_number"]
-
-        # Fix: Handle case where pending_context is a list
-        if isinstance(pending_context, list):
-            pending_context = pending_context[-1] if pending_context else {}
-            print(f"[DEBUG] CreateExpenseTool: Fixed list context to: {pending_context}")
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("CreateExpenseTool invoked with state: %s", state)
+        update, reply = self._apply(state)
+        if reply is None:
+            return update
+        messages, fallback, label = reply
+        return {**update, "final_response": self._generate(messages, fallback, label)}
+
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        update, reply = await run_db_work(self._apply, state)
+        if reply is None:
+            return update
+        messages, fallback, label = reply
+        return {**update, "final_response": await self._agenerate(messages, fallback, label)}
+
+    def _apply(self, state: AgentState):
+        """Do the DB work for this turn; return the state update and, when an LLM reply is
+        still needed, its (messages, fallback, label)"""
+        db: Any = current_db()
+        message = state.message
+        phone_number = state.phone_number
+
+        user_id = get_or_create_user_id(db, phone_number)
+        expenses = state.expenses or []
+        # store_conversation_context only ever keeps a single dict
+        pending_context = state.pending_context or {}
 
         # If we have complete expenses, log them
         if expenses and db and user_id:
             inserted = []
-            for expense in expenses:
-                try:
-                    amount = expense.get("amount")
-                    category_name = expense.get("category")
-                    note = expense.get("note", "")
-
-                    if amount and category_name:
-                        category = crud.get_or_create_category(db, user_id, category_name)
-                        category_id = getattr(category, "id", None)
-                        if category_id is not None:
-                            new_expense = crud.create_expense(db, user_id, category_id, amount, note)
-                            inserted.append(new_expense)
-                except Exception as e:
-                    print(f"[ERROR] CreateExpenseTool: Failed to create expense: {e}")
+            valid = [e for e in expenses if e.get("amount") and e.get("category")]
+            try:
+                # One category lookup and one multi-row INSERT for the whole turn
+                categories = crud.get_or_create_categories(db, user_id, (e["category"] for e in valid))
+                rows = [
+                    {"category_id": categories[e["category"].lower()].id, "amount": e["amount"], "note": e.get("note", "")}
+                    for e in valid
+                ]
+                if rows:
+                    created = crud.create_expenses(db, user_id, rows)
+                    inserted = [
+                        (new_expense, categories[e["category"].lower()].name)
+                        for new_expense, e in zip(created, valid)
+                    ]
+            except Exception as e:
+                db.rollback()
+                logger.exception("CreateExpenseTool: Failed to create expenses: %s", e)
 
             if inserted:
                 # Clear context after successful expense logging
                 store_conversation_context(db, phone_number, {})
-                response_message = self._generate_intelligent_success_message(inserted, db)
-                return {**state, "final_response": response_message, "pending_context": {}}
+                BREAKDOWN_CACHE.pop(phone_number)
+                return {"pending_context": {}}, self._success_reply(inserted)
 
         # If we have pending context, store it and generate clarification
         if pending_context:
             store_conversation_context(db, phone_number, pending_context)
-            clarification = self._generate_intelligent_clarification(pending_context, message)
-            return {**state, "final_response": clarification}
+            return {}, self._clarification_reply(pending_context, message)
 
         # If no expenses extracted and no pending context
         if not expenses and not pending_context:
             # Clear any stale context
             store_conversation_context(db, phone_number, {})
-            no_expense_response = self._generate_no_expense_response(message)
-            return {**state, "final_response": no_expense_response, "pending_context": {}}
+            return {"pending_context": {}}, self._no_expense_reply(message)
 
-        return {**state, "final_response": "I'm having trouble understanding that expense. Could you try rephrasing it?"}
+        return {"final_response": "I'm having trouble understanding that expense. Could you try rephrasing it?"}, None
 
-    def _generate_intelligent_success_message(self, inserted_expenses, db):
-        """Generate natural success message using LLM"""
-        if len(inserted_expenses) == 1:
-            expense = inserted_expenses[0]
-            category = db.query(models.Category).filter(models.Category.id == expense.category_id).first()
-            category_name = category.name if category else "unknown"
-            note_text = f" ({expense.note})" if expense.note else ""
-            
-            prompt = f"The user successfully logged an expense: {expense.amount} PKR for {category_name}{note_text}. Generate a natural, encouraging confirmation message. Be conversational and friendly."
-        else:
-            total = sum(exp.amount for exp in inserted_expenses)
-            prompt = f"The user successfully logged {len(inserted_expenses)} expenses totaling {total} PKR. Generate a natural, encouraging confirmation message that mentions the count and total. Be conversational and friendly."
+    def _generate(self, messages, fallback: str, label: str) -> str:
+        # The user prompt already pins down everything the reply depends on
+        # (amounts, category, note, or the missing field), so it is the cache key
+        cache_key = (label, config.llm_model, messages[-1]["content"])
+        cached = REPLY_CACHE.get(cache_key)
+        if cached:
+            return cached
+        try:
+            result = chat_completion(messages).choices[0].message.content
+            if result and result.strip():
+                REPLY_CACHE.set(cache_key, result.strip())
+                return result.strip()
+        except Exception as e:
+            logger.exception("Failed to generate %s: %s", label, e)
+        return fallback
 
+    async def _agenerate(self, messages, fallback: str, label: str) -> str:
+        cache_key = (label, config.llm_model, messages[-1]["content"])
+        cached = REPLY_CACHE.get(cache_key)
+        if cached:
+            return cached
         try:
-            response = llm_client.chat.completions.create(
-                model=config.llm_model,
-                temperature=config.temperature,
-                max_tokens=config.max_tokens,
-                messages=[
-                    {"role": "system", "content": "You are a helpful financial assistant. Generate brief, natural confirmation messages for logged expenses. Be encouraging and conversational."},
-                    {"role": "user", "content": prompt},
-                ]
-            )
-            
-            result = response.choices[0].message.content
+            result = (await achat_completion(messages)).choices[0].message.content
             if result and result.strip():
+                REPLY_CACHE.set(cache_key, result.strip())
                 return result.strip()
         except Exception as e:
-            print(f"[ERROR] Failed to generate success message: {e}")
-
-        # Fallback
-        if len(inserted_expenses) == 1:
-            expense = inserted_expenses[0]
-            category = db.query(models.Category).filter(models.Category.id == expense.category_id).first()
-            category_name = category.name if category else "unknown"
-            return f"✅ Got it! Logged {expense.amount} PKR for {category_name}."
+            logger.exception("Failed to generate %s: %s", label, e)
+        return fallback
+
+    _SUCCESS_ONE = "The user successfully logged an expense: {} PKR for {}{}. Generate a natural, encouraging confirmation message. Be conversational and friendly."
+    _SUCCESS_ONE_FALLBACK = "✅ Got it! Logged {} PKR for {}."
+    _SUCCESS_MANY = "The user successfully logged {} expenses totaling {} PKR. Generate a natural, encouraging confirmation message that mentions the count and total. Be conversational and friendly."
+    _SUCCESS_MANY_FALLBACK = "✅ Perfect! Logged {} expenses totaling {} PKR."
+
+    def _success_reply(self, inserted_expenses):
+        """Natural success message prompt, plus a templated fallback.
+        inserted_expenses holds (expense, category_name) pairs"""
+        count = len(inserted_expenses)
+        if count == 1:
+            expense, category_name = inserted_expenses[0]
+            note_text = f" ({expense.note})" if expense.note else ""
+            prompt = self._SUCCESS_ONE.format(expense.amount, category_name, note_text)
+            fallback = self._SUCCESS_ONE_FALLBACK.format(expense.amount, category_name)
         else:
-            total = sum(exp.amount for exp in inserted_expenses)
-            return f"✅ Perfect! Logged {len(inserted_expenses)} expenses totaling {total} PKR."
+            total = sum(exp.amount for exp, _ in inserted_expenses)
+            prompt = self._SUCCESS_MANY.format(count, total)
+            fallback = self._SUCCESS_MANY_FALLBACK.format(count, total)
+
+        messages = [
+            _SUCCESS_SYS,
+            {"role": "user", "content": prompt},
+        ]
+        return messages, fallback, "success message"
 
-    def _generate_intelligent_clarification(self, pending_context, original_message):
-        """Generate natural clarification question using LLM"""
+    def _clarification_reply(self, pending_context, original_message):
+        """Natural clarification question prompt, plus a templated fallback"""
         if pending_context.get("type") == "missing_amount":
             item = pending_context.get("item", "that item")
             prompt = f"The user mentioned buying '{item}' but didn't say how much it cost. Generate a natural, conversational question asking for the amount in PKR. Be friendly and specific about the item."
+            fallback = f"How much did you spend on {pending_context.get('item', 'that')}? (in PKR)"
         elif pending_context.get("type") == "missing_item":
             amount = pending_context.get("amount", "some money")
             prompt = f"The user said they spent {amount} PKR but didn't mention what they bought. Generate a natural, conversational question asking what they purchased. Be friendly."
+            fallback = f"What did you spend {pending_context.get('amount', 'that amount')} PKR on?"
         else:
             prompt = f"The user said '{original_message}' but it's unclear what expense they want to log. Generate a natural, helpful question to clarify."
+            fallback = "Could you tell me what you bought and how much you spent? (in PKR)"
 
-        try:
-            response = llm_client.chat.completions.create(
-                model=config.llm_model,
-                temperature=config.temperature,
-                max_tokens=config.max_tokens,
-                messages=[
-                    {"role": "system", "content": "You are a helpful financial assistant. Generate natural, conversational questions to clarify incomplete expense information. Be friendly and specific."},
-                    {"role": "user", "content": prompt},
-                ]
-            )
-            
-            result = response.choices[0].message.content
-            if result and result.strip():
-                return result.strip()
-        except Exception as e:
-            print(f"[ERROR] Failed to generate clarification: {e}")
-
-        # Fallback
-        if pending_context.get("type") == "missing_amount":
-            item = pending_context.get("item", "that")
-            return f"How much did you spend on {item}? (in PKR)"
-        elif pending_context.get("type") == "missing_item":
-            amount = pending_context.get("amount", "that amount")
-            return f"What did you spend {amount} PKR on?"
-        else:
-            return "Could you tell me what you bought and how much you spent? (in PKR)"
+        messages = [
+            _CLARIFY_SYS,
+            {"role": "user", "content": prompt},
+        ]
+        return messages, fallback, "clarification"
 
-    def _generate_no_expense_response(self, message):
-        """Generate intelligent response when no expense is detected"""
+    def _no_expense_reply(self, message):
+        """Prompt for when no expense is detected, plus a templated fallback"""
         prompt = f"The user said '{message}' but I couldn't detect any specific expense to log. Generate a natural, helpful response that encourages them to share expense details in PKR. Be conversational and give an example."
-
-        try:
-            response = llm_client.chat.completions.create(
-                model=config.llm_model,
-                temperature=config.temperature,
-                max_tokens=config.max_tokens,
-                messages=[
-                    {"role": "system", "content": "You are a helpful financial assistant. When users mention expenses but don't provide enough detail, guide them naturally. Be encouraging and give examples."},
-                    {"role": "user", "content": prompt},
-                ]
-            )
-            
-            result = response.choices[0].message.content
-            if result and result.strip():
-                return result.strip()
-        except Exception as e:
-            print(f"[ERROR] Failed to generate no expense response: {e}")
-
-        # Fallback
-        return "I'd love to help you log that expense! Could you tell me what you bought and how much you spent? For example: 'I spent 500 PKR on lunch' or 'bought groceries for 2000 PKR'."
+        messages = [
+            _NO_EXPENSE_SYS,
+            {"role": "user", "content": prompt},
+        ]
+        fallback = "I'd love to help you log that expense! Could you tell me what you bought and how much you spent? For example: 'I spent 500 PKR on lunch' or 'bought groceries for 2000 PKR'."
+        return messages, fallback, "no expense response"
 
 
 # 4. SQL Generation Tool (for queries)
 class GenerateSQLTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] GenerateSQLTool invoked with state:", state)
-        print("[DEBUG] GenerateSQLTool run_config db:", run_config.get('db'))
-        # Get user from database if not already in state
-        db: Any = state.get("db")
-        phone_number = state["phone_number"]
-        db_user = crud.get_user_by_phone_number(db, phone_number) if db else None
-        if db and not db_user:
-            db_user = crud.create_user(db, user=models.User(phone_number=phone_number))
-        
-        user_id = db_user.id if db_user else None
-        message = state["message"]
-
-        sql_prompt = (
-            f"You are a PostgreSQL expert helping generate SQL for an expense tracker.\n"
-            f"User data is stored in tables: users(id), categories(id, name, user_id), expenses(id, user_id, category_id, amount, timestamp, note).\n"
-            f"Only generate SELECT statements to answer the user's question.\n"
-            f"Always filter with e.user_id = {user_id}.\n"
-            f"Respond with only the SQL query, no markdown formatting or code blocks."
-        )
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("GenerateSQLTool invoked with state: %s", state)
+        cache_key = llm_cache_key(state.message)
+        cached_sql = SQL_CACHE.get(cache_key)
+        if cached_sql:
+            logger.debug("GenerateSQLTool cache hit: %s", cached_sql)
+            return {"sql": cached_sql}
+        return self._parse(chat_completion(self._messages(state), config.max_tokens_sql, json_mode=True))
 
-        response = llm_client.chat.completions.create(
-            model=config.llm_model,
-            temperature=config.temperature,
-            max_tokens=config.max_tokens,
-            messages=[
-                {"role": "system", "content": sql_prompt},
-                {"role": "user", "content": message},
-            ]
-        )
-        sql = response.choices[0].message.content
-        # Clean SQL by removing markdown code blocks
-        if sql:
-            sql = sql.strip()
-            # Remove ```sql and ``` markers
-            if sql.startswith("```sql"):
-                sql = sql[6:]
-            if sql.startswith("```"):
-                sql = sql[3:]
-            if sql.endswith("```"):
-                sql = sql[:-3]
-            sql = sql.strip()
-        else:
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        # SQL uses a :user_id placeholder, so the same question maps to the same SQL for everyone
+        cache_key = llm_cache_key(state.message)
+        cached_sql = SQL_CACHE.get(cache_key)
+        if cached_sql:
+            return {"sql": cached_sql}
+        return self._parse(await achat_completion(self._messages(state), config.max_tokens_sql, json_mode=True))
+
+    def _messages(self, state: AgentState):
+        return [
+            _SQL_SYS,
+            {"role": "user", "content": state.message},
+        ]
+
+    def _parse(self, response) -> Dict[str, Any]:
+        log_cached_tokens("GenerateSQLTool", response)
+        try:
+            sql = (parse_llm_json(response.choices[0].message.content or "{}").get("sql") or "").strip()
+        except Exception as e:
+            logger.exception("GenerateSQLTool: Failed to parse LLM response: %s", e)
             sql = ""
-        print("[DEBUG] GenerateSQLTool output SQL:", sql)
-        return {**state, "sql": sql, "db_user": db_user}
+        logger.debug("GenerateSQLTool output SQL: %s", sql)
+        return {"sql": sql}
 
 
 # 5. SQL Execution Tool
+# LLM-written SQL is only run if it parses as one read-only SELECT in which every table
+# reference is scoped to the caller: a top-level AND conjunct "<alias>.user_id = :user_id"
+# (users: "<alias>.id = :user_id") in its WHERE or its own JOIN ... ON
+_SQL_SCOPE_COLUMN = {"expenses": "user_id", "categories": "user_id", "users": "id"}
+_SQL_FORBIDDEN_NODES = (
+    exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Drop, exp.Create, exp.Alter,
+    exp.Command, exp.TruncateTable, exp.Into, exp.Lock, exp.SetOperation,
+)
+_SQL_FORBIDDEN_FUNC_RE = re.compile(r"^(pg_|lo_|dblink|set_config$|current_setting$|query_to_xml)", re.IGNORECASE)
+_SQL_ROW_LIMIT = 1000
+
+
+def _and_terms(condition):
+    """Top-level AND conjuncts of condition; an OR anywhere above a term hides it"""
+    if condition is None:
+        return
+    condition = condition.unnest()
+    if isinstance(condition, exp.And):
+        yield from _and_terms(condition.left)
+        yield from _and_terms(condition.right)
+    else:
+        yield condition
+
+
+def _is_scope_filter(term, alias: str, column: str, only_table: bool) -> bool:
+    if not isinstance(term, exp.EQ):
+        return False
+    for col, value in ((term.left, term.right), (term.right, term.left)):
+        if (
+            isinstance(col, exp.Column) and isinstance(value, exp.Placeholder)
+            and value.name == "user_id" and col.name.lower() == column
+            and (col.table.lower() == alias or (not col.table and only_table))
+        ):
+            return True
+    return False
+
+
+def _select_is_scoped(select, cte_names, checked) -> bool:
+    from_ = select.args.get("from_")
+    sources = [(from_.this, None)] if from_ else []
+    sources += [(join.this, join) for join in select.args.get("joins") or []]
+    where = list(_and_terms(select.args.get("where") and select.args["where"].this))
+    for source, join in sources:
+        if isinstance(source, exp.Subquery):
+            continue  # its own SELECT is checked on its own
+        if not isinstance(source, exp.Table) or source.args.get("db") or source.args.get("catalog"):
+            return False
+        name = source.name.lower()
+        checked.add(id(source))
+        if name in cte_names:
+            continue
+        column = _SQL_SCOPE_COLUMN.get(name)
+        if column is None:
+            return False
+        terms = where
+        # ON only restricts rows of a table that the join does not preserve
+        if join is not None and join.side.upper() not in ("RIGHT", "FULL"):
+            terms = where + list(_and_terms(join.args.get("on")))
+        alias = source.alias_or_name.lower()
+        if not any(_is_scope_filter(term, alias, column, len(sources) == 1) for term in terms):
+            return False
+    return True
+
+
+def guard_select_sql(sql: str):
+    """Return sql made safe to run (re-rendered, LIMIT added when it has no LIMIT or
+    FETCH), or None if rejected"""
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="postgres") if s is not None]
+    except sqlglot.errors.SqlglotError as e:
+        logger.warning("ExecuteSQLTool: rejected unparseable SQL (%s): %s", e, sql)
+        return None
+    if len(statements) != 1 or not isinstance(statements[0], exp.Select):
+        logger.warning("ExecuteSQLTool: rejected non-SELECT SQL: %s", sql)
+        return None
+    tree = statements[0]
+    for node in tree.walk():
+        if isinstance(node, _SQL_FORBIDDEN_NODES) or (
+            isinstance(node, exp.Func)
+            and _SQL_FORBIDDEN_FUNC_RE.match(node.name if isinstance(node, exp.Anonymous) else node.sql_name())
+        ):
+            logger.warning("ExecuteSQLTool: rejected SQL with %s: %s", type(node).__name__, sql)
+            return None
+
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    if cte_names & _SQL_SCOPE_COLUMN.keys():
+        # A CTE named like a real table would hide that table's references from the check
+        logger.warning("ExecuteSQLTool: rejected SQL with a CTE shadowing a table: %s", sql)
+        return None
+    checked = set()
+    if not all(_select_is_scoped(select, cte_names, checked) for select in tree.find_all(exp.Select)):
+        logger.warning("ExecuteSQLTool: rejected SQL not scoped to user_id = :user_id: %s", sql)
+        return None
+    if any(id(table) not in checked for table in tree.find_all(exp.Table)):
+        logger.warning("ExecuteSQLTool: rejected SQL with a table outside FROM/JOIN: %s", sql)
+        return None
+
+    if not tree.args.get("limit") and not tree.args.get("fetch"):
+        tree = tree.limit(_SQL_ROW_LIMIT)
+    # Keep :name placeholders for sql_text; the postgres writer would emit %(name)s
+    tree = tree.transform(lambda node: exp.Var(this=f":{node.name}") if isinstance(node, exp.Placeholder) else node)
+    return tree.sql(dialect="postgres")
+
+
+# LLM SQL repeats through SQL_CACHE, so reuse the TextClause for a repeated statement
+_text_clause = lru_cache(maxsize=256)(sql_text)
+
+
+# The most common questions ("how much did I spend on food this week") map onto fixed,
+# parameterised statements: no LLM call, and the database sees the same text every time.
+_TEMPLATE_QUERY_RE = re.compile(
+    r"^\s*(?:how much (?:did i|have i|i) spen[dt]|total (?:i )?spen[dt])"
+    r"(?: (?:on|for) (?P<category>[a-z]+))?"
+    r"(?: (?P<period>today|this week|this month|this year|in total|overall))?\s*\??\s*$",
+    re.IGNORECASE,
+)
+_TEMPLATE_CATEGORIES = frozenset(CATEGORY_KEYWORDS.values())
+_TEMPLATE_SQL = {
+    (by_category, since): sql_text(
+        "SELECT COALESCE(SUM(e.amount), 0) AS total_spent FROM expenses e"
+        + (" JOIN categories c ON e.category_id = c.id" if by_category else "")
+        + " WHERE e.user_id = :user_id"
+        + (" AND LOWER(c.name) = :category" if by_category else "")
+        + (" AND e.timestamp >= :since" if since else "")
+    )
+    for by_category in (False, True)
+    for since in (False, True)
+}
+
+
+def _period_start(period):
+    now = datetime.utcnow()
+    if period == "today":
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "this week":
+        return now - timedelta(days=7)
+    if period == "this month":
+        return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if period == "this year":
+        return now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    return None
+
+
+def match_query_template(message: str):
+    """(statement, params) for a question a fixed template answers, else None; params lack user_id"""
+    match = _TEMPLATE_QUERY_RE.match(message)
+    if not match:
+        return None
+    category = (match.group("category") or "").lower() or None
+    if category and category not in _TEMPLATE_CATEGORIES:
+        return None
+    since = _period_start((match.group("period") or "").lower())
+    params = {}
+    if category:
+        params["category"] = category
+    if since:
+        params["since"] = since
+    return _TEMPLATE_SQL[(category is not None, since is not None)], params
+
+
 class ExecuteSQLTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] ExecuteSQLTool invoked with state:", state)
-        db: Any = state.get("db")
-        sql = state.get("sql")
-        
-        # Clean SQL by removing any remaining markdown formatting
-        if sql:
-            sql = sql.strip()
-            # Remove ```sql and ``` markers if still present
-            if sql.startswith("```sql"):
-                sql = sql[6:]
-            if sql.startswith("```"):
-                sql = sql[3:]
-            if sql.endswith("```"):
-                sql = sql[:-3]
-            sql = sql.strip()
-        
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("ExecuteSQLTool invoked with state: %s", state)
+        return self.run(current_db(), state.sql, state.phone_number)
+
+    def run(self, db: Any, sql, phone_number: str) -> Dict[str, Any]:
+        return self.run_checked(db, sql, phone_number)[0]
+
+    def run_checked(self, db: Any, sql, phone_number: str):
+        """(update, ok) for LLM-written sql; ok only when it passed the guard and ran"""
         if not sql or not db:
-            print("[WARNING] ExecuteSQLTool: No SQL or DB provided.")
-            return {**state, "sql_result": None}
+            logger.warning("ExecuteSQLTool: No SQL or DB provided.")
+            return {"sql_result": None}, False
+
+        sql = guard_select_sql(sql)
+        if sql is None:
+            return {"sql_result": None}, False
+        return self._execute(db, _text_clause(sql), {}, phone_number)
+
+    def run_statement(self, db: Any, statement, params: Dict[str, Any], phone_number: str) -> Dict[str, Any]:
+        """Execute a vetted statement with params plus the caller's user_id bound"""
+        return self._execute(db, statement, params, phone_number)[0]
+
+    def _execute(self, db: Any, statement, params: Dict[str, Any], phone_number: str):
+        user_id = get_or_create_user_id(db, phone_number)
+        if user_id is None:
+            return {"sql_result": None}, False
 
         try:
-            from sqlalchemy import text as sql_text
-            result = db.execute(sql_text(sql))
+            result = db.execute(statement, {**params, "user_id": user_id})
             rows = result.fetchall()
             
             # Always return the raw result, even if None or empty
@@ -480,123 +1113,182 @@ class ExecuteSQLTool(Runnable):
             else:
                 formatted = rows
                 
-            print("[DEBUG] ExecuteSQLTool output:", formatted)
-            return {**state, "sql_result": formatted}
+            logger.debug("ExecuteSQLTool output: %s", formatted)
+            return {"sql_result": formatted}, True
         except Exception as e:
-            print(f"[ERROR] ExecuteSQLTool: SQL execution error: {e}")
+            logger.exception("ExecuteSQLTool: SQL execution error: %s", e)
+            db.rollback()
             # Return None so FormatQueryResponseTool can handle it gracefully
-            return {**state, "sql_result": None}
+            return {"sql_result": None}, False
+
+
+# 4+5. generate_sql and execute_sql fused into one graph node, saving a scheduler hop per query
+class QuerySQLTool(Runnable):
+    def __init__(self):
+        self.generate = GenerateSQLTool()
+        self.execute = ExecuteSQLTool()
+
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        templated = self._run_template(state)
+        if templated:
+            return templated
+        # The routing call usually wrote the SQL already
+        update = {"sql": state.sql} if state.sql else self.generate.invoke(state, run_config)
+        return {**update, **self._run_llm_sql(state, update["sql"])}
+
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        templated = await run_db_work(self._run_template, state)
+        if templated:
+            return templated
+        update = {"sql": state.sql} if state.sql else await self.generate.ainvoke(state, run_config)
+        return {**update, **await run_db_work(self._run_llm_sql, state, update["sql"])}
+
+    def _run_llm_sql(self, state: AgentState, sql) -> Dict[str, Any]:
+        # SQL_CACHE is shared by every user, so only statements that passed the guard and
+        # ran are kept; anything rejected or failing is dropped so it is regenerated
+        update, ok = self.execute.run_checked(current_db(), sql, state.phone_number)
+        cache_key = llm_cache_key(state.message)
+        if ok:
+            SQL_CACHE.set(cache_key, sql)
+        else:
+            SQL_CACHE.pop(cache_key)
+        return update
+
+    def _run_template(self, state: AgentState):
+        template = match_query_template(state.message)
+        db = current_db()
+        if not template or not db:
+            return None
+        statement, params = template
+        return {"sql": statement.text, **self.execute.run_statement(db, statement, params, state.phone_number)}
 
 
 # 6. Breakdown Formatter Tool
+_BREAKDOWN_SQL = sql_text("""
+    SELECT c.name, SUM(e.amount), COUNT(*), SUM(SUM(e.amount)) OVER () AS grand_total
+    FROM expenses e
+    JOIN categories c ON e.category_id = c.id
+    WHERE e.user_id = :user_id
+    GROUP BY c.name
+    ORDER BY SUM(e.amount) DESC
+""")
+
+
 class FormatBreakdownTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] FormatBreakdownTool invoked with state:", state)
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("FormatBreakdownTool invoked with state: %s", state)
         
         # Get user from database if not already in state
-        db: Any = state.get("db")
-        phone_number = state["phone_number"]
+        db: Any = current_db()
+        phone_number = state.phone_number
+
+        cached_output = BREAKDOWN_CACHE.get(phone_number)
+        if cached_output:
+            return {"final_response": cached_output}
         
         try:
-            db_user = crud.get_user_by_phone_number(db, phone_number) if db else None
-            if db and not db_user:
-                db_user = crud.create_user(db, user=models.User(phone_number=phone_number))
-            
-            user_id = db_user.id if db_user else None
+            user_id = get_or_create_user_id(db, phone_number)
             
             # Fix the linter error by being more explicit
             if user_id is None:
-                return {**state, "final_response": "I couldn't find your account. Please try logging an expense first."}
-            
-            query = """
-            SELECT c.name, SUM(e.amount), COUNT(*)
-            FROM expenses e
-            JOIN categories c ON e.category_id = c.id
-            WHERE e.user_id = :user_id
-            GROUP BY c.name
-            ORDER BY SUM(e.amount) DESC
-            """
+                return {"final_response": "I couldn't find your account. Please try logging an expense first."}
             
             if not db:
-                return {**state, "final_response": "I'm having trouble accessing your data right now. Please try again in a moment."}
+                return {"final_response": "I'm having trouble accessing your data right now. Please try again in a moment."}
             
-            from sqlalchemy import text as sql_text
-            result = db.execute(sql_text(query), {"user_id": user_id}).fetchall()
+            result = db.execute(_BREAKDOWN_SQL, {"user_id": user_id}).fetchall()
             
             if not result:
-                return {**state, "final_response": "You haven't logged any expenses yet! Start by telling me about a purchase you made."}
-
-            lines = ["📊 Your Spending Breakdown:"]
-            total = 0
-            for cat, amount, count in result:
-                total += amount
-                lines.append(f"• {cat.title()}: PKR {amount:,.0f} ({count} items)")
-            lines.append(f"\nTotal Spent: PKR {total:,.0f}")
-
-            output = "\n".join(lines)
-            print("[DEBUG] FormatBreakdownTool output:", output)
-            return {**state, "final_response": output}
+                return {"final_response": "You haven't logged any expenses yet! Start by telling me about a purchase you made."}
+
+            # grand_total is the same on every row, computed by the window function
+            rows = "\n".join(f"• {cat.title()}: PKR {amount:,.0f} ({count} items)" for cat, amount, count, _ in result)
+            output = f"📊 Your Spending Breakdown:\n{rows}\n\nTotal Spent: PKR {result[0][3]:,.0f}"
+            BREAKDOWN_CACHE.set(phone_number, output)
+            logger.debug("FormatBreakdownTool output: %s", output)
+            return {"final_response": output}
             
         except Exception as e:
-            print(f"[ERROR] FormatBreakdownTool: {e}")
-            return {**state, "final_response": "I'm having trouble getting your spending breakdown right now. Please try again!"}
+            logger.exception("FormatBreakdownTool: %s", e)
+            return {"final_response": "I'm having trouble getting your spending breakdown right now. Please try again!"}
 
 
 # 7. Chitchat Tool (Fallback for unknown intent)
 class ChitchatTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] ChitchatTool invoked with state:", state)
-        print("[DEBUG] ChitchatTool run_config db:", run_config.get('db'))
-        message = state["message"]
-        response = llm_client.chat.completions.create(
-            model=config.llm_model,
-            temperature=config.temperature,
-            max_tokens=config.max_tokens,
-            messages=[
-                {"role": "system", "content": (
-                    "You are a friendly financial assistant for expense tracking. "
-                    "Reply casually but helpfully to any general messages. "
-                    "Focus on expense tracking capabilities and be encouraging about financial management."
-                )},
-                {"role": "user", "content": message},
-            ]
-        )
-        reply = response.choices[0].message.content
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("ChitchatTool invoked with state: %s", state)
+        cache_key = llm_cache_key(state.message)
+        cached_reply = CHITCHAT_CACHE.get(cache_key)
+        if cached_reply:
+            return {"final_response": cached_reply}
+        return self._parse(cache_key, chat_completion(self._messages(state)).choices[0].message.content)
+
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        cache_key = llm_cache_key(state.message)
+        cached_reply = CHITCHAT_CACHE.get(cache_key)
+        if cached_reply:
+            return {"final_response": cached_reply}
+        reply, streamed = await areply_completion(self._messages(state))
+        return {**self._parse(cache_key, reply), "reply_streamed": streamed}
+
+    def _messages(self, state: AgentState):
+        return [
+            _CHITCHAT_SYS,
+            {"role": "user", "content": state.message},
+        ]
+
+    def _parse(self, cache_key: tuple, reply) -> Dict[str, Any]:
         if reply is None or not reply.strip():
-            print("[WARNING] ChitchatTool: LLM returned empty response. Using fallback.")
+            logger.warning("ChitchatTool: LLM returned empty response. Using fallback.")
             reply = "Hello! How can I help you with your expenses today?"
         else:
             reply = reply.strip()
-        print("[DEBUG] ChitchatTool output:", reply)
-        return {**state, "final_response": reply}
+            CHITCHAT_CACHE.set(cache_key, reply)
+        logger.debug("ChitchatTool output: %s", reply)
+        return {"final_response": reply}
 
 
 # 8. Respond Tool (Pass-through, for fallback/default end state)
 class RespondTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] RespondTool invoked with state:", state)
-        print("[DEBUG] RespondTool run_config db:", run_config.get('db'))
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("RespondTool invoked with state: %s", state)
         # Only pass through final_response or sql_result, do not generate fallback/template messages
-        if state.get("final_response"):
-            return state
-        elif state.get("sql_result") is not None:
-            return {**state, "final_response": str(state["sql_result"])}
+        if state.final_response:
+            return {}
+        elif state.sql_result is not None:
+            return {"final_response": str(state.sql_result)}
         else:
-            return state
+            return {}
 
 
 # Fix Query Response Tool to always use LLM
 class FormatQueryResponseTool(Runnable):
-    def invoke(self, state: Dict[str, Any], run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
-        print("[DEBUG] FormatQueryResponseTool invoked with state:", state)
-        
-        message = state["message"]
-        sql_result = state.get("sql_result")
-        
+    FALLBACK = "I'm having trouble with that right now. Could you try asking me something else about your expenses?"
+
+    def invoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
+        logger.debug("FormatQueryResponseTool invoked with state: %s", state)
+        try:
+            return self._parse(chat_completion(self._messages(state)).choices[0].message.content)
+        except Exception as e:
+            logger.exception("FormatQueryResponseTool: %s", e)
+            # Even error handling should be LLM-generated, but as a last resort fallback
+            return {"final_response": self.FALLBACK}
+
+    async def ainvoke(self, state: AgentState, run_config: Dict[str, Any] = {}) -> Dict[str, Any]:
         try:
-            # Always use LLM to format response, even for empty results
-            if sql_result is None:
-                format_prompt = f"""
+            reply, streamed = await areply_completion(self._messages(state))
+            return {**self._parse(reply), "reply_streamed": streamed}
+        except Exception as e:
+            logger.exception("FormatQueryResponseTool: %s", e)
+            return {"final_response": self.FALLBACK}
+
+    def _messages(self, state: AgentState):
+        message = state.message
+        sql_result = state.sql_result
+
+        # Always use LLM to format response, even for empty results
+        if sql_result is None:
+            format_prompt = f"""
 The user asked: "{message}"
 
 The database search didn't return any results - this means there are no expenses matching what they're looking for.
@@ -609,8 +1301,8 @@ Generate a natural, conversational response that:
 
 Be natural and conversational, not robotic.
 """
-            else:
-                format_prompt = f"""
+        else:
+            format_prompt = f"""
 The user asked: "{message}"
 
 The database returned this result: {sql_result}
@@ -623,28 +1315,32 @@ Format this into a natural, friendly response that:
 
 Respond as if you're talking directly to the user about their expenses.
 """
-            
-            response = llm_client.chat.completions.create(
-                model=config.llm_model,
-                temperature=config.temperature,
-                max_tokens=config.max_tokens,
-                messages=[
-                    {"role": "system", "content": "You are a helpful financial assistant that provides clear, friendly, conversational responses. Never use technical terms like 'data', 'query', 'criteria', 'records'. Talk like a friendly helper."},
-                    {"role": "user", "content": format_prompt},
-                ]
-            )
-            
-            formatted_response = response.choices[0].message.content
-            if formatted_response is None or not formatted_response.strip():
-                # This should rarely happen, but just in case
-                formatted_response = "I'm having trouble understanding that right now. Could you try asking in a different way?"
-            else:
-                formatted_response = formatted_response.strip()
-            
-            print("[DEBUG] FormatQueryResponseTool output:", formatted_response)
-            return {**state, "final_response": formatted_response}
-            
-        except Exception as e:
-            print(f"[ERROR] FormatQueryResponseTool: {e}")
-            # Even error handling should be LLM-generated, but as a last resort fallback
-            return {**state, "final_response": "I'm having trouble with that right now. Could you try asking me something else about your expenses?"}
\ No newline at end of file
+
+        return [
+            _FORMAT_QUERY_SYS,
+            {"role": "user", "content": format_prompt},
+        ]
+
+    def _parse(self, formatted_response) -> Dict[str, Any]:
+        if formatted_response is None or not formatted_response.strip():
+            # This should rarely happen, but just in case
+            formatted_response = "I'm having trouble understanding that right now. Could you try asking in a different way?"
+        else:
+            formatted_response = formatted_response.strip()
+
+        logger.debug("FormatQueryResponseTool output: %s", formatted_response)
+        return {"final_response": formatted_response}
+
+
+# Stateless tools shared by the graph and any direct callers
+INTENT_TOOL = IntentTool()
+EXTRACT_EXPENSE_TOOL = ExtractExpenseTool()
+COMBINED_INTENT_EXTRACT_TOOL = CombinedIntentExtractTool()
+CREATE_EXPENSE_TOOL = CreateExpenseTool()
+GENERATE_SQL_TOOL = GenerateSQLTool()
+EXECUTE_SQL_TOOL = ExecuteSQLTool()
+QUERY_SQL_TOOL = QuerySQLTool()
+FORMAT_BREAKDOWN_TOOL = FormatBreakdownTool()
+CHITCHAT_TOOL = ChitchatTool()
+RESPOND_TOOL = RespondTool()
+FORMAT_QUERY_TOOL = FormatQueryResponseTool()
@@ -0,0 +1,84 @@
+# llm_json.py
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is the fallback
+    orjson = None
+try:
+    import json5
+except ImportError:  # optional; only tried when strict parsing fails
+    json5 = None
+
+_RE_FENCE_LANG = re.compile(r'```(?:json)?\s*')
+_RE_FENCE = re.compile(r'```\s*')
+
+
+def _extract_json_object(text: str) -> str:
+    """Return the first balanced {...} in text, ignoring braces inside strings"""
+    depth = 0
+    start = -1
+    in_str = False
+    esc = False
+    for i, c in enumerate(text):
+        if in_str:
+            if esc:
+                esc = False
+            elif c == '\\':
+                esc = True
+            elif c == '"':
+                in_str = False
+            continue
+        if c == '"':
+            in_str = True
+        elif c == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return "{}"
+
+
+def loads_json(text: str):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def clean_json_response(raw_response: str) -> str:
+    """Clean LLM response to extract valid JSON"""
+    if not raw_response:
+        return "{}"
+    
+    # Remove markdown code blocks
+    if "```" in raw_response:
+        raw_response = _RE_FENCE_LANG.sub('', raw_response)
+        raw_response = _RE_FENCE.sub('', raw_response)
+    
+    # Python-style {'intent': 'query'} output: only convert quotes when there are no
+    # double quotes at all, so apostrophes inside JSON strings ("men's shoes") survive
+    if "'" in raw_response and '"' not in raw_response:
+        raw_response = raw_response.replace("'", '"')
+    
+    return _extract_json_object(raw_response)
+
+
+def parse_llm_json(raw: str):
+    """Parse an LLM JSON reply: strict parse first, then after clean_json_response,
+    then with json5 (if installed) for trailing commas and the like. Raises ValueError."""
+    try:
+        return loads_json(raw)
+    except ValueError:
+        pass
+    cleaned = clean_json_response(raw)
+    try:
+        return loads_json(cleaned)
+    except ValueError:
+        if json5 is None:
+            raise
+    return json5.loads(cleaned)
@@ -1,73 +1,127 @@
 # main.py
 
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import func, text
 from . import crud, models, schemas
 from .database import SessionLocal, engine, get_db
 from .services import llm_service, whatsapp_service
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from fastapi.responses import FileResponse
-from app.intelligent_agent_v3.agent_v3 import process_message_with_agent_v3
+from app.intelligent_agent_v3.agent_v3 import aprocess_message_with_agent_v3
+from app.intelligent_agent_v3.tools import close_llm_clients
+from contextlib import asynccontextmanager
+import anyio
+import logging
 import os
 from dotenv import load_dotenv
 
-models.Base.metadata.create_all(bind=engine)
+load_dotenv()
+# Environment is read once at import; handlers only use these constants
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+# Deployments that manage the schema themselves set AUTO_CREATE_TABLES=false (and then run
+# models.create_missing_indexes, or the equivalent CREATE INDEX IF NOT EXISTS, on upgrade)
+AUTO_CREATE_TABLES = os.getenv("AUTO_CREATE_TABLES", "true").lower() == "true"
 
-app = FastAPI()
+# Level comes from LOG_LEVEL; debug messages are lazily formatted, so at INFO they cost a level check
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger("expensebot.main")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sync endpoints, run_in_threadpool and the agent's DB work (tools.run_db_work, which keeps
+    # sync SQLAlchemy off the event loop in the async webhook) share anyio's thread limiter
+    # (40 by default); raise it so concurrent turns don't queue behind each other
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    if AUTO_CREATE_TABLES:
+        models.Base.metadata.create_all(bind=engine)
+        models.create_missing_indexes(engine)
+    yield
+    await close_llm_clients()
+    llm_service.close_client()
+
+app = FastAPI(lifespan=lifespan)
 
 class WebhookPayload(BaseModel):
     phone_number: str
     message_body: str
-    timestamp: str # Or use datetime
+    timestamp: datetime
 
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Expense Tracker API"}
 
 @app.post("/webhook")
-def handle_webhook(payload: WebhookPayload, db: Session = Depends(get_db)):
-    print(f"🔍 DEBUG: Using intelligent agent V3 for message: {payload.message_body}")
-    print(db)
-    agent_response = process_message_with_agent_v3(
+async def handle_webhook(payload: WebhookPayload, background_tasks: BackgroundTasks, background: bool = False, db: Session = Depends(get_db)):
+    # ?background=true acks at once and replies over WhatsApp afterwards; WhatsApp
+    # providers only need a fast 200, while the chat page needs the reply in the response
+    if background:
+        background_tasks.add_task(_process_in_background, payload)
+        return {"status": "accepted"}
+    return await _process_and_reply(payload, db)
+
+async def _process_in_background(payload: WebhookPayload):
+    # The request-scoped session is closed once the response is sent, so use a fresh one
+    db = SessionLocal()
+    try:
+        await _process_and_reply(payload, db)
+    except Exception as e:
+        logger.exception("Background webhook processing failed: %s", e)
+    finally:
+        db.close()
+
+async def _process_and_reply(payload: WebhookPayload, db: Session) -> dict:
+    logger.debug("Using intelligent agent V3 for message: %s", payload.message_body)
+    async def send_chunk(text: str):
+        await whatsapp_service.asend_whatsapp_message(to=str(payload.phone_number), message=text)
+
+    agent_response = await aprocess_message_with_agent_v3(
         phone_number=payload.phone_number,
         message=payload.message_body,
-        db=db
+        db=db,
+        on_reply_chunk=send_chunk
     )
-    print(f"🔍 DEBUG: Agent V3 response: {agent_response}")
+    logger.debug("Agent V3 response: %s", agent_response)
     if agent_response and agent_response.get("message"):
-        print(f"🔍 DEBUG: Using intelligent agent V3 response: {agent_response['message']}")
-        whatsapp_service.send_whatsapp_message(to=str(payload.phone_number), message=agent_response["message"])
+        if not agent_response.get("streamed"):
+            await send_chunk(agent_response["message"])
         return {"status": "ok", "message": agent_response["message"], "intent": agent_response.get("intent")}
     else:
         msg = "Sorry, I couldn't process your request. Please try again."
-        whatsapp_service.send_whatsapp_message(to=str(payload.phone_number), message=msg)
+        await send_chunk(msg)
         return {"status": "error", "message": msg}
 
 @app.get("/expenses")
 def list_expenses(phone_number: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_phone_number(db, phone_number=phone_number)
-    if not db_user:
+    user_id = crud.get_user_id_by_phone_number(db, phone_number=phone_number)
+    if user_id is None:
         raise HTTPException(status_code=404, detail="User not found")
-    expenses = db.query(models.Expense).filter(models.Expense.user_id == db_user.id).all()
-    result = []
-    for exp in expenses:
-        category = db.query(models.Category).filter(models.Category.id == exp.category_id).first()
-        result.append({
-            "amount": exp.amount,
-            "category": category.name if category else None,
-            "note": exp.note,
-            "timestamp": exp.timestamp
-        })
+    # Plain column tuples with the category name joined in: no ORM objects, no per-row lookups
+    rows = db.query(
+        models.Expense.amount, models.Category.name, models.Expense.note, models.Expense.timestamp
+    ).outerjoin(
+        models.Category, models.Category.id == models.Expense.category_id
+    ).filter(models.Expense.user_id == user_id).all()
+    result = [
+        {
+            "amount": amount,
+            "category": category_name,
+            "note": note,
+            "timestamp": timestamp
+        }
+        for amount, category_name, note, timestamp in rows
+    ]
     return {"phone_number": phone_number, "expenses": result}
 
+SUMMARY_EMOJI = {"transport": "🚗", "electronics": "💻", "lunch": "🍔", "purchases": "🛒", "groceries": "🛍️", "entertainment": "🎬", "health": "💊"}
+
 @app.get("/trigger_summary")
-def trigger_summary(phone_number: str, summary_type: str = "weekly", db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_phone_number(db, phone_number=phone_number)
-    if not db_user:
+def trigger_summary(phone_number: str, summary_type: str = "weekly", send: bool = True, db: Session = Depends(get_db)):
+    # send=false only builds the summary, so batch jobs can fan the sends out themselves
+    user_id = crud.get_user_id_by_phone_number(db, phone_number=phone_number)
+    if user_id is None:
         raise HTTPException(status_code=404, detail="User not found")
-    user_id = getattr(db_user, "id")
     now = datetime.utcnow()
     if summary_type == "monthly":
         start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -77,49 +131,54 @@ def trigger_summary(phone_number: str, summary_type: str = "weekly", db: Session
         end_date = now
         start_date = end_date - timedelta(days=7)
         period_label = "Weekly"
-    expenses: list[models.Expense] = db.query(models.Expense).filter(
+    period_filter = (
         models.Expense.user_id == user_id,
         models.Expense.timestamp >= start_date,
         models.Expense.timestamp < end_date
-    ).all()
-    if not expenses:
+    )
+    # Aggregate by category in SQL, largest first
+    category_name = func.coalesce(models.Category.name, "unknown")
+    category_total = func.sum(models.Expense.amount)
+    category_totals = db.query(category_name, category_total).outerjoin(
+        models.Category, models.Category.id == models.Expense.category_id
+    ).filter(*period_filter).group_by(category_name).order_by(category_total.desc()).all()
+    if not category_totals:
         msg = f"No expenses found for the {summary_type} period."
-        whatsapp_service.send_whatsapp_message(to=str(db_user.phone_number), message=msg)
+        if send:
+            whatsapp_service.send_whatsapp_message(to=str(phone_number), message=msg)
         return {"status": "ok", "summary": msg}
-    # Aggregate by category
-    category_totals = {}
-    for exp in expenses:
-        category = db.query(models.Category).filter(models.Category.id == exp.category_id).first()
-        cat_name = category.name if category else "unknown"
-        category_totals[cat_name] = category_totals.get(cat_name, 0) + exp.amount
-    total = sum(category_totals.values())
+    total = sum(amount for _, amount in category_totals)
     # Top categories
-    top_categories = sorted(category_totals.items(), key=lambda x: x[1], reverse=True)[:3]
-    # Biggest single expense
-    amounts = [float(getattr(e, "amount", 0.0)) for e in expenses]
-    max_index = amounts.index(max(amounts))
-    biggest_expense = expenses[max_index]
-    biggest_expense_cat = db.query(models.Category).filter(models.Category.id == biggest_expense.category_id).first()
+    top_categories = category_totals[:3]
+    # Biggest single expense: only the two columns the prompt uses, not a full ORM row
+    biggest_amount, biggest_expense_cat = db.query(models.Expense.amount, models.Category.name).outerjoin(
+        models.Category, models.Category.id == models.Expense.category_id
+    ).filter(*period_filter).order_by(models.Expense.amount.desc()).limit(1).one()
     # Average per day
     days = max((end_date - start_date).days, 1)
     avg_per_day = total / days
     # Prepare bullet points
     bullet_points = []
-    emoji_map = {"transport": "🚗", "electronics": "💻", "lunch": "🍔", "purchases": "🛒", "groceries": "🛍️", "entertainment": "🎬", "health": "💊"}
     for cat, amt in top_categories:
-        emoji = emoji_map.get(cat.lower(), "•")
+        emoji = SUMMARY_EMOJI.get(cat.lower(), "•")
         bullet_points.append(f"{emoji} {cat.title()}: PKR {amt:,.0f}")
     # LLM prompt for concise, bullet-pointed summary
     summary_prompt = (
         f"{period_label} Expense Summary:\n"
         f"Total: PKR {total:,.0f}\n"
         f"Top Categories:\n" + "\n".join(bullet_points) + "\n"
-        f"Biggest single expense: PKR {biggest_expense.amount:,.0f} ({biggest_expense_cat.name.title() if biggest_expense_cat else 'unknown'})\n"
+        f"Biggest single expense: PKR {biggest_amount:,.0f} ({biggest_expense_cat.title() if biggest_expense_cat else 'unknown'})\n"
         f"Average per day: PKR {avg_per_day:,.0f}\n"
         f"Respond ONLY with a concise, bullet-pointed WhatsApp message using emojis and line breaks."
     )
-    summary = llm_service.format_summary_with_llm(summary_prompt)
-    whatsapp_service.send_whatsapp_message(to=str(db_user.phone_number), message=summary)
+    if send:
+        # Stream the summary out line by line instead of waiting for the whole completion
+        summary = llm_service.format_summary_with_llm(
+            summary_prompt,
+            on_chunk=lambda text: whatsapp_service.send_whatsapp_message(to=str(phone_number), message=text)
+        )
+    else:
+        summary = llm_service.format_summary_with_llm(summary_prompt)
     return {"status": "ok", "summary": summary, "raw": summary_prompt}
 
 @app.get("/chat")
@@ -1,6 +1,6 @@
 # models.py
 
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -11,8 +11,9 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     phone_number = Column(String, unique=True, index=True, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    expenses = relationship("Expense", back_populates="user")
-    categories = relationship("Category", back_populates="user")
+    # Collections never lazy-load: a query that needs them must ask with selectinload(...)
+    expenses = relationship("Expense", back_populates="user", lazy="raise")
+    categories = relationship("Category", back_populates="user", lazy="raise")
 
 class Category(Base):
     __tablename__ = "categories"
@@ -23,11 +24,16 @@ class Category(Base):
     is_custom = Column(Boolean, default=False)
 
     user = relationship("User", back_populates="categories")
-    expenses = relationship("Expense", back_populates="category")
+    expenses = relationship("Expense", back_populates="category", lazy="raise")
 
 
 class Expense(Base):
     __tablename__ = "expenses"
+    # Per-user date-range scans (summaries) and per-user category joins (breakdowns)
+    __table_args__ = (
+        Index("ix_expense_user_ts", "user_id", "timestamp"),
+        Index("ix_expense_user_cat", "user_id", "category_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -38,3 +44,12 @@ class Expense(Base):
 
     user = relationship("User", back_populates="expenses")
     category = relationship("Category", back_populates="expenses")
+
+
+def create_missing_indexes(bind) -> None:
+    """Create every declared index the database doesn't have yet (CREATE INDEX IF NOT
+    EXISTS in effect). create_all skips tables that already exist, so an index added to
+    a model later never reaches an existing database without this."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
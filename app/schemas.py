@@ -1,6 +1,6 @@
 # schemas.py
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime
 from typing import Optional, List
 
@@ -18,8 +18,7 @@ class Expense(ExpenseBase):
     user_id: int
     timestamp: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Category Schemas
 class CategoryBase(BaseModel):
@@ -34,8 +33,7 @@ class Category(CategoryBase):
     user_id: Optional[int] = None
     expenses: List[Expense] = []
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 # User Schemas
 class UserBase(BaseModel):
@@ -50,5 +48,4 @@ class User(UserBase):
     expenses: List[Expense] = []
     categories: List[Category] = []
 
-    class Config:
-        orm_mode = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
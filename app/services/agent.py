@@ -10,15 +10,33 @@ This module implements the next-gen, context-aware, multi-turn conversational ag
 # from langchain.tools import ...
 
 import logging
-from datetime import datetime
-from collections import defaultdict, deque
+import time
+from collections import deque, namedtuple
 import re
+from app.cache import TTLCache
 
 logger = logging.getLogger("expensebot.agent")
 logger.setLevel(logging.INFO)
 
-# In-memory short-term context (per user)
-SESSION_CONTEXT = defaultdict(lambda: deque(maxlen=5))  # Last 5 messages per user
+# One remembered message; a tuple is far smaller than a dict per entry
+ContextMessage = namedtuple("ContextMessage", "sender text ts")
+USER, BOT = "user", "bot"
+
+# In-memory short-term context: last 5 messages per user, dropped after 30 idle minutes
+SESSION_CONTEXT = TTLCache(maxsize=10_000, ttl=1800)
+
+# Keyword rules for detect_intent, checked in order; each is one compiled alternation.
+# Keywords must start a word; greetings must also end one, so "this", "high" and
+# "history" are not a "hi".
+INTENT_PATTERNS = (
+    ("greeting", re.compile(r"\b(hi|hello|hey|salaam|assalam)\b")),
+    ("thanks", re.compile(r"\b(thank|shukriya)")),
+    ("joke", re.compile(r"\b(joke|funny|laugh)")),
+    ("repeat", re.compile(r"\b(again|repeat|previous|last time)")),
+    # Detect introductions (e.g., "I am Maaz", "My name is Maaz", "I'm Maaz")
+    ("introduction", re.compile(r"\b(i am|i'm|my name is|this is)\b")),
+)
+NAME_RE = re.compile(r"(?:i am|i'm|my name is|this is)\s+([a-zA-Z]+)", re.IGNORECASE)
 
 class IntelligentExpenseAgent:
     """
@@ -30,18 +48,14 @@ class IntelligentExpenseAgent:
 
     def detect_intent(self, message):
         """Very basic intent detection for demo; replace with LLM or LangChain later."""
-        msg = message.lower().strip()
-        if any(greet in msg for greet in ["hi", "hello", "hey", "salaam", "assalam"]):
-            return "greeting"
-        if any(kw in msg for kw in ["thank", "thanks", "shukriya"]):
-            return "thanks"
-        if any(kw in msg for kw in ["joke", "funny", "laugh"]):
-            return "joke"
-        if any(kw in msg for kw in ["again", "repeat", "previous", "last time"]):
-            return "repeat"
-        # Detect introductions (e.g., "I am Maaz", "My name is Maaz", "I'm Maaz")
-        if re.search(r"\b(i am|i'm|my name is|this is)\b", msg):
-            return "introduction"
+        # The patterns only look for word starts, so surrounding whitespace needs no strip()
+        return self._detect_intent_lowered(message.lower())
+
+    def _detect_intent_lowered(self, msg):
+        # msg is already lowercased by the caller, which lowercases each message once
+        for intent, pattern in INTENT_PATTERNS:
+            if pattern.search(msg):
+                return intent
         # Add more rules or LLM call here
         return "other"
 
@@ -54,14 +68,14 @@ class IntelligentExpenseAgent:
             return "Why did the wallet go to therapy? It lost its sense of balance! 😄"
         if intent == "repeat":
             # Use context to repeat last bot message
-            history = self.session_context[phone_number]
+            history = self.session_context.get(phone_number, ())
             for msg in reversed(history):
-                if msg["sender"] == "bot":
-                    return f"Here's what I said earlier: {msg['text']}"
+                if msg.sender == BOT:
+                    return f"Here's what I said earlier: {msg.text}"
             return "I don't have anything recent to repeat, but I'm here to help!"
         if intent == "introduction":
             # Try to extract the user's name
-            match = re.search(r"(?:i am|i'm|my name is|this is)\s+([a-zA-Z]+)", message, re.IGNORECASE)
+            match = NAME_RE.search(message)
             if match:
                 name = match.group(1)
                 return f"Nice to meet you, {name}! 😊 I'm here to help you track your expenses."
@@ -69,18 +83,24 @@ class IntelligentExpenseAgent:
         return None
 
     def update_context(self, phone_number, sender, text):
-        self.session_context[phone_number].append({"sender": sender, "text": text, "timestamp": datetime.utcnow().isoformat()})
+        history = self.session_context.get(phone_number)
+        if history is None:
+            history = deque(maxlen=5)
+        history.append(ContextMessage(sender, text, time.time()))
+        # set() again even for an existing deque, so the idle timeout restarts
+        self.session_context.set(phone_number, history)
 
     def run(self, message_body, phone_number, timestamp):
-        logger.info(f"Received message from {phone_number} at {timestamp}: {message_body}")
-        self.update_context(phone_number, "user", message_body)
-        intent = self.detect_intent(message_body)
-        logger.info(f"Detected intent: {intent}")
+        logger.info("Received message from %s at %s: %s", phone_number, timestamp, message_body)
+        self.update_context(phone_number, USER, message_body)
+        intent = self._detect_intent_lowered(message_body.lower())
+        logger.info("Detected intent: %s", intent)
         chitchat_response = self.handle_chitchat(intent, message_body, phone_number)
         if chitchat_response:
-            logger.info(f"Chitchat response: {chitchat_response}")
-            self.update_context(phone_number, "bot", chitchat_response)
-            return {"message": chitchat_response}
+            logger.info("Chitchat response: %s", chitchat_response)
+            self.update_context(phone_number, BOT, chitchat_response)
+            # Same shape as llm_service.process_user_message, so callers can skip the LLM
+            return {"message": chitchat_response, "intent": intent, "expenses": None, "query": None, "source": "rule"}
         # TODO: Add expense logging, query, and memory logic here
         logger.info("No chitchat matched; passing to main bot logic.")
         return None
@@ -1,14 +1,60 @@
 import os
-import json
+import copy
+import logging
+import re
+from functools import lru_cache
+import httpx
 from groq import Groq
+from sqlalchemy import text as sql_text
 from dotenv import load_dotenv
+from app.cache import TTLCache, normalize_message
+from app.expense_rules import extract_simple_expense
+from app.llm_json import parse_llm_json
 
 load_dotenv()
 
-client = Groq(
-    api_key=os.environ.get("GROQ_API_KEY"),
-)
+logger = logging.getLogger("expensebot.services.llm_service")
+
+# One pooled HTTP client so calls reuse warm keep-alive connections;
+# HTTP/2 needs the optional h2 package, without it httpx stays on HTTP/1.1
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+
+# Built on first use, so importing this module (or a worker that never summarises)
+# opens no sockets, and each worker process creates its own after any fork
+@lru_cache(maxsize=1)
+def get_client() -> Groq:
+    return Groq(
+        api_key=os.environ.get("GROQ_API_KEY"),
+        http_client=httpx.Client(http2=_HTTP2, timeout=_HTTP_TIMEOUT, limits=_HTTP_LIMITS),
+    )
+
+def close_client() -> None:
+    """Close the pooled Groq connections, if any were opened; called on app shutdown"""
+    if get_client.cache_info().currsize:
+        get_client().close()
+        get_client.cache_clear()
 
+MODEL = "llama3-8b-8192"
+# Classification and short formatting go to the fast 8B model, SQL to the stronger 70B one;
+# USE_GROQ_FAST=false keeps every call on MODEL
+USE_GROQ_FAST = os.getenv("USE_GROQ_FAST", "true").lower() == "true"
+MODEL_FAST = "llama-3.1-8b-instant" if USE_GROQ_FAST else MODEL
+MODEL_SQL = "llama-3.3-70b-versatile" if USE_GROQ_FAST else MODEL
+
+# In-process response caches keyed by (model, input); message keys are normalized, so
+# rephrasings that differ only in case, punctuation or emoji hit the same entry
+MESSAGE_CACHE = TTLCache(maxsize=2048, ttl=3600)
+SQL_CACHE = TTLCache(maxsize=2048, ttl=24 * 3600)
+SUMMARY_CACHE = TTLCache(maxsize=512, ttl=3600)
+
+# System prompts are byte-for-byte static, with per-user values only in bound parameters
+# or the user message, so the provider can reuse the prompt prefix across requests.
 SYSTEM_PROMPT = (
     "You are an intelligent expense tracker assistant. "
     "Given a user's WhatsApp message, classify the intent as one of: 'expense_logging', 'query', 'breakdown', or 'management'. "
@@ -26,77 +72,146 @@ SYSTEM_PROMPT = (
     "}\n"
     "(If intent is not expense_logging, set 'expenses' to null. If intent is not query, set 'query' to null.)"
 )
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+def parse_simple_expense(message: str):
+    """Rule-based result for a single "item amount" log whose item names a known
+    category ("lunch 800", "fuel 1.5k"), or None; "last 5" or "page 2" go to the LLM"""
+    expenses = extract_simple_expense(message)
+    if not expenses:
+        return None
+    return {
+        "intent": "expense_logging",
+        "expenses": expenses,
+        "query": None,
+        "source": "rule",
+    }
+
+# Breakdown requests need no classification: generate_breakdown_sql is deterministic given the period.
+# "spending"/"spent" alone are left to the LLM, since most such messages are specific queries.
+_BREAKDOWN_RE = re.compile(r"\b(breakdown|by category)\b", re.IGNORECASE)
+_BREAKDOWN_PERIOD_RE = re.compile(r"\b(week|month)\b", re.IGNORECASE)
+
+def parse_breakdown_request(message: str):
+    """Rule-based result for a breakdown request, carrying a generate_breakdown_sql time_period, or None"""
+    if not _BREAKDOWN_RE.search(message):
+        return None
+    period = _BREAKDOWN_PERIOD_RE.search(message)
+    return {
+        "intent": "breakdown",
+        "expenses": None,
+        "query": None,
+        "time_period": period.group(1).lower() if period else "all",
+        "source": "rule",
+    }
 
 def process_user_message(message: str) -> dict:
-    chat_completion = client.chat.completions.create(
+    rule_result = parse_simple_expense(message) or parse_breakdown_request(message)
+    if rule_result:
+        return rule_result
+    cache_key = (MODEL_FAST, normalize_message(message))
+    cached = MESSAGE_CACHE.get(cache_key)
+    if cached is not None:
+        # Callers may edit the result, so never hand out the cached dict itself
+        return copy.deepcopy(cached)
+    chat_completion = get_client().chat.completions.create(
         messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
+            _SYSTEM_MSG,
             {"role": "user", "content": message},
         ],
-        model="llama3-8b-8192",
+        model=MODEL_FAST,
         temperature=0.2,
-        max_tokens=512,
+        # The JSON is small; 256 still fits several expense tuples
+        max_tokens=256,
     )
     response = chat_completion.choices[0].message.content
     if not response:
         return {"intent": "unknown", "expenses": None, "query": None, "raw": ""}
     try:
-        # Try to parse the response as JSON (replace single quotes with double quotes for safety)
-        response_json = json.loads(response.replace("'", '"'))
+        # Strict JSON first; fences, prose around the object and single-quoted
+        # output are only handled on the fallback path, so "McDonald's" survives
+        response_json = parse_llm_json(response)
+        MESSAGE_CACHE.set(cache_key, copy.deepcopy(response_json))
         return response_json
     except Exception as e:
-        print(f"[LLM Service] Failed to parse LLM response: {response}\nError: {e}")
+        logger.error("Failed to parse LLM response: %.200s (%s)", response, e)
         return {"intent": "unknown", "expenses": None, "query": None, "raw": response}
 
-def generate_sql_from_query(user_message: str, user_id: int) -> str:
-    sql_prompt = (
-        f"You are an intelligent SQL agent for a personal expense tracker. "
-        f"The user's data is in a PostgreSQL database with the following tables: users(id, phone_number, created_at), categories(id, name, user_id, is_custom), expenses(id, user_id, category_id, amount, timestamp, note). "
-        f"The user's id is {user_id}. "
-        f"When matching category names, use ILIKE for case-insensitive comparison. "
-        f"Use COALESCE(SUM(amount), 0) to handle null values. "
-        f"Format dates nicely using to_char(timestamp, 'Month DD, YYYY'). "
-        f"Order results logically (most recent first, highest amounts first, etc.). "
-        f"Limit results to reasonable numbers (5-10 rows max). "
-        f"Use meaningful column aliases. "
-        f"Given the user's question, generate a single SQL SELECT statement that answers it naturally and completely. "
-        f"Respond ONLY with the SQL statement, no explanation."
-    )
-    chat_completion = client.chat.completions.create(
+SQL_PROMPT = (
+    "You are an intelligent SQL agent for a personal expense tracker. "
+    "The user's data is in a PostgreSQL database with the following tables: users(id, phone_number, created_at), categories(id, name, user_id, is_custom), expenses(id, user_id, category_id, amount, timestamp, note). "
+    "Always filter expenses with e.user_id = :user_id exactly as written; it is a bound parameter, never inline a number. "
+    "When matching category names, use ILIKE for case-insensitive comparison. "
+    "Use COALESCE(SUM(amount), 0) to handle null values. "
+    "Format dates nicely using to_char(timestamp, 'Month DD, YYYY'). "
+    "Order results logically (most recent first, highest amounts first, etc.). "
+    "Limit results to reasonable numbers (5-10 rows max). "
+    "Use meaningful column aliases. "
+    "Given the user's question, generate a single SQL SELECT statement that answers it naturally and completely. "
+    "Respond ONLY with the SQL statement, no explanation."
+)
+_SQL_MSG = {"role": "system", "content": SQL_PROMPT}
+
+def generate_sql_from_query(user_message: str, user_id: int):
+    """SQL and bind parameters answering the question: db.execute(sql_text(sql), params).
+    The SQL uses :user_id, never the id itself, so it is cached for every user."""
+    params = {"user_id": user_id}
+    cache_key = (MODEL_SQL, normalize_message(user_message))
+    cached = SQL_CACHE.get(cache_key)
+    if cached is not None:
+        return cached, params
+    chat_completion = get_client().chat.completions.create(
         messages=[
-            {"role": "system", "content": sql_prompt},
+            _SQL_MSG,
             {"role": "user", "content": user_message},
         ],
-        model="llama3-8b-8192",
+        model=MODEL_SQL,
         temperature=0.1,
         max_tokens=256,
     )
     sql = chat_completion.choices[0].message.content
     if sql:
-        return sql.strip()
-    return ""
+        sql = sql.strip()
+        SQL_CACHE.set(cache_key, sql)
+        return sql, params
+    return "", params
 
-def generate_breakdown_sql(user_id: int, time_period: str = "all") -> str:
-    """Generate SQL for expense breakdown by category"""
-    if time_period == "week":
-        time_filter = "AND timestamp >= NOW() - INTERVAL '7 days'"
-    elif time_period == "month":
-        time_filter = "AND timestamp >= NOW() - INTERVAL '1 month'"
-    else:
-        time_filter = ""
-    
-    sql = f"""
+_BREAKDOWN_TIME_FILTERS = {
+    "week": "AND timestamp >= NOW() - INTERVAL '7 days'",
+    "month": "AND timestamp >= NOW() - INTERVAL '1 month'",
+}
+
+# One statement per period, with user_id bound, so the text (and its cached plan) is shared by every user
+_BREAKDOWN_SQL = {
+    period: sql_text(f"""
     SELECT 
         c.name as category,
         SUM(e.amount) as total_amount,
         COUNT(*) as transaction_count
     FROM expenses e
     JOIN categories c ON e.category_id = c.id
-    WHERE e.user_id = {user_id} {time_filter}
+    WHERE e.user_id = :user_id {time_filter}
     GROUP BY c.name
     ORDER BY total_amount DESC
-    """
-    return sql.strip()
+    """)
+    for period, time_filter in (*_BREAKDOWN_TIME_FILTERS.items(), ("all", ""))
+}
+
+def generate_breakdown_sql(user_id: int, time_period: str = "all"):
+    """SQL and bind parameters for an expense breakdown by category: db.execute(*generate_breakdown_sql(...))"""
+    return _BREAKDOWN_SQL.get(time_period, _BREAKDOWN_SQL["all"]), {"user_id": user_id}
+
+_BREAKDOWN_EMOJI = {
+    "transport": "🚗", "electronics": "💻", "lunch": "🍔", 
+    "purchases": "🛒", "groceries": "🛍️", "entertainment": "🎬", 
+    "health": "💊", "food": "🍕", "coffee": "☕", "shopping": "🛍️"
+}
+_DEFAULT_EMOJI = "💰"
+_BREAKDOWN_PERIOD_TEXT = {
+    "all": "all time",
+    "week": "this week", 
+    "month": "this month"
+}
 
 def format_breakdown_result(result, time_period: str = "all") -> str:
     """Format breakdown results into a user-friendly message"""
@@ -104,47 +219,86 @@ def format_breakdown_result(result, time_period: str = "all") -> str:
         period_text = "this period" if time_period != "all" else "any period"
         return f"No expenses found for {period_text}."
     
-    total = sum(row.total_amount for row in result)
-    period_text = {
-        "all": "all time",
-        "week": "this week", 
-        "month": "this month"
-    }.get(time_period, "this period")
-    
-    # Format breakdown with emojis
-    emoji_map = {
-        "transport": "🚗", "electronics": "💻", "lunch": "🍔", 
-        "purchases": "🛒", "groceries": "🛍️", "entertainment": "🎬", 
-        "health": "💊", "food": "🍕", "coffee": "☕", "shopping": "🛍️"
-    }
+    period_text = _BREAKDOWN_PERIOD_TEXT.get(time_period, "this period")
     
+    # Total and lines in one pass over the rows
+    total = 0.0
     breakdown_lines = []
+    append = breakdown_lines.append
+    emoji_get = _BREAKDOWN_EMOJI.get
     for row in result:
-        emoji = emoji_map.get(row.category.lower(), "💰")
-        breakdown_lines.append(f"{emoji} {row.category.title()}: PKR {row.total_amount:,.0f} ({row.transaction_count} transactions)")
-    
+        category, amount = row.category, row.total_amount
+        total += amount
+        append(f"{emoji_get(category.lower(), _DEFAULT_EMOJI)} {category.title()}: PKR {amount:,.0f} ({row.transaction_count} transactions)")
     breakdown_text = "\n".join(breakdown_lines)
     
     return f"📊 Your spending breakdown for {period_text}:\n\nTotal: PKR {total:,.0f}\n\n{breakdown_text}"
 
-def format_summary_with_llm(summary_prompt: str) -> str:
-    system_prompt = (
-        "You are a financial assistant. When given a summary prompt, respond ONLY with a short, friendly, bullet-pointed WhatsApp message using emojis and line breaks. "
-        "Do NOT return JSON or any structured data. Here is an example:\n"
-        "Prompt: Weekly Expense Summary:\nTotal: PKR 10,000\nTop Categories:\n🚗 Transport: PKR 5,000\n🍔 Lunch: PKR 3,000\n🛒 Purchases: PKR 2,000\nBiggest single expense: PKR 5,000 (Transport)\nAverage per day: PKR 1,428\nRespond ONLY with a concise, bullet-pointed WhatsApp message using emojis and line breaks.\n"
-        "Response: \n"
-        "Your Weekly Summary 🗓️\nTotal: PKR 10,000\n• 🚗 Transport: PKR 5,000\n• 🍔 Lunch: PKR 3,000\n• 🛒 Purchases: PKR 2,000\nBiggest expense: PKR 5,000 (Transport)\nAvg/day: PKR 1,428\n"
-    )
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": summary_prompt},
-        ],
-        model="llama3-8b-8192",
+SUMMARY_SYSTEM_PROMPT = (
+    "You are a financial assistant. When given a summary prompt, respond ONLY with a short, friendly, bullet-pointed WhatsApp message using emojis and line breaks. "
+    "Do NOT return JSON or any structured data. Here is an example:\n"
+    "Prompt: Weekly Expense Summary:\nTotal: PKR 10,000\nTop Categories:\n🚗 Transport: PKR 5,000\n🍔 Lunch: PKR 3,000\n🛒 Purchases: PKR 2,000\nBiggest single expense: PKR 5,000 (Transport)\nAverage per day: PKR 1,428\nRespond ONLY with a concise, bullet-pointed WhatsApp message using emojis and line breaks.\n"
+    "Response: \n"
+    "Your Weekly Summary 🗓️\nTotal: PKR 10,000\n• 🚗 Transport: PKR 5,000\n• 🍔 Lunch: PKR 3,000\n• 🛒 Purchases: PKR 2,000\nBiggest expense: PKR 5,000 (Transport)\nAvg/day: PKR 1,428\n"
+)
+_SUMMARY_MSG = {"role": "system", "content": SUMMARY_SYSTEM_PROMPT}
+
+# Streamed text is handed on in pieces of at least this many characters, cut at a line end
+_SUMMARY_CHUNK_MIN = 80
+
+def format_summary_with_llm(summary_prompt: str, on_chunk=None) -> str:
+    """Summary message for summary_prompt. With on_chunk, the completion is streamed and
+    on_chunk receives the whole message in line-aligned pieces as they arrive."""
+    # The prompt carries every figure, so an unchanged period re-uses the earlier wording
+    cache_key = (MODEL_FAST, summary_prompt)
+    cached = SUMMARY_CACHE.get(cache_key)
+    if cached is not None:
+        if on_chunk:
+            on_chunk(cached)
+        return cached
+    messages = [
+        _SUMMARY_MSG,
+        {"role": "user", "content": summary_prompt},
+    ]
+    if on_chunk is None:
+        chat_completion = get_client().chat.completions.create(
+            messages=messages,
+            model=MODEL_FAST,
+            temperature=0.2,
+            max_tokens=256,
+        )
+        response = chat_completion.choices[0].message.content
+    else:
+        response = _stream_summary(messages, on_chunk)
+    if response:
+        response = response.strip()
+        SUMMARY_CACHE.set(cache_key, response)
+        return response
+    return ""
+
+def _stream_summary(messages, on_chunk) -> str:
+    parts = []
+    buffer = ""
+    stream = get_client().chat.completions.create(
+        messages=messages,
+        model=MODEL_FAST,
         temperature=0.2,
         max_tokens=256,
+        stream=True,
     )
-    response = chat_completion.choices[0].message.content
-    if response:
-        return response.strip()
-    return ""
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            buffer += delta
+            cut = buffer.rfind("\n") + 1
+            if cut >= _SUMMARY_CHUNK_MIN:
+                on_chunk(buffer[:cut].strip())
+                buffer = buffer[cut:]
+    finally:
+        stream.close()
+    if buffer.strip():
+        on_chunk(buffer.strip())
+    return "".join(parts)
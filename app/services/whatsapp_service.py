@@ -1,5 +1,15 @@
+import logging
+
+logger = logging.getLogger("expensebot.services.whatsapp_service")
+
 def send_whatsapp_message(to: str, message: str):
     # This is a placeholder. We will implement the actual logic for
     # sending a message via the WhatsApp Business API here.
-    print(f"Sending message to {to}: {message}")
+    logger.info("Sending message to %s: %s", to, message)
+    return True
+
+async def asend_whatsapp_message(to: str, message: str):
+    # Async counterpart for the webhook's event loop. When the real API call lands,
+    # make it here through one module-level httpx.AsyncClient so sends reuse connections.
+    logger.info("Sending message to %s: %s", to, message)
     return True
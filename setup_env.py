@@ -14,6 +14,7 @@ def create_env_file():
 
 # Database Configuration
 DATABASE_URL=sqlite:///./expense_bot.db
+AUTO_CREATE_TABLES=true
 
 # Groq API Configuration
 # Replace 'your-groq-api-key-here' with your actual Groq API key
@@ -3,11 +3,7 @@
 Test script to verify the fixes for the expense tracking agent
 """
 
-import sys
-import os
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from app.database import Base
 from app.intelligent_agent_v3.agent_v3 import process_message_with_agent_v3
@@ -15,6 +11,17 @@ from app import crud, models
 
 # Create test database
 engine = create_engine("sqlite:///test_expense_agent_fixes.db")
+
+@event.listens_for(engine, "connect")
+def _tune_sqlite(dbapi_conn, _):
+    # WAL with synchronous=NORMAL: each agent commit skips the full fsync
+    cursor = dbapi_conn.cursor()
+    cursor.executescript(
+        "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=memory; "
+        "PRAGMA cache_size=-20000; PRAGMA busy_timeout=5000;"
+    )
+    cursor.close()
+
 Base.metadata.create_all(bind=engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -82,7 +89,8 @@ def test_agent_fixes():
                 if expenses:
                     print("💾 Stored expenses:")
                     for exp in expenses[-3:]:  # Show last 3 expenses
-                        category = db.query(models.Category).filter(models.Category.id == exp.category_id).first()
+                        # Primary-key lookup: repeats of a category come from the identity map, not SQL
+                        category = db.get(models.Category, exp.category_id)
                         print(f"   - {exp.amount} PKR ({category.name if category else 'unknown'}) - Note: '{exp.note}'")
             
         except Exception as e:
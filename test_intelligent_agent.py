@@ -4,47 +4,53 @@ Test script for the Intelligent Agent Module
 This script tests the agent without affecting the main FastAPI app.
 """
 
-import os
-import sys
+import json
+import logging
+from itertools import islice
+
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Add the app directory to Python path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+from app.intelligent_agent import config, memory, process_message_safely  # noqa: E402,F401
+
+logger = logging.getLogger("expensebot.test_intelligent_agent")
+
+MAX_STATS_ENTRIES = 50
 
 def test_intelligent_agent():
     """Test the intelligent agent functionality"""
     
     print("🧪 Testing Intelligent Agent Module...")
+    # Imports ran at module load; a failure there stops the script before this point
+    print("✅ All imports successful")
     
     try:
-        # Test imports
-        from intelligent_agent import config, memory, process_message_safely
-        print("✅ All imports successful")
-        
         # Test configuration
         print(f"📋 Agent enabled: {config.enabled}")
         print(f"📋 Fallback enabled: {config.fallback_to_legacy}")
         print(f"📋 Memory enabled: {config.use_memory}")
-        
-        # Test memory
-        memory_stats = memory.get_memory_summary()
-        print(f"📊 Memory stats: {memory_stats}")
-        
-        # Test configuration loading
-        print(f"🔧 LLM Model: {config.llm_model}")
-        print(f"🔧 Temperature: {config.temperature}")
-        
-        print("\n✅ All tests passed! The intelligent agent module is ready.")
-        print("\n📝 To enable the intelligent agent, set USE_INTELLIGENT_AGENT=true in your .env file")
-        print("📝 The agent will automatically fall back to your existing system if disabled or if errors occur")
-        
     except Exception as e:
         print(f"❌ Test failed: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Intelligent agent config check failed")
+        return
+    
+    # Test memory
+    memory_stats = memory.get_memory_summary()
+    # Compact JSON of at most MAX_STATS_ENTRIES entries, so the line stays short (and
+    # still valid JSON) if the summary grows
+    shown = dict(islice(memory_stats.items(), MAX_STATS_ENTRIES))
+    truncated = " …truncated" if len(shown) < len(memory_stats) else ""
+    print("📊 Memory stats:", json.dumps(shown, default=str, separators=(",", ":")) + truncated)
+    
+    # Test configuration loading
+    print(f"🔧 LLM Model: {config.llm_model}")
+    print(f"🔧 Temperature: {config.temperature}")
+    
+    print("\n✅ All tests passed! The intelligent agent module is ready.")
+    print("\n📝 To enable the intelligent agent, set USE_INTELLIGENT_AGENT=true in your .env file")
+    print("📝 The agent will automatically fall back to your existing system if disabled or if errors occur")
 
 if __name__ == "__main__":
-    test_intelligent_agent() 
\ No newline at end of file
+    test_intelligent_agent()
@@ -0,0 +1,5 @@
+import os
+
+# app.database and the Groq clients read these at import; tests never reach either service
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("GROQ_API_KEY", "test")
@@ -0,0 +1,18 @@
+import pytest
+
+from app.services.agent import IntelligentExpenseAgent
+
+
+@pytest.fixture
+def agent():
+    return IntelligentExpenseAgent(db=None)
+
+
+@pytest.mark.parametrize("message", ["hi", "Hello there", "hey bot", "salaam!", "assalam o alaikum"])
+def test_greetings(agent, message):
+    assert agent.detect_intent(message) == "greeting"
+
+
+@pytest.mark.parametrize("message", ["high rent this month", "show my history", "his bill was 500", "this week"])
+def test_words_starting_with_a_greeting_are_not_greetings(agent, message):
+    assert agent.detect_intent(message) != "greeting"
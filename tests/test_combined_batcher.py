@@ -0,0 +1,41 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from app.intelligent_agent_v3 import tools
+
+
+def _response(obj):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(obj)))])
+
+
+def test_results_are_matched_by_id_and_users_never_share_a_prompt(monkeypatch):
+    prompts = []
+
+    async def fake_completion(messages, max_tokens=None, json_mode=False):
+        prompts.append(messages[1]["content"])
+        if messages[0] is tools._COMBINED_SYS:
+            return _response({"intent": "chitchat", "echo": messages[1]["content"]})
+        items = [json.loads(line) for line in messages[1]["content"].splitlines()]
+        # Reordered, the first message dropped, and a result for an id that was never sent
+        results = [{"id": item["id"], "intent": "chitchat", "echo": item["message"]} for item in reversed(items[1:])]
+        return _response({"results": results + [{"id": "unknown", "intent": "query"}]})
+
+    monkeypatch.setattr(tools, "achat_completion", fake_completion)
+
+    async def burst():
+        batcher = tools.combined_batcher()
+        assert batcher is tools.combined_batcher()
+        return await asyncio.gather(
+            batcher.submit("a", "first"), batcher.submit("a", "second"), batcher.submit("a", "third"),
+            batcher.submit("b", "other user"),
+        )
+
+    first, second, third, other = asyncio.run(burst())
+    assert first is None
+    assert second == {"intent": "chitchat", "echo": "second"}
+    assert third == {"intent": "chitchat", "echo": "third"}
+    assert other == {"intent": "chitchat", "echo": "other user"}
+    assert not any("other user" in prompt and "first" in prompt for prompt in prompts)
+    # A fresh loop gets its own batcher and semaphore
+    asyncio.run(burst())
@@ -0,0 +1,31 @@
+import pytest
+
+from app.expense_rules import extract_simple_expense
+from app.services.llm_service import parse_simple_expense
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("lunch 800", {"amount": 800, "category": "food", "note": "lunch"}),
+    ("800 lunch", {"amount": 800, "category": "food", "note": "lunch"}),
+    ("fuel 1.5k", {"amount": 1500, "category": "transportation", "note": "fuel"}),
+    ("laptop 80,000", {"amount": 80000, "category": "electronics", "note": "laptop"}),
+    ("new shoes 4000", {"amount": 4000, "category": "shopping", "note": "new shoes"}),
+])
+def test_known_item_logs_are_parsed(message, expected):
+    assert extract_simple_expense(message) == [expected]
+    assert parse_simple_expense(message) == {
+        "intent": "expense_logging", "expenses": [expected], "query": None, "source": "rule",
+    }
+
+
+@pytest.mark.parametrize("message", [
+    # Filters and questions, not logs
+    "last 5", "expenses 10", "page 2", "lunch 800?", "how much on lunch 800",
+    # Dated logs are left to the LLM
+    "lunch 800 yesterday", "lunch 800 on monday", "fuel 2000 last week", "dinner 1200 12/3",
+    # Items outside CATEGORY_KEYWORDS, or only modified by a keyword
+    "random 500", "500", "phone bill 2000", "uber eats 800", "coffee machine 15000",
+])
+def test_everything_else_is_left_to_the_llm(message):
+    assert extract_simple_expense(message) is None
+    assert parse_simple_expense(message) is None
@@ -0,0 +1,54 @@
+import pytest
+
+from app.intelligent_agent_v3.state import AgentState
+from app.intelligent_agent_v3.tools import CombinedIntentExtractTool, ExtractExpenseTool, classify_intent_locally
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("lunch 800", "log_expense"),
+    ("fuel 1.5k", "log_expense"),
+    ("spending breakdown", "breakdown"),
+    ("breakdown this month", "query"),
+    # Period-scoped summaries are not the all-time report
+    ("weekly summary", "query"),
+    ("monthly breakdown", "query"),
+    ("breakdown last 7 days", "query"),
+    ("daily summary", "query"),
+    ("how much did I spend on food", "query"),
+    ("hi", "chitchat"),
+])
+def test_classify_intent_locally(message, intent):
+    assert classify_intent_locally(message) == intent
+
+
+@pytest.mark.parametrize("message", ["last 5", "lunch 800?", "what is the weather"])
+def test_classify_intent_locally_defers_unclear_messages(message):
+    assert classify_intent_locally(message) is None
+
+
+def test_simple_log_is_handled_without_the_llm():
+    tool = CombinedIntentExtractTool()
+    state = AgentState(phone_number="1", message="lunch 800")
+    assert tool._fast_log(state) == {
+        "intent": "log_expense",
+        "expenses": [{"amount": 800, "category": "food", "note": "lunch"}],
+        "pending_context": {},
+    }
+
+
+@pytest.mark.parametrize("message", ["lunch 800", "hi", "spending breakdown"])
+def test_pending_context_skips_local_shortcuts(message):
+    tool = CombinedIntentExtractTool()
+    state = AgentState(phone_number="1", message=message, pending_context={"type": "missing_amount", "item": "coffee"})
+    assert tool._fast_log(state) is None
+    assert tool._quick_intent(state) is None
+
+
+@pytest.mark.parametrize("pending_context, message, expected", [
+    ({"type": "missing_amount", "item": "coffee"}, "500", "500 for coffee"),
+    ({"type": "missing_item", "amount": 500}, "coffee", "500 PKR for coffee"),
+    ({}, "coffee 500", "coffee 500"),
+])
+def test_follow_up_is_sent_with_the_pending_expense(pending_context, message, expected):
+    state = AgentState(phone_number="1", message=message, pending_context=pending_context)
+    assert ExtractExpenseTool()._user_content(state) == expected
@@ -0,0 +1,34 @@
+import pytest
+
+from app.services import llm_service
+
+
+@pytest.mark.parametrize("period", ["week", "month", "all", "unknown"])
+def test_breakdown_sql_binds_the_user(period):
+    statement, params = llm_service.generate_breakdown_sql(42, period)
+    assert ":user_id" in statement.text
+    assert "42" not in statement.text
+    assert params == {"user_id": 42}
+
+
+def test_generated_sql_is_shared_and_the_user_is_a_parameter(monkeypatch):
+    key = (llm_service.MODEL_SQL, llm_service.normalize_message("total spent on food"))
+    monkeypatch.setattr(llm_service, "SQL_CACHE", llm_service.TTLCache(maxsize=8, ttl=60))
+    llm_service.SQL_CACHE.set(key, "SELECT SUM(amount) FROM expenses e WHERE e.user_id = :user_id")
+    sql, params = llm_service.generate_sql_from_query("Total spent on food?", 7)
+    assert sql == "SELECT SUM(amount) FROM expenses e WHERE e.user_id = :user_id"
+    assert params == {"user_id": 7}
+
+
+@pytest.mark.parametrize("message, period", [
+    ("spending breakdown", "all"),
+    ("breakdown for this week", "week"),
+    ("spending by category this month", "month"),
+])
+def test_breakdown_requests(message, period):
+    assert llm_service.parse_breakdown_request(message)["time_period"] == period
+
+
+@pytest.mark.parametrize("message", ["add new categories", "rename my categories", "show my categories"])
+def test_category_management_is_not_a_breakdown(message):
+    assert llm_service.parse_breakdown_request(message) is None
@@ -0,0 +1,24 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect, text
+
+from app import models
+from app.main import app
+
+
+def test_read_root():
+    # Without the context manager the lifespan (and its DB setup) is skipped
+    response = TestClient(app).get("/")
+    assert response.status_code == 200
+
+
+def test_missing_indexes_are_added_to_existing_tables():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER, category_id INTEGER, amount FLOAT, timestamp DATETIME, note VARCHAR)"))
+    models.Base.metadata.create_all(engine)
+    assert not inspect(engine).get_indexes("expenses")
+
+    models.create_missing_indexes(engine)
+    models.create_missing_indexes(engine)
+    names = {index["name"] for index in inspect(engine).get_indexes("expenses")}
+    assert {"ix_expense_user_ts", "ix_expense_user_cat"} <= names
@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import models
+from app.intelligent_agent_v3.state import DB_SESSION, AgentState
+from app.intelligent_agent_v3.tools import SQL_CACHE, QuerySQLTool, llm_cache_key
+
+# No query template matches this, so the LLM-written SQL path runs
+MESSAGE = "what did I pay for coffee beans in spring"
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    token = DB_SESSION.set(session)
+    yield session
+    DB_SESSION.reset(token)
+    session.close()
+    SQL_CACHE.clear()
+
+
+def run(sql):
+    return QuerySQLTool().invoke(AgentState(phone_number="923001234567", message=MESSAGE, sql=sql))
+
+
+def test_sql_that_ran_is_cached(db):
+    sql = "SELECT COUNT(*) FROM expenses WHERE user_id = :user_id"
+    assert run(sql)["sql_result"] == 0
+    assert SQL_CACHE.get(llm_cache_key(MESSAGE)) == sql
+
+
+@pytest.mark.parametrize("sql", [
+    # Rejected by the guard
+    "SELECT COUNT(*) FROM expenses",
+    # Passes the guard but fails to execute
+    "SELECT missing_column FROM expenses WHERE user_id = :user_id",
+])
+def test_rejected_or_failing_sql_is_dropped(db, sql):
+    SQL_CACHE.set(llm_cache_key(MESSAGE), sql)
+    assert run(sql)["sql_result"] is None
+    assert SQL_CACHE.get(llm_cache_key(MESSAGE)) is None
@@ -0,0 +1,50 @@
+import pytest
+
+from app.intelligent_agent_v3.tools import guard_select_sql
+
+
+@pytest.mark.parametrize("sql", [
+    # OR lifts the user filter out of the top-level AND
+    "SELECT * FROM expenses WHERE user_id = :user_id OR 1=1",
+    "SELECT * FROM expenses e WHERE e.user_id = :user_id OR e.amount > 0",
+    # Set operations pull in unscoped rows
+    "SELECT amount FROM expenses WHERE user_id = :user_id UNION SELECT amount FROM expenses",
+    "SELECT amount FROM expenses WHERE user_id = :user_id EXCEPT SELECT amount FROM expenses WHERE user_id = 1",
+    # Every table reference needs its own filter
+    "SELECT e.amount FROM expenses e WHERE e.user_id = :user_id AND e.amount > (SELECT AVG(amount) FROM expenses)",
+    "SELECT c.name FROM expenses e JOIN categories c ON c.id = e.category_id WHERE e.user_id = :user_id",
+    "SELECT * FROM expenses e RIGHT JOIN categories c ON c.user_id = :user_id WHERE e.user_id = :user_id",
+    "WITH expenses AS (SELECT * FROM expenses) SELECT * FROM expenses",
+    "SELECT * FROM expenses e WHERE e.user_id = 5",
+    # Not a single read-only SELECT
+    "DELETE FROM expenses WHERE user_id = :user_id",
+    "SELECT 1 FROM expenses WHERE user_id = :user_id; DROP TABLE expenses",
+    "SELECT * INTO stolen FROM expenses WHERE user_id = :user_id",
+    "SELECT * FROM pg_catalog.pg_user",
+    "SELECT pg_sleep(10) FROM expenses WHERE user_id = :user_id",
+    "not sql at all",
+])
+def test_rejects_unscoped_or_unsafe_sql(sql):
+    assert guard_select_sql(sql) is None
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT SUM(amount) FROM expenses WHERE user_id = :user_id;",
+    "SELECT * FROM expenses e WHERE (e.user_id = :user_id) AND e.amount > 100",
+    "SELECT c.name, SUM(e.amount) FROM expenses e JOIN categories c ON c.id = e.category_id AND c.user_id = :user_id "
+    "WHERE e.user_id = :user_id GROUP BY c.name",
+    "WITH t AS (SELECT * FROM expenses WHERE user_id = :user_id) SELECT * FROM t",
+    "SELECT * FROM users u WHERE u.id = :user_id",
+])
+def test_accepts_scoped_select(sql):
+    guarded = guard_select_sql(sql)
+    assert guarded is not None
+    assert ":user_id" in guarded
+    assert guarded.endswith("LIMIT 1000")
+
+
+def test_keeps_existing_limit_offset_and_fetch():
+    assert guard_select_sql("SELECT * FROM expenses WHERE user_id = :user_id LIMIT 5").endswith("LIMIT 5")
+    assert guard_select_sql("SELECT * FROM expenses WHERE user_id = :user_id OFFSET 5").endswith("LIMIT 1000 OFFSET 5")
+    fetched = guard_select_sql("SELECT * FROM expenses WHERE user_id = :user_id FETCH FIRST 5 ROWS ONLY")
+    assert fetched.endswith("FETCH FIRST 5 ROWS ONLY") and "LIMIT" not in fetched